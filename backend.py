@@ -0,0 +1,135 @@
+import logging
+from typing import Protocol, runtime_checkable
+from resilience import CircuitOpenError
+
+# 可用的後端名稱
+BACKENDS = ('gemini', 'grok', 'router')
+
+
+@runtime_checkable
+class ChatBackend(Protocol):
+    """LLM 後端介面
+
+    所有後端都必須提供非同步的 chat_async，讓 Discord 事件迴圈在等待模型回覆時
+    仍能處理心跳、斜線指令與其他事件。
+    """
+
+    async def chat_async(self, text: str, session_key=None, persona=None) -> str:
+        """送出一則使用者訊息並回傳模型回覆
+
+        session_key 決定使用哪段對話歷史，persona 為 PersonaRegistry 中的角色，None 時使用建立後端時的提示。
+        """
+        ...
+
+    def get_history(self, session_key=None):
+        """獲取歷史記錄"""
+        ...
+
+    def cleanup(self):
+        """清理資源"""
+        ...
+
+
+class ConversationBackend:
+    """gemini_ai 與 Grok 共用的對話流程
+
+    重試、寫入對話歷史與錯誤時的回覆都在這裡處理；子類別提供 sessions、compactor、resilience，
+    並實作單次嘗試的 _generate(session, text, persona) 與 _stream(session, text, persona)。
+    每次嘗試都由目前的歷史重新組合請求，重試不會重複加入使用者訊息。
+    """
+    display_name = 'AI'
+
+    async def _generate(self, session, text: str, persona=None) -> str:
+        raise NotImplementedError
+
+    def _stream(self, session, text: str, persona=None):
+        raise NotImplementedError
+
+    async def generate(self, session, text: str, persona=None) -> str:
+        """產生回覆但不寫入對話歷史，失敗時拋出例外；歷史由呼叫端以 commit 寫入"""
+        return await self.resilience.call(lambda: self._generate(session, text, persona))
+
+    async def generate_stream(self, session, text: str, persona=None):
+        """以串流方式產生回覆但不寫入對話歷史，失敗時拋出例外"""
+        async for chunk in self.resilience.stream(lambda: self._stream(session, text, persona)):
+            yield chunk
+
+    def commit(self, session, text: str, reply: str):
+        """將一輪對話寫入歷史，並視需要在背景壓縮"""
+        session.extend_turn(text, reply)
+        self.compactor.maybe_compact(session)
+
+    async def chat_async(self, text: str, session_key=None, persona=None):
+        """非同步呼叫模型 API，等待期間不會阻塞事件迴圈"""
+        if not text or not isinstance(text, str):
+            logging.error("無效的輸入文本")
+            return "抱歉，我無法處理空白或無效的輸入。"
+
+        session = self.sessions.get(session_key)
+        try:
+            reply = await self.generate(session, text, persona)
+        except CircuitOpenError as e:
+            logging.warning(f"略過 {self.display_name} 請求: {e}")
+            return "抱歉，AI 服務暫時無法使用，請稍後再試。"
+        except Exception as e:
+            logging.error(f"在調用 {self.display_name} API 時發生錯誤: {e}")
+            return "抱歉，我現在遇到了一些技術問題，請稍後再試。"
+
+        self.commit(session, text, reply)
+        return reply
+
+    async def chat_stream(self, text: str, session_key=None, persona=None):
+        """以串流方式呼叫模型 API，逐段產生回覆內容
+
+        只有在尚未產生任何內容前才會重試；完整回覆結束後才寫入對話歷史。
+        """
+        if not text or not isinstance(text, str):
+            logging.error("無效的輸入文本")
+            yield "抱歉，我無法處理空白或無效的輸入。"
+            return
+
+        session = self.sessions.get(session_key)
+        parts = []
+        try:
+            async for chunk in self.generate_stream(session, text, persona):
+                parts.append(chunk)
+                yield chunk
+        except Exception as e:
+            # 已經送出部分內容時無法重試，交給呼叫端處理
+            if parts:
+                raise
+            logging.error(f"在以串流調用 {self.display_name} API 時發生錯誤: {e}")
+            yield "抱歉，我現在遇到了一些技術問題，請稍後再試。"
+            return
+
+        self.commit(session, text, ''.join(parts))
+
+
+def create_backend(model: str, prompt: str, sessions=None, token_budget: int = 4000, context_cache: bool = False):
+    """依模型名稱建立 AI 後端
+
+    供應商的模組在這裡才匯入，只載入選用的那一個（google.generativeai 與 openai 各需要將近一秒），
+    缺少的 API Key 也在建立後端時才檢查。context_cache 啟用 Gemini 的伺服器端快取。
+    """
+    name = model.lower()
+    if name not in BACKENDS:
+        logging.warning(f"未知模型：{model}")
+        name = 'gemini'
+
+    if name == 'grok':
+        from grok import Grok
+        return Grok(prompt=prompt, sessions=sessions, token_budget=token_budget)
+
+    from gemini import gemini_ai
+    gemini = gemini_ai(prompt=prompt, sessions=sessions, token_budget=token_budget, context_cache=context_cache)
+    if name == 'gemini':
+        return gemini
+
+    from grok import Grok
+    from router import RouterBackend
+    # Gemini 為主、Grok 為備援，共用同一組對話歷史
+    return RouterBackend(
+        gemini,
+        Grok(prompt=prompt, sessions=sessions, token_budget=token_budget),
+        sessions=sessions
+    )
@@ -0,0 +1,74 @@
+import re
+import time
+
+BATCH_INSTRUCTION = (
+    "（以上是多位使用者幾乎同時傳來的訊息。請分別回覆每一位使用者，"
+    "每段回覆都以「@名稱:」單獨開頭，例如：\n{example}）"
+)
+
+
+class MentionBatch:
+    """同一頻道、同一段對話中短時間內累積的提及訊息
+
+    第一則訊息放入佇列後，在 worker 取出並關閉之前，後續同一對話的訊息都會併入這一批。
+    """
+    def __init__(self, key, message):
+        self.key = key
+        self.messages = [message]
+        self.enqueued_at = time.monotonic()
+        self.closed = False
+        self.timer = None  # 等待 batch_window 時的 call_later handle
+
+    def add(self, message):
+        self.messages.append(message)
+
+    def authors(self):
+        """依第一次出現的順序回傳不重複的作者"""
+        seen = {}
+        for message in self.messages:
+            seen.setdefault(message.author.id, message.author)
+        return list(seen.values())
+
+    def __len__(self):
+        return len(self.messages)
+
+
+def format_message(message) -> str:
+    return f"[{message.author.display_name}]: {message.content}"
+
+
+def build_batch_prompt(messages, authors) -> str:
+    """將多則訊息合併成一個多人對話的輸入"""
+    lines = [format_message(m) for m in messages]
+    example = '\n'.join(f"@{a.display_name}: ……" for a in authors)
+    return '\n'.join(lines) + '\n' + BATCH_INSTRUCTION.format(example=example)
+
+
+def split_batch_reply(reply: str, authors):
+    """把模型的回覆依「@名稱:」拆回每位作者，回傳 {作者 id: 回覆}
+
+    有任何作者找不到對應段落時回傳 None，由呼叫端改為整段一起回覆。
+    """
+    by_name = {}
+    for author in authors:
+        by_name.setdefault(author.display_name, author)
+    names = sorted(by_name, key=len, reverse=True)
+    pattern = re.compile(
+        r'^[ \t>*_]*@?\[?(' + '|'.join(re.escape(n) for n in names) + r')\]?[*_]*[ \t]*[:：]',
+        re.MULTILINE
+    )
+
+    matches = list(pattern.finditer(reply))
+    if not matches:
+        return None
+    parts = {}
+    for i, match in enumerate(matches):
+        end = matches[i + 1].start() if i + 1 < len(matches) else len(reply)
+        text = reply[match.end():end].strip()
+        author = by_name[match.group(1)]
+        if text:
+            parts[author.id] = f"{parts[author.id]}\n{text}" if author.id in parts else text
+
+    if any(author.id not in parts for author in authors):
+        return None
+    return parts
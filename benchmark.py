@@ -0,0 +1,353 @@
+"""離線端對端壓力測試
+
+以假的 Discord 物件與假的 LLM 後端驅動 DiscordBot.on_message，量測
+提及 → on_message → 佇列 → ai.chat_async → channel.send 整條流程的表現，不需要連線到 Discord。
+
+    python benchmark.py --rate 20 --duration 30 --channels 8 --latency 1.5
+    python benchmark.py --save baseline.json
+    python benchmark.py --baseline baseline.json
+"""
+import re
+import sys
+import json
+import math
+import time
+import random
+import asyncio
+import logging
+import argparse
+from itertools import count
+
+from discord_bot import DiscordBot
+from session import SessionManager, SCOPES
+from log_config import setup_logging
+
+_ids = count(1)
+_MESSAGE_TAG = re.compile(r'#bench-(\d+)')
+
+
+class FakeUser:
+    """假的 Discord 使用者"""
+    def __init__(self, name: str, user_id: int = None, bot: bool = False):
+        self.id = user_id or next(_ids)
+        self.name = name
+        self.display_name = name
+        self.bot = bot
+        self.mention = f'<@{self.id}>'
+
+    def mentioned_in(self, message) -> bool:
+        return self.mention in message.content
+
+    def __eq__(self, other):
+        return isinstance(other, FakeUser) and other.id == self.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+
+class FakeGuild:
+    def __init__(self, guild_id: int = None):
+        self.id = guild_id or next(_ids)
+
+
+class FakeSentMessage:
+    """假頻道送出的訊息，支援編輯"""
+    def __init__(self, channel, content: str):
+        self.channel = channel
+        self.content = content
+        self.id = next(_ids)
+
+    async def edit(self, content: str = None, **kwargs):
+        self.channel.edits += 1
+        self.content = content
+        if self.channel.on_send:
+            self.channel.on_send(content)
+
+
+class FakeChannel:
+    """記錄所有送出訊息的假頻道"""
+    def __init__(self, name: str, guild: FakeGuild, channel_id: int = None, send_latency: float = 0.0):
+        self.id = channel_id or next(_ids)
+        self.name = name
+        self.guild = guild
+        self.send_latency = send_latency
+        self.sent = []   # (送出時間, 內容)
+        self.edits = 0
+        self.on_send = None
+
+    async def send(self, content: str = None, **kwargs):
+        if self.send_latency:
+            await asyncio.sleep(self.send_latency)
+        self.sent.append((time.perf_counter(), content))
+        if self.on_send:
+            self.on_send(content)
+        return FakeSentMessage(self, content)
+
+
+class FakeMessage:
+    """假的 discord.Message"""
+    def __init__(self, author: FakeUser, channel: FakeChannel, content: str):
+        self.id = next(_ids)
+        self.author = author
+        self.channel = channel
+        self.guild = channel.guild
+        self.content = content
+        self.mentions = []
+
+
+class FakeBackend:
+    """可設定延遲與錯誤率的假 LLM 後端
+
+    延遲取自對數常態分佈（中位數 latency、離散程度 sigma），error_rate 的請求會拋出例外。
+    """
+    def __init__(self, latency: float = 1.0, sigma: float = 0.5, error_rate: float = 0.0,
+                 reply_chars: int = 120, chunk_chars: int = 20, sessions: SessionManager = None):
+        self.latency = latency
+        self.sigma = sigma
+        self.error_rate = error_rate
+        self.reply_chars = reply_chars
+        self.chunk_chars = chunk_chars
+        self.sessions = sessions if sessions is not None else SessionManager()
+        self.calls = 0
+        self.started = {}   # 訊息編號 -> 開始呼叫的時間
+        self.failed = set()  # 模擬錯誤的訊息編號；合併的批次失敗時整批一起記錄
+
+    def _delay(self):
+        if self.sigma:
+            return random.lognormvariate(math.log(self.latency), self.sigma)
+        return self.latency
+
+    def _mark(self, text: str):
+        self.calls += 1
+        for tag in _MESSAGE_TAG.findall(text):
+            self.started.setdefault(int(tag), time.perf_counter())
+
+    def _reply(self, text: str):
+        tags = ' '.join(f'#bench-{t}' for t in _MESSAGE_TAG.findall(text))
+        return f'{tags} ' + '喵' * self.reply_chars
+
+    async def chat_async(self, text: str, session_key=None, persona=None):
+        self._mark(text)
+        await asyncio.sleep(self._delay())
+        if random.random() < self.error_rate:
+            self.failed.update(int(tag) for tag in _MESSAGE_TAG.findall(text))
+            raise RuntimeError("模擬的 LLM 錯誤")
+        reply = self._reply(text)
+        self.sessions.get(session_key).extend_turn(text, reply)
+        return reply
+
+    async def chat_stream(self, text: str, session_key=None, persona=None):
+        self._mark(text)
+        reply = self._reply(text)
+        delay = self._delay()
+        chunks = [reply[i:i + self.chunk_chars] for i in range(0, len(reply), self.chunk_chars)]
+        # 失敗的請求在隨機的位置中斷：可能在第一段之前，也可能已經送出部分內容
+        fail_at = random.randrange(len(chunks)) if random.random() < self.error_rate else None
+        for i, chunk in enumerate(chunks):
+            await asyncio.sleep(delay / len(chunks))
+            if i == fail_at:
+                self.failed.update(int(tag) for tag in _MESSAGE_TAG.findall(text))
+                raise RuntimeError("模擬的 LLM 錯誤")
+            yield chunk
+        self.sessions.get(session_key).extend_turn(text, reply)
+
+    def get_history(self, session_key=None):
+        return self.sessions.get(session_key).messages
+
+    def cleanup(self):
+        self.sessions.clear()
+
+
+def percentile(values, p: float):
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def build_bot(backend, workers: int = 4, stream: bool = False, **kwargs) -> DiscordBot:
+    """建立連接假後端、不連線 Discord 的 DiscordBot"""
+    bot = DiscordBot(token=None, ai=backend, workers=workers, stream=stream,
+                     stream_edit_interval=0.0, metrics_port=None, store_path=None,
+                     send_rate=10000, send_burst=10000, **kwargs)
+    bot.bot._connection.user = FakeUser('bench-bot', bot=True)
+    bot.is_ready.set()
+    return bot
+
+
+class LoopLagSampler:
+    """量測事件迴圈延遲"""
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.samples = []
+        self._task = None
+
+    async def _run(self):
+        while True:
+            before = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, time.perf_counter() - before - self.interval) * 1000)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+
+
+class Pipeline:
+    """把 DiscordBot 與假頻道串起來，負責注入訊息並收集結果
+
+    tracker 記錄每則訊息開始呼叫 LLM 的時間（started）、失敗的訊息（failed）與呼叫次數（calls），
+    通常就是 FakeBackend；使用真實後端搭配模擬伺服器時則傳入該伺服器。
+    """
+    def __init__(self, bot: DiscordBot, tracker, channels: int = 4, users: int = 20,
+                 send_latency: float = 0.0):
+        self.bot = bot
+        self.tracker = tracker
+        guild = FakeGuild()
+        self.channels = [FakeChannel(f'bench-{i}', guild, send_latency=send_latency) for i in range(channels)]
+        self.users = [FakeUser(f'user{i}') for i in range(users)]
+        self.injected = {}    # 訊息編號 -> 注入時間
+        self.completed = {}   # 訊息編號 -> 回覆首次出現在頻道的時間（串流時為第一次編輯）
+        self.errors = set()   # 已收到錯誤回覆的訊息編號，與 completed 不重疊
+        self.closed = False
+        self.done = asyncio.Event()
+        for channel in self.channels:
+            channel.on_send = self._on_send
+
+    def _on_send(self, content: str):
+        now = time.perf_counter()
+        for tag in _MESSAGE_TAG.findall(content or ''):
+            if int(tag) not in self.errors:
+                self.completed.setdefault(int(tag), now)
+        # 錯誤回覆不帶編號：依內容判斷，並以後端記錄的失敗編號逐則計算（一批失敗時整批都算錯誤）；
+        # 串流途中失敗的訊息已經出現過部分回覆，改記為錯誤
+        if content and '抱歉' in content and not _MESSAGE_TAG.search(content):
+            for number in self.tracker.failed:
+                self.errors.add(number)
+                self.completed.pop(number, None)
+        if self.closed and self.finished() >= len(self.injected):
+            self.done.set()
+
+    def finished(self) -> int:
+        return len(self.completed) + len(self.errors)
+
+    async def inject(self, content: str, channel: FakeChannel = None, user: FakeUser = None):
+        """注入一則提及機器人的訊息"""
+        number = len(self.injected) + 1
+        channel = channel or random.choice(self.channels)
+        user = user or random.choice(self.users)
+        message = FakeMessage(user, channel, f'{self.bot.bot.user.mention} {content} #bench-{number}')
+        self.injected[number] = time.perf_counter()
+        await self.bot.on_message(message)
+        return number
+
+    async def finish(self, timeout: float):
+        """停止注入並等待剩餘訊息處理完成"""
+        self.closed = True
+        if self.finished() >= len(self.injected):
+            self.done.set()
+        try:
+            await asyncio.wait_for(self.done.wait(), timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"等待逾時，仍有 {len(self.injected) - self.finished()} 則訊息未完成")
+
+    def report(self, elapsed: float, lag_samples):
+        e2e = [(self.completed[n] - t) * 1000 for n, t in self.injected.items() if n in self.completed]
+        waits = [(self.tracker.started[n] - t) * 1000 for n, t in self.injected.items() if n in self.tracker.started]
+        return {
+            'injected': len(self.injected),
+            'completed': len(self.completed),
+            'errors': len(self.errors),
+            'llm_calls': self.tracker.calls,
+            'throughput_rps': len(self.completed) / elapsed if elapsed else 0.0,
+            'queue_wait_p50_ms': percentile(waits, 50),
+            'queue_wait_p99_ms': percentile(waits, 99),
+            'e2e_p50_ms': percentile(e2e, 50),
+            'e2e_p99_ms': percentile(e2e, 99),
+            'loop_lag_p50_ms': percentile(lag_samples, 50),
+            'loop_lag_p99_ms': percentile(lag_samples, 99),
+            'loop_lag_max_ms': max(lag_samples) if lag_samples else float('nan'),
+        }
+
+
+async def run_benchmark(rate: float = 10, duration: float = 10, channels: int = 4, users: int = 20,
+                        workers: int = 4, latency: float = 1.0, sigma: float = 0.5, error_rate: float = 0.0,
+                        stream: bool = False, send_latency: float = 0.0, drain_timeout: float = 60,
+                        scope: str = 'user', batch_window: float = None):
+    """以泊松到達的速率注入訊息，回傳統計結果"""
+    backend = FakeBackend(latency=latency, sigma=sigma, error_rate=error_rate, sessions=SessionManager(scope=scope))
+    bot = build_bot(backend, workers=workers, stream=stream, batch_window=batch_window)
+    pipeline = Pipeline(bot, backend, channels=channels, users=users, send_latency=send_latency)
+    lag = LoopLagSampler()
+
+    bot.start_workers()
+    lag.start()
+    started = time.perf_counter()
+    deadline = started + duration
+    while time.perf_counter() < deadline:
+        await pipeline.inject('你好，今天過得如何？')
+        await asyncio.sleep(random.expovariate(rate))
+
+    await pipeline.finish(drain_timeout)
+    elapsed = time.perf_counter() - started
+    await lag.stop()
+    for task in bot.worker_tasks:
+        task.cancel()
+    await asyncio.gather(*bot.worker_tasks, return_exceptions=True)
+    return pipeline.report(elapsed, lag.samples)
+
+
+def print_report(result: dict, baseline: dict = None):
+    print(f"{'指標':<22}{'本次':>14}" + (f"{'基準':>14}{'差異':>10}" if baseline else ''))
+    for key, value in result.items():
+        line = f"{key:<22}{value:>14.2f}" if isinstance(value, float) else f"{key:<22}{value:>14}"
+        if baseline and key in baseline:
+            base = baseline[key]
+            line += f"{base:>14.2f}" if isinstance(base, float) else f"{base:>14}"
+            if isinstance(base, (int, float)) and base:
+                line += f"{(value - base) / base:>+10.1%}"
+        print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="DiscordBot 離線端對端壓力測試")
+    parser.add_argument('--rate', type=float, default=10, help="每秒注入的提及數量")
+    parser.add_argument('--duration', type=float, default=10, help="注入持續秒數")
+    parser.add_argument('--channels', type=int, default=4)
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--latency', type=float, default=1.0, help="假 LLM 延遲中位數（秒）")
+    parser.add_argument('--sigma', type=float, default=0.5, help="假 LLM 延遲的對數常態離散程度")
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--send-latency', type=float, default=0.0, help="假頻道 send 的延遲（秒）")
+    parser.add_argument('--stream', action='store_true', help="使用串流回覆")
+    parser.add_argument('--scope', choices=SCOPES, default='user', help="對話範圍")
+    parser.add_argument('--batch-window', type=float, help="啟用提及訊息批次合併，並設定等待秒數")
+    parser.add_argument('--save', help="將結果存成 JSON 作為基準")
+    parser.add_argument('--baseline', help="與先前存下的基準比較")
+    args = parser.parse_args(argv)
+
+    setup_logging(logging.WARNING)
+    result = asyncio.run(run_benchmark(
+        rate=args.rate, duration=args.duration, channels=args.channels, users=args.users,
+        workers=args.workers, latency=args.latency, sigma=args.sigma, error_rate=args.error_rate,
+        stream=args.stream, send_latency=args.send_latency, scope=args.scope, batch_window=args.batch_window
+    ))
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+    print_report(result, baseline)
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
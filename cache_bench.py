@@ -0,0 +1,123 @@
+"""Gemini context caching 離線比較
+
+對本機的 MockGeminiServer 以相同的對話分別在停用與啟用 context_cache 的情況下執行
+gemini_ai.chat_stream，比較計費的輸入 token、快取命中次數與首字延遲。
+模擬伺服器以字元數當作 token 數，首字延遲隨未快取的輸入長度增加。
+
+預設使用與正式環境相同的門檻（--preset production）：prompt/ 中的角色設定約 500–1300 tokens，
+都低於 4096 的快取下限，只有角色加上累積的對話歷史才可能被快取。--preset lowered 把下限調到
+800 並立即重建歷史快取，只用來觀察快取機制本身，數字不代表正式環境的節省。
+
+    python cache_bench.py
+    python cache_bench.py --preset lowered --turns 6
+    python cache_bench.py --sessions 10 --turns 30 --keys 3
+
+啟用快取後沒有任何命中，或計費的輸入 token 沒有減少時以狀態碼 1 結束。
+"""
+import sys
+import time
+import asyncio
+import logging
+import argparse
+
+from benchmark import percentile, print_report
+from gemini import gemini_ai
+from mock_llm import MockGeminiServer
+from persona import PersonaRegistry
+from token_counter import TokenEstimator
+from log_config import setup_logging
+
+
+# 正式環境的預設值（gemini_ai 與 ContextCacheManager），以及為了在短時間內看到快取效果而調低的設定
+PRESETS = {
+    'production': dict(min_cache_tokens=4096, history_step=2048, rebuild_interval=300, token_budget=4000),
+    'lowered': dict(min_cache_tokens=800, history_step=300, rebuild_interval=0, token_budget=0),
+}
+
+
+async def run_cache_bench(context_cache: bool, sessions: int = 5, turns: int = 20, keys: int = 2,
+                          message: str = '你好' * 50, min_cache_tokens: int = 4096, history_step: int = 2048,
+                          rebuild_interval: float = 300, token_budget: int = 4000,
+                          latency: float = 0.05, prefill_rate: float = 5000):
+    """以 sessions 段對話各進行 turns 輪（同一輪的對話同時送出），回傳統計結果"""
+    server = MockGeminiServer(latency=latency, prefill_rate=prefill_rate, min_cache_tokens=min_cache_tokens)
+    await server.start()
+    prompt = PersonaRegistry(poll_interval=0).get().prompt
+    # 不測試 Key 池的速率限制，RPM 設得夠高避免請求排隊
+    ai = gemini_ai(prompt=prompt, keys=[f'mock-{i}' for i in range(keys)], endpoint=server.endpoint,
+                   context_cache=context_cache, cache_min_tokens=min_cache_tokens, token_budget=token_budget,
+                   rpm_per_key=100_000)
+    if ai.caches is not None:
+        ai.caches.history_step = history_step
+        ai.caches.rebuild_interval = rebuild_interval
+
+    ttft = []
+
+    async def one(session: int):
+        started = time.perf_counter()
+        first = None
+        async for _ in ai.chat_stream(message, session_key=('bench', session)):
+            if first is None:
+                first = time.perf_counter() - started
+        ttft.append(first * 1000)
+
+    try:
+        for _ in range(turns):
+            await asyncio.gather(*(one(session) for session in range(sessions)))
+            # 讓背景建立快取的工作有機會完成
+            await asyncio.sleep(0.1)
+        if ai.caches is not None:
+            await ai.caches.close()
+    finally:
+        await server.stop()
+
+    return {
+        'requests': server.requests,
+        'billed_input_tokens': server.billed_input,
+        'cached_input_tokens': server.cached_input,
+        'cache_hits': server.cache_hits,
+        'caches_created': server.cache_calls['create'],
+        'caches_left': len(server.caches),
+        'ttft_mean_ms': sum(ttft) / len(ttft) if ttft else float('nan'),
+        'ttft_p99_ms': percentile(ttft, 99),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="比較 Gemini context caching 的計費 token 與首字延遲")
+    parser.add_argument('--preset', choices=PRESETS, default='production',
+                        help="production：與正式環境相同的快取門檻；lowered：調低門檻以便在短時間內看到快取效果")
+    parser.add_argument('--sessions', type=int, default=5, help="同時進行的對話數")
+    parser.add_argument('--turns', type=int, default=20, help="每段對話的輪數")
+    parser.add_argument('--keys', type=int, default=2, help="模擬的 API Key 數量")
+    parser.add_argument('--min-cache-tokens', type=int, help="覆寫快取的最小長度（模擬伺服器與 gemini_ai 相同）")
+    parser.add_argument('--history-step', type=int, help="覆寫建立歷史快取所需累積的未快取歷史長度")
+    args = parser.parse_args(argv)
+
+    setup_logging(logging.WARNING)
+    settings = dict(PRESETS[args.preset])
+    if args.min_cache_tokens is not None:
+        settings['min_cache_tokens'] = args.min_cache_tokens
+    if args.history_step is not None:
+        settings['history_step'] = args.history_step
+    persona = PersonaRegistry(poll_interval=0).get()
+    persona_tokens = TokenEstimator().count(persona.prompt)
+
+    options = dict(sessions=args.sessions, turns=args.turns, keys=args.keys, **settings)
+    baseline = asyncio.run(run_cache_bench(False, **options))
+    result = asyncio.run(run_cache_bench(True, **options))
+    print(f"設定（{args.preset}）：" + '，'.join(f'{key}={value}' for key, value in settings.items()))
+    if persona_tokens < settings['min_cache_tokens']:
+        print(f"預設角色「{persona.name}」約 {persona_tokens} tokens，低於快取下限，單獨無法建立快取；"
+              f"只有角色加上累積的對話歷史達到下限時才會使用快取")
+    print("基準：停用 context_cache；本次：啟用 context_cache")
+    print_report(result, baseline)
+
+    if result['cache_hits'] == 0 or result['billed_input_tokens'] >= baseline['billed_input_tokens']:
+        print("啟用快取後沒有減少計費的輸入 token", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
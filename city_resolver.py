@@ -0,0 +1,155 @@
+import re
+from bisect import bisect_left
+from collections import defaultdict, namedtuple
+from functools import lru_cache
+from city_names import CITY_NAMES
+
+CityMatch = namedtuple('CityMatch', ['name', 'city', 'score'])
+
+# 簡體字與異體字轉為城市表使用的繁體字
+_CHAR_MAP = str.maketrans({
+    '臺': '台', '东': '東', '伦': '倫', '区': '區', '图': '圖', '园': '園', '广': '廣',
+    '约': '約', '纽': '紐', '县': '縣', '绳': '繩', '罗': '羅', '义': '義', '旧': '舊',
+    '华': '華', '莲': '蓮', '兰': '蘭', '连': '連', '门': '門', '云': '雲', '顿': '頓',
+    '马': '馬', '尔': '爾', '冈': '岡', '矶': '磯', '湾': '灣',
+})
+# 可省略的行政區後綴
+_CJK_SUFFIXES = ('市', '縣', '都', '府', '區')
+_EN_SUFFIXES = (' city', ' county')
+_NON_WORD = re.compile(r'[\s,.\-_()（）]+')
+# resolve 接受模糊比對結果的最短輸入長度
+MIN_FUZZY_CHARS = 2
+
+
+@lru_cache(maxsize=4096)
+def normalize(text: str) -> str:
+    """統一城市名稱寫法：簡轉繁、臺→台、英文小寫、移除行政區後綴與標點"""
+    text = text.strip().translate(_CHAR_MAP).casefold()
+    for suffix in _EN_SUFFIXES:
+        if text.endswith(suffix):
+            text = text[:-len(suffix)]
+    text = _NON_WORD.sub('', text)
+    for suffix in _CJK_SUFFIXES:
+        # 至少保留兩個字，避免「京都」變成「京」
+        if text.endswith(suffix) and len(text) > 2:
+            text = text[:-1]
+            break
+    return text
+
+
+def _ngrams(text: str):
+    if len(text) < 2:
+        return {text} if text else set()
+    return {text[i:i + 2] for i in range(len(text) - 1)}
+
+
+class CityResolver:
+    """城市名稱解析器
+
+    匯入時為 CITY_NAMES 的所有中文名稱與英文名稱建立正規化索引，
+    精確比對直接查表，前綴比對使用排序陣列二分搜尋，模糊比對使用雙字 n-gram 倒排索引。
+    """
+    def __init__(self, city_names: dict):
+        self.city_names = city_names
+        self.aliases = {}                  # 正規化名稱 -> 英文查詢名稱
+        self.display = {}                  # 英文查詢名稱 -> 顯示用中文名稱
+        self.index = defaultdict(set)      # n-gram -> 正規化名稱
+
+        for name, city in city_names.items():
+            # 優先以帶「市」「縣」的名稱作為顯示名稱
+            if city not in self.display or (name.endswith(('市', '縣')) and not self.display[city].endswith(('市', '縣'))):
+                self.display[city] = name
+            self._add_alias(name, city)
+
+        for city in set(city_names.values()):
+            self._add_alias(city, city)
+
+        self.sorted_aliases = sorted(self.aliases)
+
+    def _add_alias(self, alias: str, city: str):
+        key = normalize(alias)
+        if not key:
+            return
+        self.aliases.setdefault(key, city)
+        for gram in _ngrams(key):
+            self.index[gram].add(key)
+
+    def resolve(self, query: str, threshold: float = 0.5):
+        """解析使用者輸入，回傳 CityMatch；找不到或無法確定是哪個城市時回傳 None
+
+        不是完全相同的名稱時，前綴必須只對應到一個城市（「新」同時是新北與新加坡的前綴），
+        模糊比對則至少要有 MIN_FUZZY_CHARS 個字；自動完成的排序不受這些限制。
+        """
+        if not query:
+            return None
+        if query in self.city_names:
+            return CityMatch(query, self.city_names[query], 1.0)
+        matches = self.search(query, limit=1)
+        if not matches or matches[0].score < threshold:
+            return None
+        if matches[0].score < 1.0:
+            key = normalize(query)
+            cities = self._prefix_cities(key)
+            if len(cities) > 1 or (not cities and len(key) < MIN_FUZZY_CHARS):
+                return None
+        return matches[0]
+
+    def _prefix_cities(self, key: str, limit: int = 2):
+        """回傳名稱以 key 開頭的城市，找到 limit 個就停止"""
+        cities = set()
+        for i in range(bisect_left(self.sorted_aliases, key), len(self.sorted_aliases)):
+            alias = self.sorted_aliases[i]
+            if not alias.startswith(key):
+                break
+            cities.add(self.aliases[alias])
+            if len(cities) >= limit:
+                break
+        return cities
+
+    def search(self, query: str, limit: int = 25):
+        """依相似度排序回傳候選城市，同一城市只出現一次"""
+        return list(self._search(query, limit))
+
+    @lru_cache(maxsize=1024)
+    def _search(self, query: str, limit: int):
+        key = normalize(query)
+        if not key:
+            # 沒有輸入時依原始順序列出城市
+            cities = list(dict.fromkeys(self.city_names.values()))[:limit]
+            return tuple(CityMatch(self.display[c], c, 0.0) for c in cities)
+
+        scores = {}
+        # 完全相同
+        if key in self.aliases:
+            scores[key] = 1.0
+
+        # 前綴比對
+        for i in range(bisect_left(self.sorted_aliases, key), len(self.sorted_aliases)):
+            alias = self.sorted_aliases[i]
+            if not alias.startswith(key):
+                break
+            scores.setdefault(alias, 0.9)
+
+        # n-gram 模糊比對（Dice 係數）
+        grams = _ngrams(key)
+        overlap = defaultdict(int)
+        for gram in grams:
+            for alias in self.index.get(gram, ()):
+                overlap[alias] += 1
+        for alias, shared in overlap.items():
+            score = 0.85 * 2 * shared / (len(grams) + len(_ngrams(alias)))
+            if score >= 0.3 and score > scores.get(alias, 0):
+                scores[alias] = score
+
+        best = {}
+        for alias, score in sorted(scores.items(), key=lambda item: -item[1]):
+            city = self.aliases[alias]
+            if city not in best:
+                best[city] = CityMatch(self.display[city], city, score)
+            if len(best) >= limit:
+                break
+        return tuple(best.values())
+
+
+# 匯入時建立索引
+resolver = CityResolver(CITY_NAMES)
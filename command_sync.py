@@ -0,0 +1,95 @@
+import os
+import json
+import asyncio
+import hashlib
+import logging
+import discord
+
+
+class CommandSyncer:
+    """斜線指令同步
+
+    以已註冊指令的 payload 計算指紋並保存在本機，指紋與上次同步時相同就不呼叫 API；
+    全域同步既慢又有嚴格的速率限制，每次啟動或重新連線都同步並不必要。
+    guild_ids 不為空時改為只同步到這些伺服器（開發用，變更會立即生效），全域指令會先複製過去。
+    """
+    def __init__(self, tree: discord.app_commands.CommandTree, path: str = 'command_sync.json', guild_ids=None):
+        self.tree = tree
+        self.path = path
+        self.guild_ids = list(guild_ids or [])
+        self._task = None
+        self._lock = asyncio.Lock()
+
+    def _targets(self):
+        """回傳要同步的 (名稱, guild)，guild 為 None 表示全域"""
+        if not self.guild_ids:
+            return [('global', None)]
+        return [(str(guild_id), discord.Object(id=guild_id)) for guild_id in self.guild_ids]
+
+    def fingerprint(self, guild=None) -> str:
+        """計算指令樹的指紋，與註冊順序無關"""
+        commands = [command.to_dict(self.tree) for command in self.tree.get_commands(guild=guild)]
+        commands.sort(key=lambda payload: (payload.get('type', 1), payload['name']))
+        raw = json.dumps(commands, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def _load(self) -> dict:
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logging.warning(f'讀取指令同步記錄失敗，將重新同步：{e}')
+            return {}
+
+    def _save(self, state: dict):
+        # 先寫入暫存檔再取代，避免中斷時留下不完整的檔案
+        temp = f'{self.path}.tmp'
+        with open(temp, 'w', encoding='utf-8') as f:
+            json.dump(state, f, ensure_ascii=False, indent=2)
+        os.replace(temp, self.path)
+
+    async def sync(self, force: bool = False):
+        """同步指紋有變更的目標，force 為 True 時一律同步，回傳實際同步的目標名稱"""
+        async with self._lock:
+            state = self._load()
+            # 同一份記錄檔可能被多個機器人帳號共用，依應用程式 ID 分開保存
+            app_key = str(self.tree.client.application_id)
+            saved = state.setdefault(app_key, {})
+            synced = []
+            for name, guild in self._targets():
+                if guild is not None:
+                    self.tree.copy_global_to(guild=guild)
+                fingerprint = self.fingerprint(guild)
+                if not force and saved.get(name) == fingerprint:
+                    logging.info(f'斜線指令（{name}）沒有變更，略過同步')
+                    continue
+                commands = await self.tree.sync(guild=guild)
+                saved[name] = fingerprint
+                synced.append(name)
+                logging.info(f'已同步 {len(commands)} 個斜線指令（{name}）')
+            if synced:
+                try:
+                    self._save(state)
+                except OSError as e:
+                    logging.warning(f'保存指令同步記錄失敗：{e}')
+            return synced
+
+    async def _run(self, force: bool):
+        try:
+            await self.sync(force)
+        except Exception as e:
+            logging.error(f'同步斜線指令時發生錯誤：{e}')
+
+    def start(self, force: bool = False):
+        """在背景同步，不延遲機器人就緒"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(force))
+        return self._task
+
+    async def stop(self):
+        if self._task and not self._task.done():
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
@@ -0,0 +1,93 @@
+import asyncio
+import logging
+from token_counter import estimate_tokens
+
+SUMMARY_PROMPT = (
+    "請將以下對話整理成簡潔的繁體中文摘要，保留參與者、重要事實、約定與尚未結束的話題，"
+    "不要加入評論或額外內容。"
+)
+
+
+def format_transcript(messages) -> str:
+    """將訊息列表轉成純文字對話紀錄，供摘要使用"""
+    lines = []
+    for m in messages:
+        speaker = '模型' if m['role'] == 'assistant' else '使用者'
+        lines.append(f"{speaker}：{m['content']}")
+    return '\n'.join(lines)
+
+
+def build_summary_request(previous_summary: str, messages) -> str:
+    """組合摘要請求內容"""
+    parts = [SUMMARY_PROMPT]
+    if previous_summary:
+        parts.append(f"先前的摘要：\n{previous_summary}")
+    parts.append(f"新的對話：\n{format_transcript(messages)}")
+    return '\n\n'.join(parts)
+
+
+class ContextCompactor:
+    """以 token 預算控制對話長度
+
+    超出預算時，將較舊的訊息交給背景任務濃縮成滾動摘要，最近的 keep_recent 則訊息保持原文。
+    摘要在背景進行，不會延遲當前回覆。
+    """
+    def __init__(self, summarize, token_budget: int = 4000, keep_recent: int = 6, estimate=estimate_tokens):
+        self.summarize = summarize
+        self.token_budget = token_budget
+        self.keep_recent = keep_recent
+        self.estimate = estimate
+        self._tasks = set()
+
+    def session_tokens(self, session) -> int:
+        """計算對話目前佔用的 token 數量（含摘要）"""
+        total = self.estimate(session.summary)
+        for m in session.messages:
+            total += self.estimate(m['content'])
+        return total
+
+    def view(self, session):
+        """回傳 (摘要, 最近訊息)，供後端組合請求內容"""
+        return session.summary, list(session.messages)
+
+    def maybe_compact(self, session):
+        """超出預算時排程背景摘要"""
+        if session.compacting or not self.token_budget:
+            return
+        if len(session.messages) <= self.keep_recent:
+            return
+        if self.session_tokens(session) <= self.token_budget:
+            return
+
+        session.compacting = True
+        task = asyncio.create_task(self._compact(session))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _compact(self, session):
+        try:
+            older = session.messages[:len(session.messages) - self.keep_recent]
+            if not older:
+                return
+
+            summary = await self.summarize(session.summary, older)
+            if not summary:
+                logging.warning(f"對話 {session.key} 的摘要為空，略過壓縮")
+                return
+
+            # 摘要期間可能有新訊息加入或被硬性上限裁掉，只移除仍在開頭且已被摘要的訊息
+            summarized = {id(m) for m in older}
+            count = 0
+            while count < len(session.messages) and id(session.messages[count]) in summarized:
+                count += 1
+            session.set_summary(summary, count)
+            logging.info(f"已壓縮對話 {session.key}：{len(older)} 則訊息併入摘要，目前約 {self.session_tokens(session)} tokens")
+        except Exception as e:
+            logging.error(f"壓縮對話 {session.key} 時發生錯誤: {e}")
+        finally:
+            session.compacting = False
+
+    async def wait_idle(self):
+        """等待所有背景摘要完成"""
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
@@ -3,135 +3,195 @@ import logging
 import discord
 from discord.ext import commands
 import asyncio
-from gemini import gemini_ai
-from grok import Grok
 import time
-import aiohttp
+import math
 from discord import app_commands
-from rich.logging import RichHandler
-from rich import traceback
-from tqdm import tqdm
-import requests
 from city_names import CITY_NAMES  # 導入城市名稱對照表
+from city_resolver import resolver as city_resolver
+from session import SessionManager
+from backend import create_backend
+from startup import STARTUP
+from persona import PersonaRegistry
+from store import ConversationStore
+from purge import PurgeEngine, InteractionProgress
+from command_sync import CommandSyncer
+from dispatcher import OutboundDispatcher, BULK
+from latency import LatencyMonitor, SERIES
+from metrics import MetricsServer, MESSAGES_RECEIVED, MENTIONS_QUEUED, QUEUE_DEPTH, QUEUE_WAIT, REPLIES, MENTION_BATCH_SIZE
+from batching import MentionBatch, format_message, build_batch_prompt, split_batch_reply
+from traffic_trace import TraceRecorder
+from weather import WeatherService, WeatherPrefetcher, WeatherError, WEATHER_ICONS
 import datetime
 
 # 設置環境變數以抑制 gRPC 警告
 os.environ['GRPC_PYTHON_LOG_LEVEL'] = '0'
 os.environ['GRPC_VERBOSITY'] = 'ERROR'
 
-# 設定日誌
-traceback.install(show_locals=True)
+# Discord 單則訊息的字數上限
+MESSAGE_LIMIT = 2000
+# /clear 單次可清除的訊息數量上限
+MAX_PURGE = 100000
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[RichHandler()]
-)
+
+def split_message(text: str, limit: int = MESSAGE_LIMIT):
+    """將過長的文字切成 (可發送的部分, 剩餘部分)，優先在換行處切開"""
+    if len(text) <= limit:
+        return text, ''
+    cut = text.rfind('\n', 0, limit)
+    if cut <= limit // 2:
+        cut = limit
+    return text[:cut], text[cut:].lstrip('\n')
 
 
 class DiscordBot:
     """Discord Bot 類別"""
-    def __init__(self, token, owner_id = None, model: str = 'Gemini', wait: bool = False):
+    def __init__(self, token, owner_id = None, model: str = 'Gemini', wait: bool = False,
+                 session_scope: str = 'user', max_sessions: int = 500, session_ttl: float = 3600,
+                 workers: int = 4, token_budget: int = 4000, stream: bool = False,
+                 stream_edit_interval: float = 1.2, metrics_port: int = 9108, ai=None,
+                 trace_path: str = None, trace_content: bool = False, store_path: str = None,
+                 send_rate: float = 1.0, send_burst: int = 5, batch_window: float = None, batch_max: int = 8,
+                 context_cache: bool = False, sync_guilds=None, force_sync: bool = False):
         """初始化 Discord Bot"""
         self.token = token
         self.owner_id = owner_id
         self.wait = wait
         
+        # 串流回覆：先發送佔位訊息，再隨著內容產生逐步編輯
+        self.stream = stream
+        self.stream_edit_interval = stream_edit_interval
+        
+        # 對話管理：依 (伺服器, 頻道, 使用者) 分開保存上下文；指定 store_path 時另外寫入本機資料庫
+        self.store = ConversationStore(store_path) if store_path else None
+        self.sessions = SessionManager(scope=session_scope, max_sessions=max_sessions, ttl=session_ttl,
+                                       store=self.store)
+        
+        # 角色設定：啟動時一次讀入 prompt/*.md，之後檔案變更會自動重新載入
+        with STARTUP.phase('角色設定'):
+            self.personas = PersonaRegistry()
+        
         # 城市名稱對照表
         self.CITY_NAMES = CITY_NAMES  # 設置城市名稱對照表
         
-        # 初始化 AI
-        with open('E:/project/Discord/prompt/千雪.md', 'r', encoding='utf-8') as f:
-            p = f.read()
+        # 天氣查詢服務（共用連線池與快取）
+        self.weather = WeatherService()
+        self.weather_prefetcher = WeatherPrefetcher(self.weather)
+        # 預設地點一開始就列入預取
+        self.weather_prefetcher.record(self.CITY_NAMES['新北市'])
         
-        if model.lower() == 'gemini':
-            self.ai = gemini_ai(prompt=p)
-
-        elif model.lower() == 'grok':
-            self.ai = Grok(prompt=p)
-
+        # 初始化 AI（可由外部傳入後端，例如壓力測試用的假後端）
+        if ai is not None:
+            self.ai = ai
+            # 沿用後端自己的對話管理，確保鍵值與歷史在同一處
+            injected = getattr(ai, 'sessions', None)
+            if injected is not None and injected is not self.sessions:
+                if self.store is not None:
+                    if injected.store is None:
+                        # 把資料庫接到後端的對話管理上，否則 store_path 不會收到任何寫入
+                        injected.attach_store(self.store)
+                    elif injected.store is not self.store:
+                        logging.warning('傳入的後端已使用自己的對話資料庫，忽略 store_path')
+                        self.store = None
+                self.sessions = injected
         else:
-            logging.warning(f"未知模型：{model}")
-            self.ai = gemini_ai(prompt=p)
+            self.ai = self._create_ai(model, token_budget, context_cache)
 
         # 設定 bot
         intents = discord.Intents.all()
         self.bot = commands.Bot(command_prefix='!', intents=intents)
+        
+        # 斜線指令只在內容變更時同步；sync_guilds 指定時只同步到這些伺服器（開發用）
+        self.command_syncer = CommandSyncer(self.bot.tree, guild_ids=sync_guilds)
+        self.force_sync = force_sync
+        
+        # 所有對外發送的訊息都經過排程器，依頻道與全域速率上限送出
+        self.dispatcher = OutboundDispatcher(self.bot.http, channel_rate=send_rate, channel_burst=send_burst)
+        
+        # 背景延遲取樣
+        self.latency = LatencyMonitor(self.bot)
         self.is_ready = asyncio.Event()
         
-        # 初始化訊息佇列
-        self.message_queue = asyncio.Queue()
+        # 初始化訊息佇列：依頻道分片，同一頻道的訊息固定由同一個 worker 依序處理
+        self.workers = max(1, workers)
+        self.message_queues = [asyncio.Queue() for _ in range(self.workers)]
+        self.worker_tasks = []
         self.processing = False
         
+        # 提及訊息批次合併（選用）：batch_window 為 None 時停用，0 表示只合併仍在佇列中等待的訊息；
+        # 合併成多則的批次不使用串流回覆（見 handle_batch）。
+        # 批次以 (頻道, 對話鍵值) 區分，一次請求只能帶一段對話歷史：預設的 session_scope='user' 下
+        # 每位使用者各自一段對話，只會合併同一個人的連續訊息；要把同頻道多位使用者的訊息合併成
+        # 一次多人請求，需使用 'channel' 以上的對話範圍
+        self.batch_window = batch_window
+        self.batch_max = batch_max
+        self.open_batches = {}
+        for worker_id, queue in enumerate(self.message_queues):
+            QUEUE_DEPTH.set_function(queue.qsize, shard=worker_id)
+        
+        # 流量記錄（選用），供離線重播使用
+        self.tracer = TraceRecorder(trace_path, include_content=trace_content) if trace_path else None
+        
+        # 本機指標端點（Prometheus 文字格式），metrics_port 為 None 時停用
+        self.metrics_server = MetricsServer(port=metrics_port) if metrics_port else None
+        
         # 註冊指令和事件
         self.setup_commands()
         
+    def _create_ai(self, model: str, token_budget: int, context_cache: bool = False):
+        """依模型名稱建立 AI 後端，context_cache 啟用 Gemini 的伺服器端快取"""
+        with STARTUP.phase(f'AI 後端（{model}）'):
+            return create_backend(model, self.personas.get().prompt, sessions=self.sessions,
+                                  token_budget=token_budget, context_cache=context_cache)
+
     def setup_commands(self):
         """設定所有指令和事件"""
         
         # 設定事件
         @self.bot.event
         async def setup_hook():
-            try:
-                await self.bot.tree.sync()
-                logging.info("已同步斜線指令")
-            except Exception as e:
-                logging.error(f"同步斜線指令時發生錯誤：{e}")
             await self.setup_hook()
             
         @self.bot.event
         async def on_ready():
             await self.on_ready()
             
+        @self.bot.command(name="sync")
+        async def sync_command(ctx: commands.Context, mode: str = None):
+            """同步斜線指令：!sync 只在指令有變更時同步，!sync force 強制同步"""
+            if ctx.author.id != self.owner_id:
+                return
+            try:
+                synced = await self.command_syncer.sync(force=mode == 'force')
+            except Exception as e:
+                logging.error(f'同步斜線指令時發生錯誤：{e}')
+                await ctx.reply('同步斜線指令時發生錯誤')
+                return
+            await ctx.reply(f"已同步：{'、'.join(synced)}" if synced else '斜線指令沒有變更，不需要同步')
+
         # 註冊斜線指令
         @self.bot.tree.command(name="ping", description="檢查機器人延遲")
         async def ping(interaction: discord.Interaction):
-            """測量各種延遲的平均值（10次測量）"""
-            await interaction.response.defer()
-            
-            # 初始化延遲列表
-            bot_latencies = []
-            api_latencies = []
-            ws_latencies = []
-            
-            # 進行10次測量
-            for _ in range(10):
-                # Bot 回應延遲
-                before = time.monotonic()
-                bot_latency = (time.monotonic() - before) * 1000
-                bot_latencies.append(bot_latency)
-                
-                # API 延遲
-                api_before = time.monotonic()
-                async with aiohttp.ClientSession() as session:
-                    async with session.get('https://discord.com/api/v10/gateway') as resp:
-                        api_latency = (time.monotonic() - api_before) * 1000
-                api_latencies.append(api_latency)
-                
-                # WebSocket 延遲
-                ws_latencies.append(self.bot.latency * 1000)
-                
-                # 短暫延遲以避免速率限制
-                await asyncio.sleep(0.5)
-            
-            # 計算平均值
-            avg_bot = round(sum(bot_latencies) / len(bot_latencies))
-            avg_api = round(sum(api_latencies) / len(api_latencies))
-            avg_ws = round(sum(ws_latencies) / len(ws_latencies))
-            avg_total = round((avg_bot + avg_api + avg_ws) / 3)
-            
+            """顯示背景取樣的延遲百分位數"""
             # 建立嵌入式訊息
             embed = discord.Embed(title="延遲測試報告", color=discord.Color.blue())
             
+            lines = []
+            for name, label in SERIES.items():
+                stats = self.latency.summary(name)
+                if not stats['count']:
+                    lines.append(f"**{label}**：尚無資料")
+                    continue
+                lines.append(
+                    f"**{label}**：p50 {stats['p50']:.0f}ms / p95 {stats['p95']:.0f}ms / "
+                    f"p99 {stats['p99']:.0f}ms（{stats['count']} 筆）"
+                )
+            
             # 使用 embed.description 顯示延遲資訊
-            embed.description = (
-                f"**Bot 回應延遲**：{avg_bot}ms\n"
-                f"**API 延遲**：{avg_api}ms\n"
-                f"**網路延遲**：{avg_ws}ms\n"
-                f"**平均延遲**：{avg_total}ms"
-            )
+            embed.description = "\n".join(lines)
+            if math.isfinite(self.bot.latency):
+                embed.set_footer(text=f"目前心跳延遲：{round(self.bot.latency * 1000)}ms")
             
-            await interaction.followup.send(embed=embed)
+            await interaction.response.send_message(embed=embed)
 
         @self.bot.tree.command(name="exit", description="關閉機器人")
         async def exit_command(interaction: discord.Interaction):
@@ -144,35 +204,40 @@ class DiscordBot:
             await self.close()
 
         @self.bot.tree.command(name="clear", description="清除指定數量的訊息")
-        @app_commands.describe(amount="要清除的訊息數量（1-100）")
+        @app_commands.describe(amount=f"要清除的訊息數量（1-{MAX_PURGE}）")
         async def clear(interaction: discord.Interaction, amount: int = 10):
             """清除訊息"""
             if interaction.user.id != self.owner_id:
                 await interaction.response.send_message("只有機器人擁有者可以使用此指令", ephemeral=True)
                 return
             
-            if not 0 < amount <= 100:
-                await interaction.response.send_message("清除數量必須在 1 到 100 之間", ephemeral=True)
+            if not 0 < amount <= MAX_PURGE:
+                await interaction.response.send_message(f"清除數量必須在 1 到 {MAX_PURGE} 之間", ephemeral=True)
                 return
             
-            await interaction.response.defer(ephemeral=True)
+            await interaction.response.send_message("正在清除訊息...", ephemeral=True)
             
+            # 清除可能超過互動權杖的 15 分鐘期限，之後改在頻道中回報
+            report = InteractionProgress(interaction, self.dispatcher)
             try:
-                deleted = await interaction.channel.purge(limit=amount)
-                await interaction.followup.send(f"已清除 {len(deleted)} 條訊息", ephemeral=True)
+                await self.clear(interaction.channel, amount, progress=report)
+            except discord.Forbidden:
+                await report.update("我沒有權限清除這個頻道的訊息", force=True)
             except Exception as e:
                 logging.error(f'清除訊息時發生錯誤：{e}')
-                await interaction.followup.send("清除訊息時發生錯誤", ephemeral=True)
+                await report.update("清除訊息時發生錯誤", force=True)
 
         @self.bot.tree.command(name="royoo", description="關心指定使用者今天女裝了嗎")
         @app_commands.describe(
             amount="要詢問的次數（預設10次）",
-            user="要關心的使用者（預設為 Royoo）"
+            user="要關心的使用者（預設為 Royoo）",
+            pack="將連續的訊息合併成較少則發送"
         )
         async def royoo(
             interaction: discord.Interaction,
             amount: int = 10,  # 預設為10次
-            user: discord.Member = None  # 預設為 None，後面會改為 Royoo 的 ID
+            user: discord.Member = None,  # 預設為 None，後面會改為 Royoo 的 ID
+            pack: bool = False
         ):
             """關心指定使用者今天女裝了嗎"""
             # 檢查次數是否在合理範圍內
@@ -230,20 +295,17 @@ class DiscordBot:
                 else:
                     user_mention = user.mention
 
-                # 發送訊息
-                sent_count = 0
-                for i in range(amount):
-                    try:
-                        await target_thread.send(f"每日關心 {user_mention} 今天女裝了嗎？")
-                        sent_count += 1
-                        logging.info(f"成功發送第 {sent_count}/{amount} 條訊息")
-                        
-                        # 如果不是最後一條訊息，則等待一下
-                        if i < amount - 1:
-                            await asyncio.sleep(0.5)
-                    except Exception as e:
-                        logging.error(f"發送第 {sent_count + 1} 條訊息時發生錯誤: {e}")
-                        break
+                # 交給發送排程器，依頻道速率上限盡快送出，個別失敗不影響其他訊息
+                text = f"每日關心 {user_mention} 今天女裝了嗎？"
+                results = await asyncio.gather(
+                    *(self.dispatcher.send(target_thread, text, priority=BULK, pack=pack) for _ in range(amount)),
+                    return_exceptions=True
+                )
+                errors = [r for r in results if isinstance(r, Exception)]
+                sent_count = amount - len(errors)
+                if errors:
+                    logging.error(f"發送關心訊息時有 {len(errors)} 則失敗，例如：{errors[0]}")
+                logging.info(f"成功發送 {sent_count}/{amount} 條訊息")
 
                 # 更新結果訊息
                 if sent_count == amount:
@@ -302,6 +364,16 @@ class DiscordBot:
                 inline=True
             )
             
+            # 天氣快取資訊
+            weather_stats = self.weather.stats()
+            embed.add_field(
+                name="🌤️ 天氣快取",
+                value=f"🎯 命中率：{weather_stats['hit_rate']:.0%}\n"
+                      f"📡 上游請求：{weather_stats['upstream_requests']}\n"
+                      f"⏱️ 平均上游延遲：{round(weather_stats['avg_upstream_latency_ms'])}ms",
+                inline=True
+            )
+            
             # 設置伺服器圖標
             if guild.icon:
                 embed.set_thumbnail(url=guild.icon.url)
@@ -324,7 +396,8 @@ class DiscordBot:
                 "help": "顯示此幫助訊息",
                 "exit": "關閉機器人 (管理員專用)",
                 "Royoo": "每日關心 Royoo 今天女裝了嗎",
-                "weather": "查詢指定地點的天氣預報"
+                "weather": "查詢指定地點的天氣預報",
+                "persona": "切換這個頻道或自己的對話所使用的角色"
             }
             
             for cmd, desc in commands.items():
@@ -334,6 +407,13 @@ class DiscordBot:
                     inline=False
                 )
             
+            if self.batch_window is not None:
+                if self.sessions.scope == 'user':
+                    batching = "短時間內連續提及機器人的訊息會合併成一次回覆；每個人的對話分開保存，只會合併同一個人的訊息"
+                else:
+                    batching = "短時間內提及機器人的訊息會合併成一次請求，再分別回覆每一位使用者"
+                embed.add_field(name="提及合併", value=batching, inline=False)
+            
             embed.set_footer(text="提示：輸入 / 可以看到所有可用的指令")
             await interaction.response.send_message(embed=embed)
 
@@ -351,62 +431,24 @@ class DiscordBot:
                 - 歐洲：倫敦、巴黎等
             """
             try:
-                # 轉換城市名稱
-                if location in self.CITY_NAMES:
-                    city_name = self.CITY_NAMES[location]
+                # 轉換城市名稱（支援臺/台、簡體字、英文與錯字）
+                match = city_resolver.resolve(location)
+                if match:
+                    location = match.name
+                    city_name = match.city
+                    self.weather_prefetcher.record(city_name)
                 else:
                     await interaction.response.send_message(f"抱歉，找不到 {location} 的天氣資訊。請確認城市名稱是否正確。", ephemeral=True)
                     return
                 
-                # OpenWeatherMap API設置
-                api_key = "5f11c065acc703865b9351406ac35562"
-                base_url = "http://api.openweathermap.org/data/2.5"
-                
-                # 天氣圖標對照表
-                WEATHER_ICONS = {
-                    "Clear": "☀️",
-                    "Clouds": "☁️",
-                    "Rain": "🌧️",
-                    "Drizzle": "🌦️",
-                    "Thunderstorm": "⛈️",
-                    "Snow": "🌨️",
-                    "Mist": "🌫️",
-                    "Smoke": "🌫️",
-                    "Haze": "🌫️",
-                    "Dust": "🌫️",
-                    "Fog": "🌫️",
-                    "Sand": "🌫️",
-                    "Ash": "🌫️",
-                    "Squall": "🌪️",
-                    "Tornado": "🌪️"
-                }
-
-                # 發送當前天氣API請求
-                current_params = {
-                    "q": city_name,
-                    "appid": api_key,
-                    "units": "metric",  # 使用攝氏溫度
-                    "lang": "zh_tw"     # 使用繁體中文
-                }
-                
-                # 發送未來天氣預報API請求
-                forecast_params = {
-                    "q": city_name,
-                    "appid": api_key,
-                    "units": "metric",
-                    "lang": "zh_tw"
-                }
+                # 先回應互動，避免查詢天氣時超過互動期限
+                await interaction.response.defer()
 
                 try:
-                    # 獲取當前天氣
-                    current_response = requests.get(f"{base_url}/weather", params=current_params)
-                    current_data = current_response.json()
-                    
-                    # 獲取未來天氣預報
-                    forecast_response = requests.get(f"{base_url}/forecast", params=forecast_params)
-                    forecast_data = forecast_response.json()
+                    # 同時取得當前天氣與未來天氣預報（優先使用快取）
+                    current_data, forecast_data = await self.weather.get_weather(city_name)
 
-                    if current_response.status_code == 200:
+                    if current_data:
                         # 獲取當前天氣圖標
                         current_icon = WEATHER_ICONS.get(current_data['weather'][0]['main'], "🌈")
                         
@@ -429,7 +471,7 @@ class DiscordBot:
                         embed.add_field(name="📍 當前天氣", value=current_weather, inline=False)
 
                         # 處理未來天氣預報
-                        if forecast_response.status_code == 200:
+                        if forecast_data:
                             # 按照日期分組預報數據
                             daily_forecasts = {}
                             today = datetime.datetime.now().strftime('%m/%d')
@@ -474,15 +516,79 @@ class DiscordBot:
                             icons_text = " ".join([f"{icon} {desc}" for desc, icon in WEATHER_ICONS.items()])
                             embed.set_footer(text=f"天氣圖標說明：{icons_text}")
                         
-                        await interaction.response.send_message(embed=embed)
+                        await interaction.followup.send(embed=embed)
                     else:
-                        await interaction.response.send_message(f"抱歉，無法獲取 {location} 的天氣資訊。", ephemeral=True)
+                        await interaction.followup.send(f"抱歉，無法獲取 {location} 的天氣資訊。", ephemeral=True)
+                except WeatherError as e:
+                    logging.warning(f'無法獲取 {location} 的天氣資訊：{e}')
+                    await interaction.followup.send(f"抱歉，無法獲取 {location} 的天氣資訊。", ephemeral=True)
                 except Exception as e:
-                    print(f"Error: {e}")
-                    await interaction.response.send_message(f"抱歉，獲取天氣資訊時發生錯誤。", ephemeral=True)
+                    logging.error(f'獲取天氣資訊時發生錯誤：{e}')
+                    await interaction.followup.send(f"抱歉，獲取天氣資訊時發生錯誤。", ephemeral=True)
             except Exception as e:
                 logging.error(f'執行天氣指令時發生錯誤：{e}')
-                await interaction.response.send_message("執行指令時發生錯誤", ephemeral=True)
+                if interaction.response.is_done():
+                    await interaction.followup.send("執行指令時發生錯誤", ephemeral=True)
+                else:
+                    await interaction.response.send_message("執行指令時發生錯誤", ephemeral=True)
+
+        @weather.autocomplete('location')
+        async def weather_location_autocomplete(interaction: discord.Interaction, current: str):
+            """依輸入內容提供城市候選"""
+            return [
+                app_commands.Choice(name=f"{match.name} ({match.city})", value=match.name)
+                for match in city_resolver.search(current, limit=25)
+            ]
+
+        @self.bot.tree.command(name="persona", description="切換這個頻道或自己的對話所使用的角色")
+        @app_commands.describe(
+            name="角色名稱（不填則顯示目前的角色）",
+            scope="套用範圍：整個頻道或只有自己的對話",
+            reset="恢復為預設角色"
+        )
+        @app_commands.choices(scope=[
+            app_commands.Choice(name="頻道", value="channel"),
+            app_commands.Choice(name="自己的對話", value="session")
+        ])
+        async def persona(interaction: discord.Interaction, name: str = None, scope: str = "channel",
+                          reset: bool = False):
+            """切換角色"""
+            guild_id = interaction.guild.id if interaction.guild else None
+            session_key = self.sessions.key_for(guild_id, interaction.channel.id, interaction.user.id)
+            key = ('channel', interaction.channel.id) if scope == "channel" else session_key
+
+            if name is None and not reset:
+                current = self.personas.resolve(session_key, ('channel', interaction.channel.id))
+                await interaction.response.send_message(
+                    f"目前的角色：{current.name}\n可用的角色：{'、'.join(self.personas.names())}", ephemeral=True
+                )
+                return
+
+            # 整個頻道的角色只有擁有者或有管理頻道權限的成員可以更改
+            if scope == "channel" and interaction.user.id != self.owner_id:
+                permissions = getattr(interaction.user, 'guild_permissions', None)
+                if interaction.guild and not (permissions and permissions.manage_channels):
+                    await interaction.response.send_message("只有管理員可以更改整個頻道的角色", ephemeral=True)
+                    return
+
+            try:
+                self.personas.select(key, None if reset else name)
+            except KeyError:
+                await interaction.response.send_message(f"找不到角色：{name}", ephemeral=True)
+                return
+
+            target = "這個頻道" if scope == "channel" else "你的對話"
+            chosen = self.personas.resolve(key)
+            logging.info(f'{interaction.user} 將{target}的角色設為 {chosen.name}')
+            await interaction.response.send_message(f"已將{target}的角色設為：{chosen.name}", ephemeral=True)
+
+        @persona.autocomplete('name')
+        async def persona_name_autocomplete(interaction: discord.Interaction, current: str):
+            """依輸入內容提供角色候選"""
+            return [
+                app_commands.Choice(name=name, value=name)
+                for name in self.personas.names() if current in name
+            ][:25]
 
         # 註冊其他事件
         @self.bot.event
@@ -522,60 +628,258 @@ class DiscordBot:
             """當頻道被刪除時"""
             logging.debug(f'頻道被刪除 - {channel.name}')
 
-    async def process_message_queue(self):
-        """處理訊息佇列"""
+    def _persona_for(self, message, session_key):
+        """依對話、頻道的順序找出指定的角色，都沒有指定時使用預設角色"""
+        return self.personas.resolve(session_key, ('channel', message.channel.id))
+
+    def _shard_for(self, message) -> int:
+        """依頻道決定訊息要交給哪個 worker"""
+        return message.channel.id % self.workers
+
+    def queue_depth(self) -> int:
+        """所有分片佇列中等待處理的訊息總數"""
+        return sum(queue.qsize() for queue in self.message_queues)
+
+    async def enqueue_message(self, message):
+        """將訊息放入所屬頻道的分片佇列
+
+        啟用批次合併時，同一頻道、同一段對話的提及訊息在被 worker 取出前都會併入同一批
+        （session_scope='user' 時即同一位使用者）；每批第一則訊息會先等待 batch_window 秒
+        才放入佇列，讓短時間內的訊息有機會合併。
+        """
+        MENTIONS_QUEUED.inc()
+        queue = self.message_queues[self._shard_for(message)]
+        if self.batch_window is None:
+            await queue.put(MentionBatch(None, message))
+            return
+
+        key = (message.channel.id, self.sessions.key_for_message(message))
+        batch = self.open_batches.get(key)
+        if batch is not None and not batch.closed and len(batch) < self.batch_max:
+            batch.add(message)
+            return
+
+        batch = self.open_batches[key] = MentionBatch(key, message)
+        if self.batch_window > 0:
+            batch.timer = asyncio.get_running_loop().call_later(self.batch_window, self._release_batch, queue, batch)
+        else:
+            await queue.put(batch)
+
+    @staticmethod
+    def _release_batch(queue: asyncio.Queue, batch: MentionBatch):
+        batch.timer = None
+        queue.put_nowait(batch)
+
+    def flush_batches(self):
+        """取消所有等待中的 batch_window 計時，立即將這些批次放入佇列"""
+        for batch in list(self.open_batches.values()):
+            if batch.timer is not None:
+                batch.timer.cancel()
+                self._release_batch(self.message_queues[self._shard_for(batch.messages[0])], batch)
+
+    async def process_message_queue(self, worker_id: int = 0):
+        """處理單一分片的訊息佇列"""
         self.processing = True
+        queue = self.message_queues[worker_id]
         while True:
             try:
-                # 從佇列中取出訊息
-                message = await self.message_queue.get()
+                # 從佇列中取出訊息；取出後這一批就不再接受新訊息
+                batch = await queue.get()
+                batch.closed = True
+                if self.open_batches.get(batch.key) is batch:
+                    del self.open_batches[batch.key]
                 
                 try:
-                    # 調用 AI API，並加入使用者名稱
-                    user_message = f"[{message.author.display_name}]: {message.content}"
-                    response = self.ai.chat(user_message)
-                    logging.info(f'回覆：{response}')
-
-                    # 等待 5 秒
-                    if self.wait:
-                        logging.info('等待 5 秒後發送回覆...')
-                        await asyncio.sleep(5)
-                    
-                    # 發送回覆到原始頻道
-                    await message.channel.send(f'{message.author.mention} {response}')
-                    
-                except Exception as e:
-                    logging.error(f'處理訊息時發生錯誤：{e}')
-                    await message.channel.send(f'{message.author.mention} 抱歉，我現在無法正確回應，請稍後再試。')
-                
+                    MENTION_BATCH_SIZE.observe(len(batch))
+                    if len(batch) == 1:
+                        await self.handle_message(batch.messages[0], batch.enqueued_at)
+                    else:
+                        await self.handle_batch(batch)
                 finally:
                     # 標記任務完成
-                    self.message_queue.task_done()
-                    # 等待一小段時間再處理下一條訊息
-                    await asyncio.sleep(1)
+                    queue.task_done()
                     
+            except asyncio.CancelledError:
+                raise
             except Exception as e:
-                logging.error(f'佇列處理器發生錯誤：{e}')
-                await asyncio.sleep(5)  # 發生錯誤時等待較長時間
+                logging.error(f'佇列處理器 {worker_id} 發生錯誤：{e}')
+
+    async def send_reply(self, channel, text: str):
+        """發送回覆，超過字數上限時分成多則"""
+        while text:
+            head, text = split_message(text)
+            await self.dispatcher.send(channel, head)
+
+    async def handle_message(self, message, enqueued_at: float):
+        """處理單一則提及訊息"""
+        queue_wait = time.monotonic() - enqueued_at
+        QUEUE_WAIT.observe(queue_wait)
+        before = time.perf_counter()
+        llm_latency = None
+        response = None
+        status = 'ok'
+        
+        try:
+            # 調用 AI API，並加入使用者名稱
+            user_message = format_message(message)
+            session_key = self.sessions.key_for_message(message)
+            # 對話不在記憶體中時，先從資料庫載入最近的記錄
+            await self.sessions.load(session_key)
+            persona = self._persona_for(message, session_key)
+
+            if self.stream and hasattr(self.ai, 'chat_stream'):
+                response = await self.reply_streaming(message, user_message, session_key, persona)
+                llm_latency = time.perf_counter() - before
+                self.latency.record('llm', llm_latency * 1000)
+                REPLIES.inc(status='ok')
+                return
+
+            response = await self.ai.chat_async(user_message, session_key=session_key, persona=persona)
+            llm_latency = time.perf_counter() - before
+            self.latency.record('llm', llm_latency * 1000)
+            logging.info('回覆：%s', response, extra={'event': 'reply'})
+
+            # 等待 5 秒
+            if self.wait:
+                logging.info('等待 5 秒後發送回覆...')
+                await asyncio.sleep(5)
+            
+            # 發送回覆到原始頻道
+            await self.send_reply(message.channel, f'{message.author.mention} {response}')
+            REPLIES.inc(status='ok')
+            
+        except Exception as e:
+            logging.error(f'處理訊息時發生錯誤：{e}')
+            REPLIES.inc(status='error')
+            status = 'error'
+            await self.dispatcher.send(message.channel, f'{message.author.mention} 抱歉，我現在無法正確回應，請稍後再試。')
+        
+        finally:
+            if self.tracer:
+                self.tracer.record_reply(message, queue_wait, llm_latency, time.perf_counter() - before, response, status)
+
+    async def handle_batch(self, batch: MentionBatch):
+        """將同一段對話的多則提及訊息合併成一次 AI 請求，再把回覆拆回給每位使用者
+
+        合併後的回覆要先完整取得才能依作者拆開，因此即使 stream=True 也不使用串流回覆。
+        """
+        messages = batch.messages
+        channel = messages[0].channel
+        authors = batch.authors()
+        queue_wait = time.monotonic() - batch.enqueued_at
+        for _ in messages:
+            QUEUE_WAIT.observe(queue_wait)
+        before = time.perf_counter()
+        llm_latency = None
+        response = None
+        status = 'ok'
+        logging.info(f'合併 {len(messages)} 則訊息（{len(authors)} 位使用者）為一次請求')
+        
+        try:
+            session_key = batch.key[1]
+            await self.sessions.load(session_key)
+            persona = self._persona_for(messages[0], session_key)
+            if len(authors) == 1:
+                prompt = '\n'.join(format_message(m) for m in messages)
+            else:
+                prompt = build_batch_prompt(messages, authors)
+
+            response = await self.ai.chat_async(prompt, session_key=session_key, persona=persona)
+            llm_latency = time.perf_counter() - before
+            self.latency.record('llm', llm_latency * 1000)
+            logging.info('回覆：%s', response, extra={'event': 'reply'})
+
+            if self.wait:
+                logging.info('等待 5 秒後發送回覆...')
+                await asyncio.sleep(5)
+
+            parts = split_batch_reply(response, authors) if len(authors) > 1 else None
+            if parts is None:
+                # 無法依使用者拆開時，整段回覆並提及所有人
+                mentions = ' '.join(a.mention for a in authors)
+                await self.send_reply(channel, f'{mentions} {response}')
+            else:
+                for author in authors:
+                    await self.send_reply(channel, f'{author.mention} {parts[author.id]}')
+            REPLIES.inc(len(messages), status='ok')
+            
+        except Exception as e:
+            logging.error(f'處理合併訊息時發生錯誤：{e}')
+            REPLIES.inc(len(messages), status='error')
+            status = 'error'
+            mentions = ' '.join(a.mention for a in authors)
+            await self.dispatcher.send(channel, f'{mentions} 抱歉，我現在無法正確回應，請稍後再試。')
+        
+        finally:
+            if self.tracer:
+                for message in messages:
+                    self.tracer.record_reply(message, queue_wait, llm_latency, time.perf_counter() - before, response, status)
+
+    async def reply_streaming(self, message, user_message: str, session_key, persona=None):
+        """以串流方式回覆：發送佔位訊息後依固定節奏編輯，超過字數上限時接續發送新訊息"""
+        prefix = f'{message.author.mention} '
+        reply = await self.dispatcher.send(message.channel, f'{prefix}…')
+        content = prefix
+        shown = content
+        last_edit = time.monotonic()
+
+        async for chunk in self.ai.chat_stream(user_message, session_key=session_key, persona=persona):
+            content += chunk
+
+            # 超過字數上限時，定稿目前的訊息並另開一則
+            while len(content) > MESSAGE_LIMIT:
+                head, content = split_message(content)
+                await reply.edit(content=head)
+                reply = await self.dispatcher.send(message.channel, content or '…')
+                shown = content
+                last_edit = time.monotonic()
+
+            # 依固定間隔編輯，避免觸發編輯速率限制
+            if content != shown and time.monotonic() - last_edit >= self.stream_edit_interval:
+                await reply.edit(content=content)
+                shown = content
+                last_edit = time.monotonic()
+
+        if content != shown:
+            await reply.edit(content=content)
+        logging.info('回覆：%s', content, extra={'event': 'reply'})
+        return content
+
+    def start_workers(self):
+        """啟動訊息佇列處理器，每個分片一個 worker"""
+        self.worker_tasks = [
+            asyncio.create_task(self.process_message_queue(worker_id))
+            for worker_id in range(self.workers)
+        ]
+        logging.info(f'已啟動 {self.workers} 個訊息處理器')
 
     async def setup_hook(self):
         """當 bot 準備好時會被呼叫"""
         logging.info('Bot setup hook 已執行')
-        # 啟動訊息佇列處理器
-        asyncio.create_task(self.process_message_queue())
+        with STARTUP.phase('setup_hook'):
+            if self.store:
+                self.store.start()
+            self.personas.start()
+            await self.weather.start()
+            self.weather_prefetcher.start()
+            self.latency.start()
+            if self.metrics_server:
+                try:
+                    await self.metrics_server.start()
+                except OSError as e:
+                    logging.error(f'無法啟動指標端點：{e}')
+                    self.metrics_server = None
+            self.start_workers()
+            # 在背景同步斜線指令，不延遲就緒（需要登入後才有應用程式 ID）
+            if self.bot.application_id:
+                self.command_syncer.start(force=self.force_sync)
         
     async def on_ready(self):
         """當 bot 準備好時觸發"""
+        if not self.is_ready.is_set():
+            STARTUP.mark('就緒')
         self.is_ready.set()
         logging.info(f'Bot 已啟動: {self.bot.user.name}')
-        
-        # 同步斜線指令
-        try:
-            logging.info('正在同步斜線指令...')
-            await self.bot.tree.sync()
-            logging.info('斜線指令同步完成！')
-        except Exception as e:
-            logging.error(f'同步斜線指令時發生錯誤：{e}')
             
     async def start(self):
         """啟動 bot"""
@@ -587,16 +891,47 @@ class DiscordBot:
             # 停止處理新的訊息
             self.processing = False
             
+            # 還在等待 batch_window 的批次立即放入佇列，避免關閉時遺失
+            if hasattr(self, 'open_batches'):
+                self.flush_batches()
+
             # 等待所有佇列中的訊息處理完成
-            if hasattr(self, 'message_queue'):
-                if not self.message_queue.empty():
-                    await self.message_queue.join()
+            if hasattr(self, 'message_queues'):
+                await asyncio.gather(*(queue.join() for queue in self.message_queues if not queue.empty()))
+            for task in self.worker_tasks:
+                task.cancel()
+            
+            # 停止尚未完成的指令同步
+            await self.command_syncer.stop()
+            
+            # 送出已排入的訊息
+            await self.dispatcher.close()
+            
+            # 寫出尚未儲存的流量記錄
+            if self.tracer:
+                await asyncio.to_thread(self.tracer.close)
+            
+            # 停止延遲取樣與指標端點
+            await self.latency.stop()
+            if self.metrics_server:
+                await self.metrics_server.stop()
+            
+            # 停止監看角色設定
+            await self.personas.stop()
+            
+            # 關閉天氣服務的預取排程與連線池
+            await self.weather_prefetcher.stop()
+            await self.weather.close()
             
             # 關閉 Gemini 的聊天會話
             if hasattr(self, 'ai'):
                 self.ai.cleanup()
                 await asyncio.sleep(1)  # 給予時間清理
             
+            # 寫出尚未儲存的對話
+            if self.store:
+                await self.store.close()
+            
             # 關閉 Discord bot
             await self.bot.close()
             
@@ -612,52 +947,21 @@ class DiscordBot:
                 
             if user_mention:
                 message = f'{user_mention} {message}'
-            await channel.send(message)
+            await self.dispatcher.send(channel, message)
             logging.info(f'已發送訊息到頻道 {channel.name}：{message}')
         except Exception as e:
             logging.error(f'發送訊息時發生錯誤：{e}')
             raise
 
-    async def clear(self, channel, amount=100):
-        """清除指定頻道的所有訊息"""
+    async def clear(self, channel, amount=100, progress=None):
+        """清除指定頻道的訊息，amount 為 None 時清除全部"""
         await self.is_ready.wait()
         
         try:
             if not channel:
                 raise ValueError("未提供有效的頻道")
             
-            # 取得所有訊息
-            messages = []
-            async for message in channel.history(limit=amount):
-                messages.append(message)
-            
-            if messages:
-                # 使用進度條顯示刪除進度
-                with tqdm(total=len(messages), desc="正在清除訊息") as pbar:
-                    # 如果訊息數量大於100，使用批量刪除
-                    if len(messages) > 1:
-                        # Discord 限制一次最多刪除 100 條訊息，且訊息不能超過 14 天
-                        chunks = [messages[i:i + 100] for i in range(0, len(messages), 100)]
-                        for chunk in chunks:
-                            try:
-                                await channel.delete_messages(chunk)
-                                pbar.update(len(chunk))
-                            except discord.errors.HTTPException:
-                                # 如果訊息太舊無法批量刪除，就逐條刪除
-                                for msg in chunk:
-                                    try:
-                                        await msg.delete()
-                                        pbar.update(1)
-                                    except:
-                                        continue
-                    else:
-                        # 如果只有一條訊息，直接刪除
-                        await messages[0].delete()
-                        pbar.update(1)
-                        
-                logging.info(f'已清除 {len(messages)} 則訊息')
-            else:
-                logging.info('沒有需要清除的訊息')
+            return await PurgeEngine(channel, limit=amount, progress=progress).run()
                 
         except discord.Forbidden:
             logging.error('沒有權限清除訊息')
@@ -673,10 +977,17 @@ class DiscordBot:
             return
 
         # 記錄訊息資訊
-        logging.info(f'收到訊息 - 頻道: {message.channel.name} | 作者: {message.author.name} : {message.content}')
+        MESSAGES_RECEIVED.inc()
+        # 以參數傳入，只有通過抽樣的記錄才會在背景執行緒組合字串
+        logging.info('收到訊息 - 頻道: %s | 作者: %s : %s', message.channel.name, message.author.name,
+                     message.content, extra={'event': 'message_received'})
 
         # 檢查是否有提及機器人
-        if self.bot.user.mentioned_in(message):
+        mentioned = self.bot.user.mentioned_in(message)
+        if self.tracer:
+            self.tracer.record_message(message, mentioned)
+
+        if mentioned:
             # 清理消息內容，移除 mention 和額外空格
             content = message.content.replace(f'<@{self.bot.user.id}>', '').strip()
             
@@ -688,4 +999,4 @@ class DiscordBot:
                 await self.bot.close()
             else:
                 # 將訊息加入佇列
-                await self.message_queue.put(message)
+                await self.enqueue_message(message)
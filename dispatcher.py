@@ -0,0 +1,212 @@
+import asyncio
+import logging
+from collections import deque
+import discord
+from ratelimit import TokenBucket
+from metrics import REGISTRY
+
+# 優先順序：互動回覆優先於大量發送的工作
+INTERACTIVE = 0
+BULK = 1
+
+OUTBOUND_SENT = REGISTRY.counter('discord_outbound_messages_total', '經由發送排程器送出的訊息數量')
+OUTBOUND_RATE_LIMITED = REGISTRY.counter('discord_outbound_rate_limited_total', '發送時收到 429 的次數')
+
+
+class _Job:
+    def __init__(self, content, kwargs, pack: bool):
+        self.content = content
+        self.kwargs = kwargs
+        self.pack = pack
+        self.future = asyncio.get_running_loop().create_future()
+
+
+class _Lane:
+    """單一頻道的發送佇列，依優先順序分成多條"""
+    def __init__(self, channel, rate: float, burst: int):
+        self.channel = channel
+        self.bucket = TokenBucket(rate, capacity=burst)
+        self.queues = (deque(), deque())
+        self.ready = asyncio.Event()
+        self.task = None
+
+    def pending(self) -> int:
+        return sum(len(q) for q in self.queues)
+
+    def pop(self, max_chars: int):
+        """取出下一批要發送的工作；可合併的大量訊息會盡量併成一則"""
+        queue = self.queues[INTERACTIVE] or self.queues[BULK]
+        jobs = [queue.popleft()]
+        if jobs[0].pack:
+            length = len(jobs[0].content)
+            while queue and queue[0].pack and length + 1 + len(queue[0].content) <= max_chars:
+                length += 1 + len(queue[0].content)
+                jobs.append(queue.popleft())
+        return jobs
+
+
+class OutboundDispatcher:
+    """集中式的訊息發送排程器
+
+    每個頻道一條發送佇列與一個權杖桶（Discord 對每個頻道的發送頻率有限制），
+    另有一個全域權杖桶限制整體請求數，並保留一部分額度給互動回覆，讓大量發送的工作
+    不會擠掉一般回覆。每次發送後會讀取 discord.py 依回應標頭記錄的限制，與本地的
+    權杖桶同步；收到 429 時依 retry_after 暫停該頻道後重試。
+    """
+    def __init__(self, http=None, channel_rate: float = 1.0, channel_burst: int = 5, global_rate: float = 45,
+                 interactive_reserve: int = 5, max_pack_chars: int = 2000, idle_timeout: float = 60,
+                 max_retries: int = 3):
+        self.http = http
+        self.channel_rate = channel_rate
+        self.channel_burst = channel_burst
+        self.global_bucket = TokenBucket(global_rate, capacity=global_rate)
+        self.interactive_reserve = min(interactive_reserve, max(0, int(global_rate) - 1))
+        self.max_pack_chars = max_pack_chars
+        self.idle_timeout = idle_timeout
+        self.max_retries = max_retries
+        self.lanes = {}
+        self.closing = False
+
+    def pending(self) -> int:
+        return sum(lane.pending() for lane in self.lanes.values())
+
+    async def send(self, channel, content: str = None, priority: int = INTERACTIVE, pack: bool = False, **kwargs):
+        """排入發送佇列並等待送出，回傳 discord.Message
+
+        pack 為 True 時，同一頻道中連續的可合併訊息會以換行併成一則發送（只適用於純文字訊息）。
+        """
+        job = _Job(content or '', kwargs, pack and not kwargs)
+        lane = self.lanes.get(channel.id)
+        if lane is None:
+            lane = self.lanes[channel.id] = _Lane(channel, self.channel_rate, self.channel_burst)
+        lane.queues[priority].append(job)
+        lane.ready.set()
+        if lane.task is None or lane.task.done():
+            lane.task = asyncio.create_task(self._run(channel.id, lane))
+        return await job.future
+
+    async def _acquire_global(self, priority: int):
+        if priority == INTERACTIVE:
+            await self.global_bucket.acquire()
+            return
+        # 大量發送的工作只使用保留額度以外的權杖
+        while True:
+            wait = self.global_bucket.delay(1 + self.interactive_reserve)
+            if wait <= 0:
+                self.global_bucket.consume(1)
+                return
+            await asyncio.sleep(wait)
+
+    def _sync_limits(self, lane: _Lane):
+        """讀取 discord.py 由 X-RateLimit-* 標頭記錄的頻道限制，同步到本地權杖桶
+
+        依賴 HTTPClient 的私有屬性 _bucket_hashes 與 _buckets 以及 Ratelimit 的 limit、remaining、
+        reset_after（依 discord.py 2.7.1 確認）。這些屬性不存在或型別不符時記錄一次警告並停用同步，
+        之後只使用本地權杖桶的設定。
+        """
+        if self.http is None:
+            return
+        try:
+            route = discord.http.Route('POST', '/channels/{channel_id}/messages', channel_id=lane.channel.id)
+            bucket_hash = self.http._bucket_hashes.get(route.key)
+            if bucket_hash is None:
+                return
+            limit = self.http._buckets.get(f'{bucket_hash}:{route.major_parameters}')
+            if limit is None:
+                return
+            capacity, remaining, reset_after = int(limit.limit), int(limit.remaining), float(limit.reset_after or 0)
+        except (AttributeError, TypeError, ValueError) as e:
+            logging.warning(f'無法讀取 discord.py 的速率限制狀態（可能是版本變更），改用本地設定：{e}')
+            self.http = None
+            return
+        if capacity <= 1:
+            return
+        lane.bucket.capacity = capacity
+        if remaining == 0 and reset_after:
+            lane.bucket.penalize(reset_after)
+        else:
+            lane.bucket.tokens = min(lane.bucket.tokens, remaining)
+
+    async def _run(self, channel_id, lane: _Lane):
+        try:
+            while True:
+                if not lane.pending():
+                    if self.closing:
+                        return
+                    lane.ready.clear()
+                    try:
+                        await asyncio.wait_for(lane.ready.wait(), self.idle_timeout)
+                    except asyncio.TimeoutError:
+                        if not lane.pending():
+                            return
+                    continue
+
+                # 先取得頻道權杖再挑選工作，等待期間新排入的互動回覆仍可插隊
+                await lane.bucket.acquire()
+                priority = INTERACTIVE if lane.queues[INTERACTIVE] else BULK
+                jobs = lane.pop(self.max_pack_chars)
+                await self._deliver(lane, jobs, priority)
+        finally:
+            if self.lanes.get(channel_id) is lane and not lane.pending():
+                del self.lanes[channel_id]
+
+    async def _deliver(self, lane: _Lane, jobs, priority: int):
+        content = '\n'.join(job.content for job in jobs)
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                await lane.bucket.acquire()
+            await self._acquire_global(priority)
+            try:
+                message = await lane.channel.send(content or None, **jobs[0].kwargs)
+            except discord.HTTPException as e:
+                if e.status == 429 and attempt < self.max_retries:
+                    retry_after = getattr(e, 'retry_after', None) or 1.0
+                    OUTBOUND_RATE_LIMITED.inc()
+                    logging.warning(f'發送到 {lane.channel.id} 時遇到速率限制，{retry_after:.1f} 秒後重試')
+                    lane.bucket.penalize(retry_after)
+                    continue
+                self._finish(jobs, error=e)
+                return
+            except discord.RateLimited as e:
+                # 等待時間超過 discord.py 的上限時會直接拋出，交給本地權杖桶等待
+                OUTBOUND_RATE_LIMITED.inc()
+                lane.bucket.penalize(e.retry_after)
+                if attempt < self.max_retries:
+                    continue
+                self._finish(jobs, error=e)
+                return
+            except Exception as e:
+                self._finish(jobs, error=e)
+                return
+            OUTBOUND_SENT.inc(priority='interactive' if priority == INTERACTIVE else 'bulk')
+            self._sync_limits(lane)
+            self._finish(jobs, message=message)
+            return
+
+    @staticmethod
+    def _finish(jobs, message=None, error=None):
+        for job in jobs:
+            if job.future.done():
+                continue
+            if error is not None:
+                job.future.set_exception(error)
+            else:
+                job.future.set_result(message)
+
+    async def close(self, timeout: float = 10):
+        """等待已排入的訊息送出（最多 timeout 秒），再停止所有頻道的發送工作"""
+        self.closing = True
+        tasks = [lane.task for lane in self.lanes.values() if lane.task]
+        for lane in self.lanes.values():
+            lane.ready.set()
+        if tasks:
+            _, pending = await asyncio.wait(tasks, timeout=timeout)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        for lane in list(self.lanes.values()):
+            for queue in lane.queues:
+                for job in queue:
+                    if not job.future.done():
+                        job.future.cancel()
+        self.lanes.clear()
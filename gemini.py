@@ -1,22 +1,37 @@
 import google.generativeai as genai
-from google.api_core.exceptions import ResourceExhausted
+from google.ai import generativelanguage as glm
+from google.ai.generativelanguage_v1beta.services.generative_service.transports.grpc_asyncio import (
+    GenerativeServiceGrpcAsyncIOTransport
+)
+from google.ai.generativelanguage_v1beta.services.cache_service.transports.grpc_asyncio import (
+    CacheServiceGrpcAsyncIOTransport
+)
+from google.api_core.exceptions import (
+    ResourceExhausted, NotFound, PermissionDenied, FailedPrecondition, InvalidArgument
+)
+from google.protobuf import field_mask_pb2
+import grpc
+import json
+import hashlib
+import datetime
 import logging
 import os
-from rich.logging import RichHandler
+import asyncio
 from dotenv import load_dotenv
 import atexit
+from session import SessionManager
+from context import ContextCompactor, build_summary_request
+from token_counter import TokenEstimator
+from backend import ConversationBackend
+from ratelimit import TokenBucket
+from metrics import LLM_TOKENS, GEMINI_KEY_ROTATIONS, GEMINI_CACHE_EVENTS
+from resilience import Resilience, RetryPolicy, EmptyResponse, remaining_time
+import time
 
 # 設置環境變數以抑制 gRPC 警告
 os.environ['GRPC_PYTHON_LOG_LEVEL'] = '0'
 os.environ['GRPC_VERBOSITY'] = 'ERROR'
 
-# 配置 logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[RichHandler()]
-)
-
 # 載入環境變數
 load_dotenv()
 API_KEYS = [
@@ -25,12 +40,9 @@ API_KEYS = [
     os.getenv('GEMINI_API_KEY_3')
 ]
 
-# 過濾掉無效的 API keys
+# 過濾掉無效的 API keys，沒有任何 Key 時由 GeminiKeyPool 在建立後端時拋出錯誤
 API_KEYS = [key for key in API_KEYS if key is not None]
 
-if not API_KEYS:
-    raise ValueError("沒有找到有效的 Gemini API Keys，請檢查環境變數設置")
-
 def cleanup_genai():
     """清理 Gemini AI 的全局資源"""
     try:
@@ -44,10 +56,366 @@ def cleanup_genai():
 # 註冊程序退出時的清理函數
 atexit.register(cleanup_genai)
 
-class gemini_ai:
-    def __init__(self, prompt: str = "使用繁體中文進行回覆", temperature: float = 1, top_p: float = 0.95, top_k: float = 40, max_output_tokens: int = 8192, response_mime_type: str = "text/plain", model_name: str = 'gemini-1.5-flash'):
-        self.current_api_key_index = 0
-        self._initialize_with_current_key()
+# 使用快取的請求遇到這些錯誤時，視為快取已失效，改以完整內容重送
+CACHE_ERRORS = (NotFound, PermissionDenied, FailedPrecondition, InvalidArgument)
+
+def bind_client(model: genai.GenerativeModel, client: glm.GenerativeServiceAsyncClient):
+    """讓 GenerativeModel 改用指定的非同步客戶端
+
+    SDK 只提供全域的 genai.configure，沒有公開的方式為單一模型指定客戶端；這是唯一依賴
+    SDK 私有屬性的地方（依 google-generativeai 0.8.6 確認），升級 SDK 時只需檢查這裡。
+    """
+    model._async_client = client
+    return model
+
+
+def cache_request(model_name: str, system: str, contents, ttl: float) -> glm.CreateCachedContentRequest:
+    """以 generativelanguage 的型別建立 CreateCachedContentRequest，contents 為 {'role', 'parts'} 格式"""
+    cached = glm.CachedContent(
+        model=model_name if '/' in model_name else f'models/{model_name}',
+        system_instruction=glm.Content(parts=[glm.Part(text=system)]) if system else None,
+        contents=[glm.Content(role=entry['role'], parts=[glm.Part(text=part) for part in entry['parts']])
+                  for entry in contents],
+        ttl=datetime.timedelta(seconds=ttl),
+    )
+    return glm.CreateCachedContentRequest(cached_content=cached)
+
+
+class ApiKeySlot:
+    """單一 API Key 的狀態：獨立的連線、RPM 與 TPM 限制器以及冷卻時間"""
+    def __init__(self, index: int, key: str, rpm: int, tpm: int, endpoint: str = None):
+        self.index = index
+        self.key = key
+        self.endpoint = endpoint
+        self.rpm = TokenBucket(rpm / 60, capacity=rpm)
+        self.tpm = TokenBucket(tpm / 60, capacity=tpm)
+        self.cooldown_until = 0.0
+        self.in_flight = 0
+        self.served = 0
+        self._client = None
+        self._cache_client = None
+        self._channel = None
+
+    def _local_channel(self):
+        """endpoint 為本機模擬伺服器時使用不加密的連線"""
+        if self._channel is None:
+            self._channel = grpc.aio.insecure_channel(self.endpoint)
+        return self._channel
+
+    def client(self):
+        """建立只屬於這把 Key 的非同步客戶端，不經過全域的 genai.configure"""
+        if self._client is None:
+            if self.endpoint:
+                transport = GenerativeServiceGrpcAsyncIOTransport(channel=self._local_channel())
+                self._client = glm.GenerativeServiceAsyncClient(transport=transport)
+            else:
+                self._client = glm.GenerativeServiceAsyncClient(client_options={'api_key': self.key})
+        return self._client
+
+    def cache_client(self):
+        """這把 Key 的 CacheService 客戶端；快取只能由建立它的 Key（專案）使用"""
+        if self._cache_client is None:
+            if self.endpoint:
+                transport = CacheServiceGrpcAsyncIOTransport(channel=self._local_channel())
+                self._cache_client = glm.CacheServiceAsyncClient(transport=transport)
+            else:
+                self._cache_client = glm.CacheServiceAsyncClient(client_options={'api_key': self.key})
+        return self._cache_client
+
+    def wait_time(self, tokens: int, now: float) -> float:
+        """距離這把 Key 可以處理一個 tokens 大小的請求還需等待的秒數"""
+        if self.cooldown_until > now:
+            return self.cooldown_until - now
+        return max(self.rpm.delay(1), self.tpm.delay(min(tokens, self.tpm.capacity)))
+
+
+class GeminiKeyPool:
+    """Gemini API Key 池
+
+    同時使用所有可用的 Key，每次挑選目前可用且負載最低的一把；配額用盡的 Key 只會在自己的
+    冷卻時間內被略過，不影響其他正在進行中的請求。
+    """
+    def __init__(self, keys, rpm_per_key: int = 15, tpm_per_key: int = 1_000_000, cooldown: float = 60,
+                 endpoint: str = None):
+        if not keys:
+            raise ValueError("沒有找到有效的 Gemini API Keys，請檢查環境變數設置")
+        self.slots = [ApiKeySlot(i, key, rpm_per_key, tpm_per_key, endpoint) for i, key in enumerate(keys)]
+        self.cooldown = cooldown
+
+    async def acquire(self, tokens: int) -> ApiKeySlot:
+        """等待直到有 Key 可以處理預估 tokens 大小的請求，並預先扣除額度
+
+        在 Resilience 之內呼叫時，需要等待的時間超過請求剩餘的時限就直接拋出 ResourceExhausted，
+        以配額錯誤而不是逾時結束，避免所有 Key 都在冷卻時被當成服務中斷而開啟斷路器。
+        """
+        while True:
+            now = time.monotonic()
+            best = None
+            wait = None
+            for slot in self.slots:
+                slot_wait = slot.wait_time(tokens, now)
+                if slot_wait <= 0 and (best is None or (slot.in_flight, slot.served) < (best.in_flight, best.served)):
+                    best = slot
+                wait = slot_wait if wait is None else min(wait, slot_wait)
+
+            if best is not None:
+                best.rpm.consume(1)
+                best.tpm.consume(tokens)
+                best.in_flight += 1
+                best.served += 1
+                return best
+
+            remaining = remaining_time()
+            if remaining is not None and wait >= remaining:
+                raise ResourceExhausted(f"所有 API Key 在 {remaining:.1f} 秒內都無法使用（需等待 {wait:.1f} 秒）")
+            logging.debug(f"所有 API Key 皆已達速率上限，等待 {wait:.2f} 秒")
+            await asyncio.sleep(wait)
+
+    def release(self, slot: ApiKeySlot, reserved: int, used: int = None):
+        """請求結束後歸還 Key，並以實際用量修正預扣的 TPM 額度"""
+        slot.in_flight -= 1
+        if used is not None:
+            slot.tpm.consume(used - reserved)
+
+    def mark_exhausted(self, slot: ApiKeySlot):
+        """配額用盡的 Key 進入冷卻，期間改用其他 Key"""
+        GEMINI_KEY_ROTATIONS.inc()
+        slot.cooldown_until = time.monotonic() + self.cooldown
+        logging.warning(f"API Key {slot.index + 1} 配額已用完，冷卻 {self.cooldown} 秒")
+
+    def healthy(self) -> int:
+        now = time.monotonic()
+        return sum(1 for slot in self.slots if slot.cooldown_until <= now)
+
+
+class CacheHandle:
+    """一份已在伺服器端建立的 context cache"""
+    def __init__(self, slot: ApiKeySlot, key, name: str, length: int, tokens: int, expire_at: float, model):
+        self.slot = slot
+        self.key = key            # (key 編號, 內容雜湊)
+        self.name = name
+        self.length = length      # 快取涵蓋的 contents 筆數
+        self.tokens = tokens
+        self.expire_at = expire_at
+        self.model = model        # 以此快取為前綴的 GenerativeModel
+        self.refs = 0
+        self.last_used = time.monotonic()
+        self.refreshing = False
+
+
+class ContextCacheManager:
+    """Gemini context cache 管理器
+
+    把固定的角色設定（system_instruction）以及對話中較舊、不再變動的歷史建立成伺服器端快取，
+    之後的請求只送出快取之後的內容。快取依 API Key 分開並以內容雜湊辨識；建立與延長 TTL 都在
+    背景進行，請求本身從不等待快取。
+
+    伺服器只接受至少 min_tokens 的快取，min_tokens 應設為所用模型的下限。prompt/ 中的角色設定
+    約 500–1300 tokens，在預設的 4096 下無法單獨快取（記在 too_small，不再嘗試）；這時快取的是
+    「角色加上較舊的歷史」這個前綴，只要總長度達到下限就建立，之後每累積 history_step 的新歷史
+    才重建。只有角色設定本身達到下限時，同一個角色才會在所有對話之間共用一份快取。
+
+    refs 為正在使用快取的請求數加上綁定在快取上的對話數；歸零並閒置超過 idle_timeout 的快取會被刪除，
+    仍在使用且即將到期的快取則延長 TTL。建立失敗時，該內容在 retry_after 秒內不再嘗試，
+    請求照常以完整內容送出。
+    """
+    def __init__(self, model_name: str, generation_config=None, ttl: float = 900, refresh_margin: float = 180,
+                 min_tokens: int = 4096, history_step: int = 2048, rebuild_interval: float = 300,
+                 idle_timeout: float = 600, retry_after: float = 600, estimator: TokenEstimator = None):
+        self.model_name = model_name
+        self.estimator = estimator if estimator is not None else TokenEstimator()
+        self.generation_config = generation_config
+        self.ttl = ttl
+        self.refresh_margin = refresh_margin
+        self.min_tokens = min_tokens
+        self.history_step = history_step
+        self.rebuild_interval = rebuild_interval
+        self.idle_timeout = idle_timeout
+        self.retry_after = retry_after
+        self.handles = {}    # (key 編號, 內容雜湊) -> CacheHandle
+        self.pending = set()  # 建立中的 (key 編號, 內容雜湊)
+        self.failed = {}     # (key 編號, 內容雜湊) -> 可再次嘗試的時間
+        self.too_small = set()  # 低於 min_tokens 的角色設定 (key 編號, 內容雜湊)
+        self.bindings = {}   # (對話鍵值, key 編號) -> CacheHandle
+        self.rebuilt = {}    # (對話鍵值, key 編號) -> 上次排程建立歷史快取的時間
+        self._tasks = set()
+        self._next_sweep = time.monotonic() + 60
+
+    def _digest(self, system: str, contents) -> str:
+        raw = json.dumps([self.model_name, system, contents], ensure_ascii=False, separators=(',', ':'))
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def _usable(self, handle: CacheHandle, now: float) -> bool:
+        # 保留一點緩衝，避免請求送到伺服器時快取剛好過期
+        return handle is not None and handle.expire_at - now > 5 and self.handles.get(handle.key) is handle
+
+    def lease(self, slot: ApiKeySlot, system: str, contents, session_key=None):
+        """挑選可以作為這次請求前綴的快取並增加參考計數，沒有可用的快取時回傳 None
+
+        同時視需要在背景建立角色或歷史的快取，供之後的請求使用。
+        """
+        now = time.monotonic()
+        if now >= self._next_sweep:
+            self._sweep(now)
+
+        base_key = (slot.index, self._digest(system, []))
+        binding = (session_key, slot.index)
+        handle = None
+        bound = self.bindings.get(binding) if session_key is not None else None
+        if self._usable(bound, now) and bound.length < len(contents) \
+                and bound.key[1] == self._digest(system, contents[:bound.length]):
+            handle = bound
+        elif self._usable(self.handles.get(base_key), now):
+            handle = self.handles[base_key]
+        elif base_key not in self.too_small:
+            self._schedule(slot, base_key, system, [], None)
+
+        # 把這次輸入以外的內容（角色加上歷史）建成一份歷史快取：還沒有任何快取時，只要總長度達到
+        # min_tokens 就建立；已有快取時，未快取的歷史累積超過 history_step 才重建
+        if session_key is not None and now - self.rebuilt.get(binding, 0) >= self.rebuild_interval:
+            covered = handle.length if handle else 0
+            uncached = self._count(contents[covered:-1])
+            if uncached >= self.history_step or (handle is None and uncached):
+                prefix = contents[:-1]
+                if self.estimator.count(system) + self._count(prefix) >= self.min_tokens:
+                    self.rebuilt[binding] = now
+                    self._schedule(slot, (slot.index, self._digest(system, prefix)), system, prefix, session_key)
+
+        if handle is None:
+            GEMINI_CACHE_EVENTS.inc(event='miss')
+            return None
+        GEMINI_CACHE_EVENTS.inc(event='hit')
+        handle.refs += 1
+        handle.last_used = now
+        if handle.expire_at - now < self.refresh_margin and not handle.refreshing:
+            handle.refreshing = True
+            self._spawn(self._refresh(handle))
+        return handle
+
+    def release(self, handle: CacheHandle):
+        if handle is not None:
+            handle.refs -= 1
+
+    def invalidate(self, handle: CacheHandle):
+        """快取已在伺服器端失效（過期或被刪除），不再使用"""
+        GEMINI_CACHE_EVENTS.inc(event='invalidated')
+        if self.handles.get(handle.key) is handle:
+            del self.handles[handle.key]
+        for binding, bound in list(self.bindings.items()):
+            if bound is handle:
+                del self.bindings[binding]
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _count(self, contents) -> int:
+        return sum(self.estimator.count(part) for entry in contents for part in entry['parts'])
+
+    def _schedule(self, slot: ApiKeySlot, key, system: str, prefix, session_key):
+        if key in self.handles or key in self.pending or self.failed.get(key, 0) > time.monotonic():
+            return
+        tokens = self.estimator.count(system) + self._count(prefix)
+        if tokens < self.min_tokens:
+            # 只有單獨的角色設定會走到這裡（歷史快取在排程前已檢查長度）；內容不會再變長，之後不再嘗試
+            self.too_small.add(key)
+            logging.info(f"角色設定約 {tokens} tokens，低於快取下限 {self.min_tokens}，"
+                         f"只有加上對話歷史達到下限後才會建立快取")
+            return
+        self.pending.add(key)
+        self._spawn(self._create(slot, key, system, prefix, session_key))
+
+    async def _create(self, slot: ApiKeySlot, key, system: str, prefix, session_key):
+        try:
+            request = cache_request(self.model_name, system, prefix, self.ttl)
+            cached = await slot.cache_client().create_cached_content(request=request)
+        except Exception as e:
+            GEMINI_CACHE_EVENTS.inc(event='error')
+            self.failed[key] = time.monotonic() + self.retry_after
+            logging.warning(f"建立 Gemini 快取失敗，{self.retry_after:.0f} 秒內改用完整內容：{e}")
+            return
+        finally:
+            self.pending.discard(key)
+
+        GEMINI_CACHE_EVENTS.inc(event='created')
+        # from_cached_content 只讀取 name 與 model，直接傳入回傳的 CachedContent，不另外呼叫 get
+        model = bind_client(
+            genai.GenerativeModel.from_cached_content(cached, generation_config=self.generation_config),
+            slot.client()
+        )
+        tokens = cached.usage_metadata.total_token_count
+        handle = CacheHandle(slot, key, cached.name, len(prefix), tokens, time.monotonic() + self.ttl, model)
+        self.handles[key] = handle
+        logging.info(f"已建立 Gemini 快取 {cached.name}（{tokens} tokens，{len(prefix)} 則內容）")
+
+        if session_key is not None:
+            binding = (session_key, slot.index)
+            old = self.bindings.get(binding)
+            self.bindings[binding] = handle
+            handle.refs += 1
+            if old is not None:
+                old.refs -= 1
+
+    async def _refresh(self, handle: CacheHandle):
+        try:
+            request = glm.UpdateCachedContentRequest(
+                cached_content=glm.CachedContent(name=handle.name, ttl=datetime.timedelta(seconds=self.ttl)),
+                update_mask=field_mask_pb2.FieldMask(paths=['ttl'])
+            )
+            await handle.slot.cache_client().update_cached_content(request=request)
+            handle.expire_at = time.monotonic() + self.ttl
+            GEMINI_CACHE_EVENTS.inc(event='refreshed')
+        except NotFound:
+            self.invalidate(handle)
+        except Exception as e:
+            logging.warning(f"延長 Gemini 快取 {handle.name} 的 TTL 失敗：{e}")
+        finally:
+            handle.refreshing = False
+
+    def _sweep(self, now: float):
+        """解除閒置對話的綁定，刪除沒有人使用的快取，並移除過期的記錄"""
+        self._next_sweep = now + 60
+        for binding, handle in list(self.bindings.items()):
+            if now - handle.last_used > self.idle_timeout or handle.expire_at <= now:
+                del self.bindings[binding]
+                handle.refs -= 1
+        for key, handle in list(self.handles.items()):
+            if handle.expire_at <= now:
+                del self.handles[key]
+            elif handle.refs <= 0 and now - handle.last_used > self.idle_timeout:
+                del self.handles[key]
+                self._spawn(self._delete(handle))
+        self.failed = {key: until for key, until in self.failed.items() if until > now}
+        self.rebuilt = {key: at for key, at in self.rebuilt.items() if now - at < self.rebuild_interval}
+
+    async def _delete(self, handle: CacheHandle):
+        try:
+            await handle.slot.cache_client().delete_cached_content(name=handle.name)
+            GEMINI_CACHE_EVENTS.inc(event='deleted')
+        except NotFound:
+            pass
+        except Exception as e:
+            logging.warning(f"刪除 Gemini 快取 {handle.name} 失敗：{e}")
+
+    async def close(self):
+        """刪除所有快取，避免在 TTL 到期前繼續計算儲存費用"""
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        handles = list(self.handles.values())
+        self.handles.clear()
+        self.bindings.clear()
+        await asyncio.gather(*(self._delete(handle) for handle in handles))
+
+
+class gemini_ai(ConversationBackend):
+    display_name = 'Gemini'
+
+    def __init__(self, prompt: str = "使用繁體中文進行回覆", temperature: float = 1, top_p: float = 0.95, top_k: float = 40, max_output_tokens: int = 8192, response_mime_type: str = "text/plain", model_name: str = 'gemini-1.5-flash', sessions: SessionManager = None, token_budget: int = 4000, keys=None, rpm_per_key: int = 15, tpm_per_key: int = 1_000_000, retry_policy: RetryPolicy = None, context_cache: bool = False, cache_min_tokens: int = 4096, endpoint: str = None):
+        self.pool = GeminiKeyPool(keys or API_KEYS, rpm_per_key=rpm_per_key, tpm_per_key=tpm_per_key, endpoint=endpoint)
+        # 可用的 Key 越多，配額錯誤時可以立即換 Key 重試的次數也越多
+        self.resilience = Resilience('gemini', retry_policy or RetryPolicy(max_attempts=3 + len(self.pool.slots)))
         
         self.generation_config = {
             "temperature": temperature,
@@ -57,30 +425,35 @@ class gemini_ai:
             "response_mime_type": response_mime_type,
         }
 
-        self.model = self._create_model(model_name, prompt)
-        self.history = []
-        self.chat_session = self.model.start_chat(history=self.history)
-        logging.info(f'已初始化 Gemini AI，使用模型：{model_name}')
-
-    def _initialize_with_current_key(self):
-        """初始化 Gemini API"""
-        try:
-            if self.current_api_key_index >= len(API_KEYS):
-                raise ValueError("所有 API Keys 都已用盡")
-            
-            current_key = API_KEYS[self.current_api_key_index]
-            if not current_key:
-                raise ValueError(f"API Key {self.current_api_key_index + 1} 無效")
-            
-            genai.configure(api_key=current_key)
-            logging.info(f'使用 API Key {self.current_api_key_index + 1}')
-        except Exception as e:
-            logging.error(f"初始化 Gemini API 時發生錯誤: {e}")
-            raise
+        self.model_name = model_name
+        self.prompt = prompt
+        # 每把 API Key 各自擁有模型實例，(key 編號, 用途, 角色) -> (角色版本, GenerativeModel)
+        self.models = {}
+        # token 估算倍率依後端分開校正，在 router 下兩家的 tokenizer 不會互相覆寫
+        self.estimator = TokenEstimator()
+        # 角色設定與較舊的歷史放在伺服器端快取（選用），模型需支援 context caching
+        self.caches = ContextCacheManager(
+            model_name, self.generation_config, min_tokens=cache_min_tokens, estimator=self.estimator
+        ) if context_cache else None
+        # 空的 SessionManager 也是 False，不能寫成 sessions or SessionManager()，否則共用的管理器會被換掉
+        self.sessions = sessions if sessions is not None else SessionManager()
+        self.compactor = ContextCompactor(self.summarize_async, token_budget=token_budget, estimate=self.estimator.count)
+        logging.info(f'已初始化 Gemini AI，使用模型：{model_name}，共 {len(self.pool.slots)} 把 API Key')
 
-    def _rotate_api_key(self):
-        self.current_api_key_index = (self.current_api_key_index + 1) % len(API_KEYS)
-        self._initialize_with_current_key()
+    def _model_for(self, slot, kind: str = 'chat', persona=None):
+        """取得綁定在指定 API Key 與角色上的模型，第一次使用或角色設定變更時才建立"""
+        name, version = (persona.name, persona.version) if persona else (None, 0)
+        cached = self.models.get((slot.index, kind, name))
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        if kind == 'chat':
+            model = self._create_model(self.model_name, persona.prompt if persona else self.prompt)
+        else:
+            # 摘要用的模型不帶角色設定，避免摘要被角色語氣影響
+            model = genai.GenerativeModel(model_name=self.model_name)
+        bind_client(model, slot.client())
+        self.models[(slot.index, kind, name)] = (version, model)
+        return model
 
     def _create_model(self, model_name, prompt):
         return genai.GenerativeModel(
@@ -89,99 +462,149 @@ class gemini_ai:
             system_instruction=prompt
         )
 
-    def get_history(self):
+    def _build_contents(self, session, text: str):
+        """將壓縮後的對話歷史轉換為 Gemini 的 contents 格式"""
+        summary, messages = self.compactor.view(session)
+        contents = []
+        if summary:
+            contents.append({'role': 'user', 'parts': [f"（先前對話摘要）\n{summary}"]})
+            contents.append({'role': 'model', 'parts': ["好的，我記得先前的對話內容。"]})
+        contents.extend(
+            {'role': 'model' if m['role'] == 'assistant' else 'user', 'parts': [m['content']]}
+            for m in messages
+        )
+        contents.append({'role': 'user', 'parts': [text]})
+        return contents
+
+    def _log_usage(self, text: str, reply: str, usage):
+        """記錄 token 用量，優先使用回應附帶的實際數字，並以此校正本地估算器"""
+        output_token_count = getattr(usage, 'candidates_token_count', 0) if usage else 0
+        cached_token_count = getattr(usage, 'cached_content_token_count', 0) if usage else 0
+        if output_token_count:
+            input_token_count = usage.prompt_token_count
+            self.estimator.calibrate(reply, output_token_count)
+        else:
+            input_token_count = self.estimator.count(text)
+            output_token_count = self.estimator.count(reply)
+        LLM_TOKENS.inc(input_token_count, provider='gemini', direction='input')
+        LLM_TOKENS.inc(output_token_count, provider='gemini', direction='output')
+        if cached_token_count:
+            LLM_TOKENS.inc(cached_token_count, provider='gemini', direction='cached')
+        logging.info(f"輸入 token 數量: {input_token_count}（快取 {cached_token_count}），回應 token 數量: {output_token_count}")
+        logging.info(f"本次對話總 token 數量: {input_token_count + output_token_count}")
+        return input_token_count + output_token_count
+
+    def _estimate_contents(self, contents) -> int:
+        """預估請求的輸入 token 數，用於向 Key 池預扣 TPM 額度"""
+        return sum(self.estimator.count(part) for entry in contents for part in entry['parts'])
+
+    def _lease(self, slot, contents, persona=None, session_key=None):
+        """取得可作為這次請求前綴的快取，未啟用快取時回傳 None"""
+        if self.caches is None:
+            return None
+        return self.caches.lease(slot, persona.prompt if persona else self.prompt, contents, session_key)
+
+    async def _send(self, slot, contents, kind: str = 'chat', persona=None, handle=None, **kwargs):
+        """送出請求；使用快取時只送出快取之後的內容，快取已失效時改以完整內容重送"""
+        if handle is not None:
+            try:
+                return await handle.model.generate_content_async(contents[handle.length:], **kwargs)
+            except CACHE_ERRORS as e:
+                logging.warning(f"Gemini 快取 {handle.name} 無法使用，改以完整內容重送：{e}")
+                self.caches.invalidate(handle)
+        return await self._model_for(slot, kind, persona).generate_content_async(contents, **kwargs)
+
+    async def _request(self, contents, kind: str = 'chat', text: str = None, persona=None, session_key=None):
+        """向 Key 池取得一把 Key 並送出單次請求，配額用盡時讓該 Key 冷卻後拋出例外"""
+        reserved = self._estimate_contents(contents) if isinstance(contents, list) else self.estimator.count(contents)
+        slot = await self.pool.acquire(reserved)
+        handle = self._lease(slot, contents, persona, session_key) if kind == 'chat' else None
+        used = None
+        try:
+            response = await self._send(slot, contents, kind, persona, handle)
+            if not response or not response.text:
+                raise EmptyResponse("收到空的回應")
+            usage = getattr(response, 'usage_metadata', None)
+            if text is None:
+                used = getattr(usage, 'total_token_count', None) or None
+            else:
+                used = self._log_usage(text, response.text, usage)
+            return response.text
+        except ResourceExhausted:
+            self.pool.mark_exhausted(slot)
+            raise
+        finally:
+            if handle is not None:
+                self.caches.release(handle)
+            self.pool.release(slot, reserved, used)
+
+    async def _request_stream(self, contents, text: str, persona=None, session_key=None):
+        """單次串流請求，逐段產生內容"""
+        reserved = self._estimate_contents(contents)
+        slot = await self.pool.acquire(reserved)
+        handle = self._lease(slot, contents, persona, session_key)
+        used = None
+        try:
+            response = await self._send(slot, contents, persona=persona, handle=handle, stream=True)
+            parts = []
+            async for chunk in response:
+                if chunk.text:
+                    parts.append(chunk.text)
+                    yield chunk.text
+            if not parts:
+                raise EmptyResponse("收到空的回應")
+            used = self._log_usage(text, ''.join(parts), getattr(response, 'usage_metadata', None))
+        except ResourceExhausted:
+            self.pool.mark_exhausted(slot)
+            raise
+        finally:
+            if handle is not None:
+                self.caches.release(handle)
+            self.pool.release(slot, reserved, used)
+
+    async def _generate(self, session, text: str, persona=None) -> str:
+        return await self._request(self._build_contents(session, text), text=text, persona=persona,
+                                   session_key=session.key)
+
+    async def _stream(self, session, text: str, persona=None):
+        async for chunk in self._request_stream(self._build_contents(session, text), text, persona, session.key):
+            yield chunk
+
+    async def summarize_async(self, previous_summary: str, messages):
+        """將較舊的對話濃縮成摘要，由 ContextCompactor 在背景呼叫"""
+        request = build_summary_request(previous_summary, messages)
+        reply = await self.resilience.call(lambda: self._request(request, 'summary'))
+        return reply.strip()
+
+    def get_history(self, session_key=None):
         """獲取歷史記錄並計算總 token 數量"""
+        session = self.sessions.get(session_key)
         total_tokens = 0
-        for entry in self.history:
-            if not entry or 'parts' not in entry or not entry['parts']:
-                logging.warning("發現無效的歷史記錄項目")
-                continue
-                
-            content = entry['parts'][0]
+        for entry in session.messages:
+            content = entry.get('content') if entry else None
             if not content:
                 logging.warning("發現空的歷史記錄內容")
                 continue
                 
             logging.info(f"歷史記錄: {content}")
-            try:
-                tokens = self.model.count_tokens(content).total_tokens
-                total_tokens += tokens
-            except Exception as e:
-                logging.error(f"計算 token 時發生錯誤: {e}")
+            total_tokens += self.estimator.count(content)
                 
         logging.info(f"歷史記錄總 token 數量: {total_tokens}")
         return total_tokens
 
-    def chat(self, text: str):
-        if not text or not isinstance(text, str):
-            logging.error("無效的輸入文本")
-            return "抱歉，我無法處理空白或無效的輸入。"
-            
-        max_retries = 9
-        retry_sets = 2  # 嘗試兩組，每組9次
-        retry_delay = 2  # 每次重試間隔2秒
-        set_delay = 5   # 每組重試間隔5秒
-        
-        for set_attempt in range(retry_sets):
-            for attempt in range(max_retries):
-                try:
-                    # 計算輸入文本的 token 數量
-                    input_token_count = self.model.count_tokens(text).total_tokens
-                    logging.info(f"輸入文本的 token 數量: {input_token_count}")
-                    
-                    response = self.chat_session.send_message(text)
-                    if not response or not response.text:
-                        raise ValueError("收到空的回應")
-                    
-                    # 計算回應文本的 token 數量
-                    output_token_count = self.model.count_tokens(response.text).total_tokens
-                    logging.info(f"回應文本的 token 數量: {output_token_count}")
-                    logging.info(f"本次對話總 token 數量: {input_token_count + output_token_count}")
-                    
-                    self.history.append(
-                        {
-                            'role':'user',
-                            'parts':[text],
-                        }                
-                    )
-                    self.history.append(
-                        {
-                            'role':'model',
-                            'parts':[response.text]
-                        }
-                    )
-                    return response.text
-                    
-                except ResourceExhausted as e:
-                    logging.error(f"API 配額已用完: {e}")
-                    self._rotate_api_key()
-                    
-                except Exception as e:
-                    current_attempt = set_attempt * max_retries + attempt + 1
-                    total_attempts = max_retries * retry_sets
-                    
-                    if current_attempt < total_attempts:
-                        logging.warning(f"嘗試 {current_attempt}/{total_attempts} 失敗: {e}")
-                        import time
-                        
-                        # 如果完成一組9次嘗試，等待5秒
-                        if attempt == max_retries - 1 and set_attempt < retry_sets - 1:
-                            logging.info(f"完成第 {set_attempt + 1} 組嘗試，等待 {set_delay} 秒後繼續...")
-                            time.sleep(set_delay)
-                        else:
-                            time.sleep(retry_delay)
-                        continue
-                    else:
-                        logging.error(f"在調用 Gemini API 時發生錯誤: {e}")
-                        return "抱歉，我現在遇到了一些技術問題，請稍後再試。"
-    
     def cleanup(self):
         """清理資源並關閉連接"""
         try:
-            if hasattr(self, 'chat_session'):
-                self.chat_session = None
-            if hasattr(self, 'model'):
-                self.model = None
+            if hasattr(self, 'sessions'):
+                self.sessions.clear()
+            if hasattr(self, 'models'):
+                self.models.clear()
+            if getattr(self, 'caches', None):
+                # 在背景刪除伺服器端的快取，呼叫端關閉前會保留一點時間
+                try:
+                    asyncio.get_running_loop().create_task(self.caches.close())
+                except RuntimeError:
+                    pass
             logging.info("已關閉 Gemini AI")
         except Exception as e:
             logging.error(f"清理 Gemini 資源時發生錯誤: {e}")
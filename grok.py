@@ -1,15 +1,14 @@
 import os
 import logging
-from openai import OpenAI
-from rich.logging import RichHandler
+import asyncio
+from openai import AsyncOpenAI
 from dotenv import load_dotenv
-
-# 配置 logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[RichHandler()]
-)
+from session import SessionManager
+from context import ContextCompactor, build_summary_request
+from token_counter import TokenEstimator
+from metrics import LLM_TOKENS
+from resilience import Resilience, RetryPolicy, EmptyResponse
+from backend import ConversationBackend
 
 # 設定 OpenAI 的日誌層級為 WARNING，以隱藏 HTTP 請求訊息
 logging.getLogger("openai").setLevel(logging.WARNING)
@@ -19,63 +18,110 @@ logging.getLogger("httpx").setLevel(logging.WARNING)
 load_dotenv()
 xai_api_key = os.getenv('XAI_API_KEY')
 
-if not xai_api_key:
-    raise ValueError("未找到 XAI_API_KEY 環境變數")
-
-class Grok:
-    def __init__(self, prompt: str = '使用繁體中文進行回覆'):
-        self.client = OpenAI(
-            api_key=xai_api_key,
-            base_url='https://api.x.ai/v1'
+class Grok(ConversationBackend):
+    display_name = 'Grok'
+
+    def __init__(self, prompt: str = '使用繁體中文進行回覆', sessions: SessionManager = None, token_budget: int = 4000,
+                 base_url: str = 'https://api.x.ai/v1', api_key: str = None, retry_policy: RetryPolicy = None):
+        api_key = api_key or xai_api_key
+        if not api_key:
+            raise ValueError("未找到 XAI_API_KEY 環境變數")
+        # 重試由 Resilience 統一處理，關閉 SDK 內建的重試以免次數相乘
+        self.client = AsyncOpenAI(
+            api_key=api_key,
+            base_url=base_url,
+            max_retries=0
         )
-
-        self.messages = [
-            {"role": "system", "content": prompt}
-        ]
-
-    def chat(self, text: str):
-        if not text or not isinstance(text, str):
-            logging.error("無效的輸入文本")
-            return "抱歉，我無法處理空白或無效的輸入。"
-            
-        max_retries = 3
-        retry_delay = 2  # 每次重試間隔2秒
-        
-        for attempt in range(max_retries):
-            try:
-                self.messages.append(
-                    {"role": "user", "content": text}
-                )
-
-                response = self.client.chat.completions.create(
-                    model='grok-beta',
-                    messages=self.messages,
-                )
-
-                if not response or not response.choices or not response.choices[0].message:
-                    raise ValueError("收到無效的回應")
-                    
-                content = response.choices[0].message.content
-                if not content:
-                    raise ValueError("收到空的回應內容")
-
-                self.messages.append(
-                    {"role": "assistant", "content": content}
-                )
-                return content
-
-            except Exception as e:
-                logging.error(f"Grok API 呼叫失敗 (嘗試 {attempt + 1}/{max_retries}): {e}")
-                if attempt < max_retries - 1:
-                    import time
-                    time.sleep(retry_delay)
-                    continue
-                return f"抱歉，我遇到了技術問題：{str(e)}"
-    
-    def get_history(self):
+        self.resilience = Resilience('grok', retry_policy)
+
+        self.system_message = {"role": "system", "content": prompt}
+        # 角色名稱 -> (角色版本, 系統訊息)
+        self.persona_messages = {}
+        # 空的 SessionManager 也是 False，不能寫成 sessions or SessionManager()，否則共用的管理器會被換掉
+        self.sessions = sessions if sessions is not None else SessionManager()
+        # token 估算倍率依後端分開校正，在 router 下兩家的 tokenizer 不會互相覆寫
+        self.estimator = TokenEstimator()
+        self.compactor = ContextCompactor(self.summarize_async, token_budget=token_budget, estimate=self.estimator.count)
+
+    def _system_message_for(self, persona=None):
+        """取得角色的系統訊息，角色設定變更時才重新建立"""
+        if persona is None:
+            return self.system_message
+        cached = self.persona_messages.get(persona.name)
+        if cached is None or cached[0] != persona.version:
+            cached = self.persona_messages[persona.name] = (persona.version, {"role": "system", "content": persona.prompt})
+        return cached[1]
+
+    def _build_messages(self, session, text: str, persona=None):
+        """組合系統提示、壓縮後的對話歷史與本次輸入"""
+        summary, messages = self.compactor.view(session)
+        payload = [self._system_message_for(persona)]
+        if summary:
+            payload.append({"role": "system", "content": f"先前對話摘要：\n{summary}"})
+        payload.extend(messages)
+        payload.append({"role": "user", "content": text})
+        return payload
+
+    async def _complete(self, messages):
+        """送出單次請求，回傳 (回覆內容, usage)"""
+        response = await self.client.chat.completions.create(
+            model='grok-beta',
+            messages=messages,
+        )
+        if not response or not response.choices or not response.choices[0].message:
+            raise EmptyResponse("收到無效的回應")
+        content = response.choices[0].message.content
+        if not content:
+            raise EmptyResponse("收到空的回應內容")
+        return content, getattr(response, 'usage', None)
+
+    async def _generate(self, session, text: str, persona=None) -> str:
+        content, usage = await self._complete(self._build_messages(session, text, persona))
+        self._log_usage(content, usage)
+        return content
+
+    async def _stream(self, session, text: str, persona=None):
+        """單次串流請求，逐段產生內容，最後以 usage 記錄用量"""
+        stream = await self.client.chat.completions.create(
+            model='grok-beta',
+            messages=self._build_messages(session, text, persona),
+            stream=True,
+            stream_options={"include_usage": True},
+        )
+        parts = []
+        usage = None
+        async for chunk in stream:
+            if chunk.usage:
+                usage = chunk.usage
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                parts.append(delta)
+                yield delta
+        if not parts:
+            raise EmptyResponse("收到空的回應內容")
+        self._log_usage(''.join(parts), usage)
+
+    async def summarize_async(self, previous_summary: str, messages):
+        """將較舊的對話濃縮成摘要，由 ContextCompactor 在背景呼叫"""
+        content, _ = await self.resilience.call(lambda: self._complete(
+            [{"role": "user", "content": build_summary_request(previous_summary, messages)}]
+        ))
+        return content.strip()
+
+    def _log_usage(self, content: str, usage):
+        """記錄伺服器回報的 token 用量，並以此校正本地估算器"""
+        if usage and usage.completion_tokens:
+            LLM_TOKENS.inc(usage.prompt_tokens, provider='grok', direction='input')
+            LLM_TOKENS.inc(usage.completion_tokens, provider='grok', direction='output')
+            self.estimator.calibrate(content, usage.completion_tokens)
+            logging.info(f"輸入 token 數量: {usage.prompt_tokens}，回應 token 數量: {usage.completion_tokens}")
+
+    def get_history(self, session_key=None):
         """獲取歷史記錄"""
         valid_messages = []
-        for message in self.messages:
+        for message in [self.system_message, *self.sessions.get(session_key).messages]:
             if not message or 'role' not in message or 'content' not in message:
                 logging.warning("發現無效的歷史記錄項目")
                 continue
@@ -88,33 +134,36 @@ class Grok:
     def cleanup(self):
         """清理資源"""
         try:
-            self.messages.clear()
+            self.sessions.clear()
             if hasattr(self, 'client'):
                 self.client = None
             logging.info("已關閉 Grok AI")
         except Exception as e:
             logging.error(f"清理資源時發生錯誤: {e}")
 
-if __name__ == '__main__':
-    try:
-        grok = Grok()
+async def main():
+    grok = Grok()
+
+    while True:
+        text = input("你:")
 
-        while True:
-            text = input("你:")
+        if text == 'exit':
+            break
 
-            if text == 'exit':
-                break
+        response = await grok.chat_async(text)
+        if response:
+            print(f"Grok 回應: {response}")
 
-            response = grok.chat(text)
-            if response:
-                print(f"Grok 回應: {response}")
+    history = grok.get_history()
 
-        history = grok.get_history()
+    print("--" * 30)
+    print("歷史記錄:")
+    for message in history:
+        print(f"{message['role']}:\n{message['content']}\n")
 
-        print("--" * 30)
-        print("歷史記錄:")
-        for message in history:
-            print(f"{message['role']}:\n{message['content']}\n")
+if __name__ == '__main__':
+    try:
+        asyncio.run(main())
 
     except Exception as e:
         logging.error(f"程式執行錯誤: {e}")
\ No newline at end of file
@@ -0,0 +1,112 @@
+import math
+import time
+import asyncio
+import logging
+from collections import deque
+import aiohttp
+
+GATEWAY_URL = 'https://discord.com/api/v10/gateway'
+
+# 延遲序列名稱與顯示名稱
+SERIES = {
+    'loop': '事件迴圈延遲',
+    'gateway': '網路延遲',
+    'rest': 'API 延遲',
+    'llm': 'AI 回應延遲',
+}
+
+
+class RollingWindow:
+    """保留最近 size 筆樣本的滾動視窗"""
+    def __init__(self, size: int = 300):
+        self.samples = deque(maxlen=size)
+
+    def add(self, value: float):
+        self.samples.append(value)
+
+    def percentile(self, p: float):
+        """以最近的樣本計算百分位數，沒有樣本時回傳 None"""
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        index = max(0, math.ceil(p / 100 * len(ordered)) - 1)
+        return ordered[index]
+
+    def __len__(self):
+        return len(self.samples)
+
+
+class LatencyMonitor:
+    """背景延遲取樣
+
+    持續量測事件迴圈延遲，並定期取樣 Gateway 心跳與 REST 往返時間（共用一個連線池），
+    AI 回應延遲則由實際請求記錄，不額外消耗 token。/ping 直接讀取滾動視窗的百分位數。
+    """
+    def __init__(self, bot, interval: float = 15, loop_interval: float = 0.5, window: int = 300):
+        self.bot = bot
+        self.interval = interval
+        self.loop_interval = loop_interval
+        self.series = {name: RollingWindow(window) for name in SERIES}
+        self.session = None
+        self._tasks = []
+
+    def record(self, name: str, latency_ms: float):
+        self.series[name].add(latency_ms)
+
+    def summary(self, name: str):
+        """回傳 {'p50', 'p95', 'p99', 'count'}"""
+        window = self.series[name]
+        return {
+            'p50': window.percentile(50),
+            'p95': window.percentile(95),
+            'p99': window.percentile(99),
+            'count': len(window),
+        }
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [
+                asyncio.create_task(self._run()),
+                asyncio.create_task(self._watch_loop()),
+            ]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self.session and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+    async def _run(self):
+        self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10))
+        while True:
+            try:
+                await self.sample()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.debug(f"延遲取樣失敗：{e}")
+            await asyncio.sleep(self.interval)
+
+    async def _watch_loop(self):
+        # 事件迴圈延遲：實際醒來的時間比預定的 sleep 晚了多少
+        while True:
+            before = time.perf_counter()
+            await asyncio.sleep(self.loop_interval)
+            lag = time.perf_counter() - before - self.loop_interval
+            self.record('loop', max(0.0, lag) * 1000)
+
+    async def sample(self):
+        """取樣一次 Gateway 與 REST 延遲"""
+        # Gateway 心跳延遲
+        heartbeat = self.bot.latency
+        if heartbeat is not None and math.isfinite(heartbeat):
+            self.record('gateway', heartbeat * 1000)
+
+        # REST 往返時間（重用連線，不含 TLS 握手）
+        before = time.perf_counter()
+        async with self.session.get(GATEWAY_URL) as resp:
+            await resp.read()
+        self.record('rest', (time.perf_counter() - before) * 1000)
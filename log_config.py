@@ -0,0 +1,131 @@
+import sys
+import json
+import queue
+import atexit
+import random
+import logging
+import logging.handlers
+from ratelimit import TokenBucket
+
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+
+class LogRule:
+    """單一事件的記錄規則：sample 為保留比例，rate / burst 為每秒最多輸出的筆數與突發量"""
+    def __init__(self, rate: float = None, burst: float = None, sample: float = 1.0):
+        self.sample = sample
+        self.bucket = TokenBucket(rate, capacity=burst or rate) if rate else None
+        self.suppressed = 0
+
+
+# 大量出現的記錄預設的規則，以 extra={'event': ...} 標記
+DEFAULT_RULES = {
+    'message_received': dict(rate=5, burst=20),
+    'reply': dict(rate=5, burst=20),
+}
+
+
+class SamplingFilter(logging.Filter):
+    """依事件抽樣或限制速率
+
+    只處理帶有 event 屬性的記錄，其他記錄直接放行；被略過的筆數會附在下一筆輸出的記錄上。
+    WARNING 以上的記錄一律保留。
+    """
+    def __init__(self, rules=None):
+        super().__init__()
+        rules = DEFAULT_RULES if rules is None else rules
+        self.rules = {event: LogRule(**options) for event, options in rules.items()}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        rule = self.rules.get(getattr(record, 'event', None))
+        if rule is None or record.levelno >= logging.WARNING:
+            return True
+        if (rule.sample < 1 and random.random() >= rule.sample) or (rule.bucket and not rule.bucket.try_acquire()):
+            rule.suppressed += 1
+            return False
+        if rule.suppressed:
+            record.suppressed = rule.suppressed
+            rule.suppressed = 0
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """每筆記錄輸出成一行精簡的 JSON"""
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for key in ('event', 'suppressed'):
+            value = getattr(record, key, None)
+            if value is not None:
+                payload[key] = value
+        if record.exc_info:
+            payload['exc'] = self.formatException(record.exc_info)
+        return json.dumps(payload, ensure_ascii=False, separators=(',', ':'))
+
+
+class TextFormatter(logging.Formatter):
+    """一般文字格式，被抽樣略過的筆數附在訊息後面"""
+    def format(self, record: logging.LogRecord) -> str:
+        text = super().format(record)
+        suppressed = getattr(record, 'suppressed', None)
+        return f'{text}（已略過 {suppressed} 筆同類記錄）' if suppressed else text
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """只把記錄放入佇列，格式化（含 % 參數代入與例外堆疊）留給背景執行緒
+
+    內建的 QueueHandler 為了讓記錄可以跨行程傳遞，會在呼叫端先格式化；這裡的佇列只在
+    同一個行程內使用，不需要這一步。
+    """
+    def prepare(self, record: logging.LogRecord):
+        return record
+
+
+_listener = None
+
+
+def setup_logging(level: int = logging.INFO, json_format: bool = False, rich: bool = False, rules=None):
+    """設定根 logger：記錄經由佇列交給背景執行緒輸出，事件迴圈只負責建立記錄
+
+    json_format 輸出精簡的 JSON；rich 使用 Rich 的彩色輸出（開發用，輸出成本較高）；
+    rules 為 {事件: {rate, burst, sample}}，None 時使用 DEFAULT_RULES。
+    """
+    global _listener
+    stop_logging()
+
+    if rich:
+        from rich.logging import RichHandler
+        output = RichHandler()
+        output.setFormatter(TextFormatter('%(message)s'))
+    else:
+        output = logging.StreamHandler(sys.stderr)
+        output.setFormatter(JsonFormatter() if json_format else TextFormatter(LOG_FORMAT))
+
+    records = queue.SimpleQueue()
+    handler = DeferredQueueHandler(records)
+    handler.addFilter(SamplingFilter(rules))
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(records, output, respect_handler_level=True)
+    _listener.start()
+    return _listener
+
+
+def stop_logging():
+    """輸出佇列中剩下的記錄並停止背景執行緒"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(stop_logging)
@@ -0,0 +1,188 @@
+import logging
+from aiohttp import web
+
+# 預設的延遲分桶（秒）
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _label_key(labels: dict):
+    return tuple(sorted(labels.items()))
+
+
+def _escape(value: str, quote: bool = True) -> str:
+    """依 Prometheus 文字格式跳脫：反斜線、換行，以及標籤值中的雙引號"""
+    value = value.replace('\\', '\\\\').replace('\n', '\\n')
+    return value.replace('"', '\\"') if quote else value
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    body = ','.join(f'{name}="{_escape(str(value))}"' for name, value in pairs)
+    return '{' + body + '}'
+
+
+class Counter:
+    """只增不減的計數器"""
+    kind = 'counter'
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self.values = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = _label_key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self.values.get(_label_key(labels), 0)
+
+    def collect(self):
+        for key, value in self.values.items():
+            yield f'{self.name}{_format_labels(key)} {value}'
+
+
+class Gauge:
+    """可增可減的量測值，也可以綁定一個在匯出時才呼叫的函式"""
+    kind = 'gauge'
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self.values = {}
+        self.functions = {}
+
+    def set(self, value: float, **labels):
+        self.values[_label_key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = _label_key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function, **labels):
+        self.functions[_label_key(labels)] = function
+
+    def collect(self):
+        for key, value in self.values.items():
+            yield f'{self.name}{_format_labels(key)} {value}'
+        for key, function in self.functions.items():
+            try:
+                yield f'{self.name}{_format_labels(key)} {function()}'
+            except Exception as e:
+                logging.debug(f"讀取指標 {self.name} 時發生錯誤：{e}")
+
+
+class Histogram:
+    """固定分桶的分佈統計"""
+    kind = 'histogram'
+
+    def __init__(self, name: str, description: str, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(sorted(buckets))
+        self.values = {}  # labels -> [各分桶計數..., 總和, 次數]
+
+    def observe(self, value: float, **labels):
+        key = _label_key(labels)
+        state = self.values.get(key)
+        if state is None:
+            state = self.values[key] = [0] * len(self.buckets) + [0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                state[i] += 1
+                break
+        state[-2] += value
+        state[-1] += 1
+
+    def collect(self):
+        for key, state in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, state):
+                cumulative += count
+                yield f'{self.name}_bucket{_format_labels(key, [("le", bound)])} {cumulative}'
+            yield f'{self.name}_bucket{_format_labels(key, [("le", "+Inf")])} {state[-1]}'
+            yield f'{self.name}_sum{_format_labels(key)} {state[-2]}'
+            yield f'{self.name}_count{_format_labels(key)} {state[-1]}'
+
+
+class Registry:
+    """指標註冊表，同名指標只會建立一次"""
+    def __init__(self):
+        self.metrics = {}
+
+    def _get(self, cls, name, description, **kwargs):
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = cls(name, description, **kwargs)
+        return metric
+
+    def counter(self, name: str, description: str) -> Counter:
+        return self._get(Counter, name, description)
+
+    def gauge(self, name: str, description: str) -> Gauge:
+        return self._get(Gauge, name, description)
+
+    def histogram(self, name: str, description: str, buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._get(Histogram, name, description, buckets=buckets)
+
+    def render(self) -> str:
+        """輸出 Prometheus 文字格式"""
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f'# HELP {metric.name} {_escape(metric.description, quote=False)}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.collect())
+        return '\n'.join(lines) + '\n'
+
+
+# 全域共用的註冊表
+REGISTRY = Registry()
+
+# 訊息處理
+MESSAGES_RECEIVED = REGISTRY.counter('discord_messages_received_total', '收到的訊息數量')
+MENTIONS_QUEUED = REGISTRY.counter('discord_mentions_queued_total', '放入佇列的提及訊息數量')
+QUEUE_DEPTH = REGISTRY.gauge('discord_message_queue_depth', '各分片佇列中等待處理的訊息數量')
+QUEUE_WAIT = REGISTRY.histogram('discord_message_queue_wait_seconds', '訊息在佇列中等待的時間')
+REPLIES = REGISTRY.counter('discord_replies_total', '送出的回覆數量')
+MENTION_BATCH_SIZE = REGISTRY.histogram('discord_mention_batch_size', '每次 AI 請求合併的提及訊息數量',
+                                        buckets=(1, 2, 3, 4, 6, 8, 12, 16))
+
+# LLM 呼叫
+LLM_LATENCY = REGISTRY.histogram('llm_request_duration_seconds', 'LLM 請求耗時')
+LLM_REQUESTS = REGISTRY.counter('llm_requests_total', 'LLM 請求數量')
+LLM_RETRIES = REGISTRY.counter('llm_retries_total', 'LLM 請求重試次數')
+LLM_TOKENS = REGISTRY.counter('llm_tokens_total', 'LLM 使用的 token 數量')
+GEMINI_KEY_ROTATIONS = REGISTRY.counter('gemini_api_key_rotations_total', 'Gemini API Key 輪替次數')
+LLM_HEDGES = REGISTRY.counter('llm_hedged_requests_total', '因主要後端延遲而送出的對沖請求數量')
+LLM_FAILOVERS = REGISTRY.counter('llm_failovers_total', '主要後端失敗或斷路器開啟而改用備援後端的次數')
+GEMINI_CACHE_EVENTS = REGISTRY.counter('gemini_context_cache_events_total', 'Gemini context cache 的命中、建立與失效次數')
+
+
+class MetricsServer:
+    """在本機提供 /metrics 的 HTTP 端點"""
+    def __init__(self, registry: Registry = REGISTRY, host: str = '127.0.0.1', port: int = 9108):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.runner = None
+
+    async def _handle(self, request):
+        return web.Response(text=self.registry.render(), content_type='text/plain', charset='utf-8')
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/metrics', self._handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+        logging.info(f'指標端點已啟動：http://{self.host}:{self.port}/metrics')
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
@@ -0,0 +1,279 @@
+"""本機 LLM API 模擬伺服器
+
+提供與 OpenAI 相容的 /v1/chat/completions（含串流），讓 Grok 後端可以在不連網、不花費 token 的情況下
+進行重播與壓力測試。延遲與回覆長度可以設定，或由流量記錄中的分佈抽樣。
+
+另有 Gemini 的 gRPC 模擬伺服器（GenerativeService 與 CacheService），用來測試 context caching。
+"""
+import re
+import json
+import math
+import time
+import random
+import asyncio
+import logging
+import datetime
+import grpc
+from aiohttp import web
+from google.ai import generativelanguage as glm
+from google.protobuf import empty_pb2
+
+_MESSAGE_TAG = re.compile(r'#bench-\d+')
+
+
+class MockLLMServer:
+    """OpenAI 相容的模擬伺服器"""
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, latency: float = 0.8, sigma: float = 0.4,
+                 reply_chars=(120,), error_rate: float = 0.0, chunk_chars: int = 20):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.sigma = sigma
+        self.reply_chars = list(reply_chars) or [120]
+        self.error_rate = error_rate
+        self.chunk_chars = chunk_chars
+        self.requests = 0
+        self.started = {}   # 追蹤編號 -> 收到請求的時間，供重播工具計算佇列等待
+        self.failed = set()  # 回傳錯誤的追蹤編號
+        self.runner = None
+
+    @property
+    def base_url(self) -> str:
+        return f'http://{self.host}:{self.port}/v1'
+
+    def _delay(self):
+        if self.sigma:
+            return random.lognormvariate(math.log(self.latency), self.sigma)
+        return self.latency
+
+    @property
+    def calls(self) -> int:
+        return self.requests
+
+    @staticmethod
+    def _tags(messages):
+        # 只看最後一則使用者訊息，歷史中的追蹤編號屬於先前的請求
+        last = next((m['content'] for m in reversed(messages) if m['role'] == 'user'), '')
+        return _MESSAGE_TAG.findall(last or '')
+
+    def _reply(self, tags) -> str:
+        # 回覆帶上追蹤編號，方便重播工具計算端對端延遲
+        return ' '.join(tags) + ' ' + '喵' * random.choice(self.reply_chars)
+
+    async def _handle_chat(self, request):
+        self.requests += 1
+        body = await request.json()
+        tags = self._tags(body.get('messages', []))
+        numbers = [int(tag.removeprefix('#bench-')) for tag in tags]
+        now = time.perf_counter()
+        for number in numbers:
+            self.started.setdefault(number, now)
+        if random.random() < self.error_rate:
+            self.failed.update(numbers)
+            await asyncio.sleep(self._delay() / 4)
+            return web.json_response({'error': {'message': 'mock overloaded'}}, status=503)
+        # 用戶端重試成功時不算錯誤
+        self.failed.difference_update(numbers)
+
+        reply = self._reply(tags)
+        usage = {
+            'prompt_tokens': sum(len(m.get('content') or '') for m in body.get('messages', [])),
+            'completion_tokens': len(reply),
+        }
+        usage['total_tokens'] = usage['prompt_tokens'] + usage['completion_tokens']
+        created = int(time.time())
+        model = body.get('model', 'mock')
+
+        if not body.get('stream'):
+            await asyncio.sleep(self._delay())
+            return web.json_response({
+                'id': f'mock-{self.requests}', 'object': 'chat.completion', 'created': created, 'model': model,
+                'choices': [{'index': 0, 'finish_reason': 'stop',
+                             'message': {'role': 'assistant', 'content': reply}}],
+                'usage': usage,
+            })
+
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+        chunks = [reply[i:i + self.chunk_chars] for i in range(0, len(reply), self.chunk_chars)]
+        delay = self._delay()
+        for i, chunk in enumerate(chunks):
+            await asyncio.sleep(delay / len(chunks))
+            data = {
+                'id': f'mock-{self.requests}', 'object': 'chat.completion.chunk', 'created': created, 'model': model,
+                'choices': [{'index': 0, 'delta': {'content': chunk},
+                             'finish_reason': 'stop' if i == len(chunks) - 1 else None}],
+            }
+            await response.write(f'data: {json.dumps(data, ensure_ascii=False)}\n\n'.encode())
+        usage_chunk = {'id': f'mock-{self.requests}', 'object': 'chat.completion.chunk', 'created': created,
+                       'model': model, 'choices': [], 'usage': usage}
+        await response.write(f'data: {json.dumps(usage_chunk)}\n\n'.encode())
+        await response.write(b'data: [DONE]\n\n')
+        await response.write_eof()
+        return response
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post('/v1/chat/completions', self._handle_chat)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+        # port 為 0 時由系統指派
+        self.port = site._server.sockets[0].getsockname()[1]
+        logging.info(f'模擬 LLM 伺服器已啟動：{self.base_url}')
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
+
+
+_GEMINI_SERVICE = 'google.ai.generativelanguage.v1beta.GenerativeService'
+_CACHE_SERVICE = 'google.ai.generativelanguage.v1beta.CacheService'
+
+
+def _count(contents) -> int:
+    """模擬伺服器以字元數當作 token 數"""
+    return sum(len(part.text) for content in contents for part in content.parts)
+
+
+class MockGeminiServer:
+    """Gemini gRPC 模擬伺服器
+
+    首個 chunk 的延遲為 latency 加上未快取的輸入長度除以 prefill_rate，藉此觀察 context caching
+    對首字延遲的影響；billed_input 只累計未快取的輸入 token。快取有最小長度與 TTL 限制，
+    過期或被刪除的快取在 generate 時回傳 NOT_FOUND，與正式 API 相同。
+    """
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, latency: float = 0.2, prefill_rate: float = 20000,
+                 reply_chars: int = 120, chunk_chars: int = 20, min_cache_tokens: int = 4096):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.prefill_rate = prefill_rate
+        self.reply_chars = reply_chars
+        self.chunk_chars = chunk_chars
+        self.min_cache_tokens = min_cache_tokens
+        self.caches = {}  # 名稱 -> (CachedContent, 到期時間)
+        self.requests = 0
+        self.billed_input = 0
+        self.cached_input = 0
+        self.cache_hits = 0
+        self.cache_calls = {'create': 0, 'update': 0, 'delete': 0}
+        self.server = None
+
+    @property
+    def endpoint(self) -> str:
+        return f'{self.host}:{self.port}'
+
+    def _cache_tokens(self, cached) -> int:
+        return _count(cached.contents) + _count([cached.system_instruction])
+
+    async def _prepare(self, request, context):
+        """檢查快取並模擬讀取輸入的時間，回傳 usage_metadata"""
+        self.requests += 1
+        cached_tokens = 0
+        if request.cached_content:
+            entry = self.caches.get(request.cached_content)
+            if entry is None or entry[1] <= time.monotonic():
+                self.caches.pop(request.cached_content, None)
+                await context.abort(grpc.StatusCode.NOT_FOUND, f'CachedContent not found: {request.cached_content}')
+            cached_tokens = self._cache_tokens(entry[0])
+            self.cache_hits += 1
+        input_tokens = _count(request.contents) + _count([request.system_instruction])
+        self.billed_input += input_tokens
+        self.cached_input += cached_tokens
+        await asyncio.sleep(self.latency + input_tokens / self.prefill_rate)
+        return glm.GenerateContentResponse.UsageMetadata(
+            prompt_token_count=input_tokens + cached_tokens,
+            cached_content_token_count=cached_tokens,
+            candidates_token_count=self.reply_chars,
+            total_token_count=input_tokens + cached_tokens + self.reply_chars,
+        )
+
+    @staticmethod
+    def _response(text: str, usage=None):
+        return glm.GenerateContentResponse(
+            candidates=[glm.Candidate(content=glm.Content(role='model', parts=[glm.Part(text=text)]),
+                                      finish_reason=glm.Candidate.FinishReason.STOP, index=0)],
+            usage_metadata=usage,
+        )
+
+    async def _generate(self, request, context):
+        usage = await self._prepare(request, context)
+        return self._response('喵' * self.reply_chars, usage)
+
+    async def _stream_generate(self, request, context):
+        usage = await self._prepare(request, context)
+        reply = '喵' * self.reply_chars
+        chunks = [reply[i:i + self.chunk_chars] for i in range(0, len(reply), self.chunk_chars)]
+        for i, chunk in enumerate(chunks):
+            if i:
+                await asyncio.sleep(0.01)
+            yield self._response(chunk, usage if i == len(chunks) - 1 else None)
+
+    async def _create_cache(self, request, context):
+        cached = request.cached_content
+        tokens = self._cache_tokens(cached)
+        if tokens < self.min_cache_tokens:
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT,
+                                f'Cached content is too small. total_token_count={tokens}, '
+                                f'min_total_token_count={self.min_cache_tokens}')
+        self.cache_calls['create'] += 1
+        cached.name = f'cachedContents/mock-{self.cache_calls["create"]}'
+        ttl = cached.ttl.total_seconds() if cached.ttl else 3600
+        cached.expire_time = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=ttl)
+        cached.usage_metadata = glm.CachedContent.UsageMetadata(total_token_count=tokens)
+        self.caches[cached.name] = (cached, time.monotonic() + ttl)
+        return cached
+
+    async def _update_cache(self, request, context):
+        entry = self.caches.get(request.cached_content.name)
+        if entry is None or entry[1] <= time.monotonic():
+            await context.abort(grpc.StatusCode.NOT_FOUND, 'CachedContent not found')
+        self.cache_calls['update'] += 1
+        cached = entry[0]
+        ttl = request.cached_content.ttl.total_seconds()
+        cached.expire_time = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=ttl)
+        self.caches[cached.name] = (cached, time.monotonic() + ttl)
+        return cached
+
+    async def _delete_cache(self, request, context):
+        if self.caches.pop(request.name, None) is None:
+            await context.abort(grpc.StatusCode.NOT_FOUND, 'CachedContent not found')
+        self.cache_calls['delete'] += 1
+        return empty_pb2.Empty()
+
+    async def start(self):
+        def unary(handler, request_type, serializer):
+            return grpc.unary_unary_rpc_method_handler(
+                handler, request_deserializer=request_type.deserialize, response_serializer=serializer
+            )
+
+        self.server = grpc.aio.server()
+        self.server.add_generic_rpc_handlers((
+            grpc.method_handlers_generic_handler(_GEMINI_SERVICE, {
+                'GenerateContent': unary(self._generate, glm.GenerateContentRequest,
+                                         glm.GenerateContentResponse.serialize),
+                'StreamGenerateContent': grpc.unary_stream_rpc_method_handler(
+                    self._stream_generate, request_deserializer=glm.GenerateContentRequest.deserialize,
+                    response_serializer=glm.GenerateContentResponse.serialize
+                ),
+            }),
+            grpc.method_handlers_generic_handler(_CACHE_SERVICE, {
+                'CreateCachedContent': unary(self._create_cache, glm.CreateCachedContentRequest,
+                                             glm.CachedContent.serialize),
+                'UpdateCachedContent': unary(self._update_cache, glm.UpdateCachedContentRequest,
+                                             glm.CachedContent.serialize),
+                'DeleteCachedContent': unary(self._delete_cache, glm.DeleteCachedContentRequest,
+                                             empty_pb2.Empty.SerializeToString),
+            }),
+        ))
+        self.port = self.server.add_insecure_port(f'{self.host}:{self.port}')
+        await self.server.start()
+        logging.info(f'模擬 Gemini 伺服器已啟動：{self.endpoint}')
+
+    async def stop(self):
+        if self.server:
+            await self.server.stop(0)
+            self.server = None
@@ -0,0 +1,121 @@
+import os
+import asyncio
+import logging
+
+# 角色設定檔所在的資料夾，與程式放在同一層
+PROMPT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'prompt')
+DEFAULT_PERSONA = '千雪'
+
+
+class Persona:
+    """單一角色設定；version 在檔案內容變更時遞增，讓後端知道快取的模型需要重建"""
+    def __init__(self, name: str, prompt: str, path: str = None, mtime: int = 0, version: int = 1):
+        self.name = name
+        self.prompt = prompt
+        self.path = path
+        self.mtime = mtime
+        self.version = version
+
+
+class PersonaRegistry:
+    """角色設定登錄表
+
+    啟動時一次讀入 prompt/*.md，之後由背景工作定期檢查檔案修改時間，只重新讀取有變更的檔案。
+    每個頻道或對話可以各自選擇角色，未選擇時使用預設角色。
+    """
+    def __init__(self, directory: str = PROMPT_DIR, default: str = DEFAULT_PERSONA, poll_interval: float = 5):
+        self.directory = directory
+        self.default = default
+        self.poll_interval = poll_interval
+        self.personas = {}
+        self.selections = {}  # 頻道或對話鍵值 -> 角色名稱
+        self._task = None
+        self.reload()
+        if self.default not in self.personas:
+            if not self.personas:
+                raise FileNotFoundError(f"在 {directory} 中找不到任何角色設定檔")
+            fallback = sorted(self.personas)[0]
+            logging.warning(f"找不到預設角色 {self.default}，改用 {fallback}")
+            self.default = fallback
+
+    def _scan(self):
+        """回傳 {名稱: (路徑, 修改時間)}"""
+        found = {}
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.is_file() and entry.name.endswith('.md'):
+                    found[entry.name[:-3]] = (entry.path, entry.stat().st_mtime_ns)
+        return found
+
+    def reload(self):
+        """讀取新增或修改過的角色設定，回傳有變更的角色名稱"""
+        changed = []
+        found = self._scan()
+        # 在副本上修改後整個替換，背景執行緒重新讀取時不會影響事件迴圈正在讀取的字典
+        personas = dict(self.personas)
+        for name, (path, mtime) in found.items():
+            current = personas.get(name)
+            if current is not None and current.mtime == mtime:
+                continue
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    prompt = f.read()
+            except OSError as e:
+                logging.error(f"讀取角色設定 {path} 時發生錯誤：{e}")
+                continue
+            version = current.version + 1 if current else 1
+            personas[name] = Persona(name, prompt, path, mtime, version)
+            changed.append(name)
+
+        for name in list(personas):
+            # 預設角色即使檔案被移除也保留最後一次讀到的內容
+            if name not in found and name != self.default:
+                del personas[name]
+                changed.append(name)
+        self.personas = personas
+
+        if changed:
+            logging.info(f"已載入角色設定：{', '.join(changed)}")
+        return changed
+
+    def names(self):
+        return sorted(self.personas)
+
+    def get(self, name: str = None) -> Persona:
+        """取得角色，找不到時回傳預設角色"""
+        return self.personas.get(name) or self.personas[self.default]
+
+    def select(self, key, name: str = None):
+        """為頻道或對話指定角色，name 為 None 時恢復預設"""
+        if name is None:
+            self.selections.pop(key, None)
+            return
+        if name not in self.personas:
+            raise KeyError(name)
+        self.selections[key] = name
+
+    def resolve(self, *keys) -> Persona:
+        """依序檢查多個鍵值（例如對話、頻道）的選擇，都沒有時使用預設角色"""
+        for key in keys:
+            name = self.selections.get(key)
+            if name in self.personas:
+                return self.personas[name]
+        return self.personas[self.default]
+
+    def start(self):
+        if self._task is None and self.poll_interval:
+            self._task = asyncio.create_task(self._watch())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                await asyncio.to_thread(self.reload)
+            except Exception as e:
+                logging.error(f"檢查角色設定時發生錯誤：{e}")
@@ -0,0 +1,179 @@
+import time
+import asyncio
+import logging
+import datetime
+import discord
+from ratelimit import TokenBucket
+from dispatcher import BULK
+
+# Discord 只允許批次刪除 14 天內的訊息，保留一點緩衝避免清除期間訊息剛好過期
+BULK_MAX_AGE = datetime.timedelta(days=14) - datetime.timedelta(minutes=10)
+BULK_SIZE = 100
+# 互動權杖 15 分鐘後失效，預留一分鐘緩衝
+INTERACTION_TTL = datetime.timedelta(minutes=14)
+
+
+class PurgeProgress:
+    """清除進度"""
+    def __init__(self):
+        self.scanned = 0
+        self.deleted = 0
+        self.bulk = 0
+        self.single = 0
+        self.failed = 0
+        self.done = False
+        self.started = time.monotonic()
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    def describe(self) -> str:
+        state = "已完成" if self.done else "清除中"
+        return (f"{state}：已掃描 {self.scanned} 則，已刪除 {self.deleted} 則"
+                f"（批次 {self.bulk}、逐則 {self.single}），失敗 {self.failed} 則，"
+                f"耗時 {self.elapsed:.0f} 秒")
+
+
+class PurgeEngine:
+    """串流式的訊息清除
+
+    邊讀取頻道歷史邊分類：14 天內的訊息每滿 100 則批次刪除，較舊的訊息交給數個
+    並行的 worker 逐則刪除，並以權杖桶控制速率，避免一次取出整個頻道的歷史。
+    progress 為選用的非同步回呼，最多每 progress_interval 秒呼叫一次。
+    """
+    def __init__(self, channel, limit: int = None, check=None, concurrency: int = 3,
+                 delete_rate: float = 1.0, delete_burst: int = 5, progress=None, progress_interval: float = 3.0):
+        self.channel = channel
+        self.limit = limit
+        self.check = check
+        self.concurrency = max(1, concurrency)
+        self.bucket = TokenBucket(delete_rate, capacity=delete_burst)
+        self.progress = progress
+        self.progress_interval = progress_interval
+        self.state = PurgeProgress()
+        self._queue = asyncio.Queue(maxsize=self.concurrency * 20)
+        self._last_report = 0.0
+
+    async def _report(self, force: bool = False):
+        if not self.progress:
+            return
+        now = time.monotonic()
+        if not force and now - self._last_report < self.progress_interval:
+            return
+        self._last_report = now
+        try:
+            await self.progress(self.state)
+        except Exception as e:
+            logging.warning(f'回報清除進度時發生錯誤：{e}')
+
+    async def _delete_bulk(self, batch):
+        if len(batch) == 1:
+            await self._queue.put(batch[0])
+            return
+        try:
+            await self.channel.delete_messages(batch)
+        except discord.Forbidden:
+            raise
+        except discord.HTTPException as e:
+            # 批次刪除失敗（例如訊息剛好超過 14 天）時改為逐則刪除
+            logging.warning(f'批次刪除失敗，改為逐則刪除：{e}')
+            for message in batch:
+                await self._queue.put(message)
+            return
+        self.state.bulk += len(batch)
+        self.state.deleted += len(batch)
+
+    async def _worker(self):
+        while True:
+            message = await self._queue.get()
+            try:
+                await self.bucket.acquire()
+                await message.delete()
+                self.state.single += 1
+                self.state.deleted += 1
+            except discord.NotFound:
+                # 已經被其他人刪除
+                self.state.deleted += 1
+            except Exception as e:
+                if isinstance(e, discord.HTTPException) and e.status == 429:
+                    self.bucket.penalize(getattr(e, 'retry_after', None) or 1.0)
+                self.state.failed += 1
+                logging.warning(f'刪除訊息 {message.id} 失敗：{e}')
+            finally:
+                self._queue.task_done()
+            await self._report()
+
+    async def run(self) -> PurgeProgress:
+        workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+        cutoff = discord.utils.utcnow() - BULK_MAX_AGE
+        batch = []
+        try:
+            async for message in self.channel.history(limit=self.limit):
+                self.state.scanned += 1
+                if self.check and not self.check(message):
+                    continue
+                if message.created_at > cutoff:
+                    batch.append(message)
+                    if len(batch) >= BULK_SIZE:
+                        await self._delete_bulk(batch)
+                        batch = []
+                else:
+                    await self._queue.put(message)
+                await self._report()
+
+            if batch:
+                await self._delete_bulk(batch)
+            await self._queue.join()
+        finally:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+        self.state.done = True
+        await self._report(force=True)
+        logging.info(f'清除 #{getattr(self.channel, "name", self.channel.id)}：{self.state.describe()}')
+        return self.state
+
+
+class InteractionProgress:
+    """把清除進度回報給斜線指令的發起者
+
+    互動權杖在 15 分鐘後失效，大量清除較舊的訊息可能要花上數小時；權杖接近期限或編輯失敗後，
+    改為經由 dispatcher 在頻道中發送一則一般訊息，之後最多每 channel_interval 秒編輯一次。
+    可直接當作 PurgeEngine 的 progress 回呼；所有錯誤都只記錄，不會拋出。
+    """
+    def __init__(self, interaction, dispatcher, channel_interval: float = 30.0):
+        self.interaction = interaction
+        self.dispatcher = dispatcher
+        self.channel_interval = channel_interval
+        self.expired = False
+        self._message = None
+        self._last_edit = 0.0
+
+    def _token_valid(self) -> bool:
+        return not self.expired and discord.utils.utcnow() - self.interaction.created_at < INTERACTION_TTL
+
+    async def update(self, content: str, force: bool = False):
+        if self._token_valid():
+            try:
+                await self.interaction.edit_original_response(content=content)
+                return
+            except discord.HTTPException as e:
+                logging.warning(f'編輯互動回應失敗，改在頻道中回報進度：{e}')
+                self.expired = True
+
+        now = time.monotonic()
+        if self._message is not None and not force and now - self._last_edit < self.channel_interval:
+            return
+        self._last_edit = now
+        try:
+            if self._message is None:
+                self._message = await self.dispatcher.send(self.interaction.channel, content, priority=BULK)
+            else:
+                await self._message.edit(content=content)
+        except Exception as e:
+            logging.warning(f'在頻道中回報清除進度失敗：{e}')
+
+    async def __call__(self, state: PurgeProgress):
+        await self.update(state.describe(), force=state.done)
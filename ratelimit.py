@@ -0,0 +1,57 @@
+import time
+import asyncio
+
+
+class TokenBucket:
+    """權杖桶速率限制器
+
+    rate 為每秒補充的權杖數，capacity 為可累積的上限（允許的突發量）。
+    """
+    def __init__(self, rate: float, capacity: float = None):
+        if rate <= 0:
+            raise ValueError("rate 必須大於 0")
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, amount: float = 1) -> bool:
+        """立即嘗試取得權杖，不足時回傳 False"""
+        self._refill()
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return True
+        return False
+
+    def delay(self, amount: float = 1) -> float:
+        """距離可取得 amount 個權杖還需等待的秒數"""
+        self._refill()
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    async def acquire(self, amount: float = 1):
+        """等待直到取得權杖"""
+        async with self._lock:
+            while True:
+                wait = self.delay(amount)
+                if wait <= 0:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep(wait)
+
+    def penalize(self, seconds: float):
+        """在收到伺服器要求等待時，暫時清空權杖"""
+        self._refill()
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+    def consume(self, amount: float):
+        """直接扣除權杖而不等待，允許欠額；amount 為負數時歸還權杖"""
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens - amount)
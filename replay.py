@@ -0,0 +1,142 @@
+"""正式環境流量重播
+
+讀取 TraceRecorder 產生的 JSONL，依原始時間（或加速）把提及訊息重新送進 DiscordBot，
+後端連到本機的模擬 LLM 伺服器，藉此離線重現正式環境的負載尖峰。
+
+    python replay.py trace.jsonl --speed 10
+    python replay.py trace.jsonl --backend fake --stream
+"""
+import sys
+import time
+import random
+import asyncio
+import logging
+import argparse
+from statistics import median
+
+from benchmark import FakeBackend, FakeGuild, FakeChannel, FakeUser, Pipeline, LoopLagSampler, build_bot, print_report
+from mock_llm import MockLLMServer
+from session import SessionManager
+from traffic_trace import load_trace
+from log_config import setup_logging
+
+
+def synthesize(chars: int, tokens: int) -> str:
+    """依記錄的長度與 token 比例產生替代內容"""
+    chars = max(1, chars)
+    # token/字元比例接近 1 表示以中文為主，否則以英文單字填充
+    if tokens and tokens / chars > 0.6:
+        return ''.join(random.choice('今天天氣很好我們一起去吃飯吧你覺得如何') for _ in range(chars))
+    words = []
+    length = 0
+    while length < chars:
+        word = random.choice(('hello', 'discord', 'bot', 'weather', 'tonight', 'game', 'ok'))
+        words.append(word)
+        length += len(word) + 1
+    return ' '.join(words)[:chars]
+
+
+class TraceReplayer:
+    """依記錄時間重播提及訊息"""
+    def __init__(self, events, pipeline: Pipeline, speed: float = 1.0, use_content: bool = True):
+        self.events = [e for e in events if e['type'] == 'message' and e.get('mention')]
+        self.pipeline = pipeline
+        self.speed = speed
+        self.use_content = use_content
+        self.channels = {}
+        self.users = {}
+        self.guild = FakeGuild()
+
+    def _channel(self, key):
+        channel = self.channels.get(key)
+        if channel is None:
+            channel = self.channels[key] = FakeChannel(f'replay-{len(self.channels)}', self.guild)
+            channel.on_send = self.pipeline._on_send
+        return channel
+
+    def _user(self, key):
+        user = self.users.get(key)
+        if user is None:
+            user = self.users[key] = FakeUser(f'user-{len(self.users)}')
+        return user
+
+    async def run(self):
+        started = time.perf_counter()
+        for event in self.events:
+            delay = started + event['t'] / self.speed - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if self.use_content and event.get('text'):
+                content = event['text']
+            else:
+                content = synthesize(event['chars'], event.get('tokens', 0))
+            await self.pipeline.inject(content, channel=self._channel(event['channel']), user=self._user(event['user']))
+
+
+async def run_replay(path: str, speed: float = 1.0, backend: str = 'grok-mock', workers: int = 4,
+                     stream: bool = False, latency: float = None, use_content: bool = True,
+                     drain_timeout: float = 120):
+    events = load_trace(path)
+    replies = [e for e in events if e['type'] == 'reply' and e.get('status') == 'ok' and e.get('llm') is not None]
+    reply_chars = [e['chars'] for e in replies] or [120]
+    if latency is None:
+        latency = median([e['llm'] for e in replies]) if replies else 1.0
+
+    server = None
+    sessions = SessionManager()
+    if backend == 'grok-mock':
+        from grok import Grok
+        server = MockLLMServer(latency=latency, reply_chars=reply_chars)
+        await server.start()
+        ai = Grok(sessions=sessions, base_url=server.base_url, api_key='mock')
+        ai.compactor.token_budget = 0  # 重播時不觸發摘要請求
+    else:
+        ai = FakeBackend(latency=latency, sessions=sessions)
+
+    bot = build_bot(ai, workers=workers, stream=stream)
+    # 佇列等待以實際處理請求的一方記錄的開始時間計算
+    pipeline = Pipeline(bot, server or ai, channels=0, users=0)
+    replayer = TraceReplayer(events, pipeline, speed=speed, use_content=use_content)
+    lag = LoopLagSampler()
+
+    bot.start_workers()
+    lag.start()
+    started = time.perf_counter()
+    try:
+        await replayer.run()
+        await pipeline.finish(drain_timeout)
+    finally:
+        elapsed = time.perf_counter() - started
+        await lag.stop()
+        for task in bot.worker_tasks:
+            task.cancel()
+        await asyncio.gather(*bot.worker_tasks, return_exceptions=True)
+        if server:
+            await server.stop()
+
+    return pipeline.report(elapsed, lag.samples)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="重播正式環境的流量記錄")
+    parser.add_argument('trace', help="TraceRecorder 產生的 JSONL 檔案")
+    parser.add_argument('--speed', type=float, default=1.0, help="重播速度倍率，例如 10 代表加速十倍")
+    parser.add_argument('--backend', choices=('grok-mock', 'fake'), default='grok-mock',
+                        help="grok-mock：真實的 Grok 後端連到本機模擬 API；fake：直接使用假後端")
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--stream', action='store_true')
+    parser.add_argument('--latency', type=float, help="覆寫模擬 LLM 延遲中位數（秒），預設取自記錄")
+    parser.add_argument('--no-content', action='store_true', help="即使記錄中有內容也改用合成內容")
+    args = parser.parse_args(argv)
+
+    setup_logging(logging.WARNING)
+    result = asyncio.run(run_replay(
+        args.trace, speed=args.speed, backend=args.backend, workers=args.workers, stream=args.stream,
+        latency=args.latency, use_content=not args.no_content
+    ))
+    print_report(result)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,243 @@
+import time
+import random
+import asyncio
+import logging
+import contextvars
+from metrics import LLM_LATENCY, LLM_REQUESTS, LLM_RETRIES, REGISTRY
+
+# 錯誤分類
+TRANSIENT = 'transient'  # 暫時性錯誤，稍後重試可能成功
+QUOTA = 'quota'          # 配額或速率限制
+FATAL = 'fatal'          # 重試也不會成功的錯誤
+
+_TRANSIENT_STATUS = {408, 409, 500, 502, 503, 504}
+# 沒有 HTTP 狀態碼的連線類錯誤，以類別名稱比對，避免在這裡匯入各家 SDK
+_TRANSIENT_NAMES = {'APIConnectionError', 'APITimeoutError', 'ServiceUnavailable', 'DeadlineExceeded',
+                    'InternalServerError', 'RetryError', 'ClientError', 'ServerDisconnectedError'}
+
+# 目前這次嘗試的總時限（time.monotonic() 的時間點），讓後端內部的等待（例如等待 API Key）不超過時限
+_DEADLINE = contextvars.ContextVar('llm_request_deadline', default=None)
+
+
+def remaining_time():
+    """距離目前請求總時限的秒數，不在 Resilience 之內執行時回傳 None"""
+    deadline = _DEADLINE.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+CIRCUIT_STATE = REGISTRY.gauge('llm_circuit_state', 'LLM 斷路器狀態（0 關閉、1 半開、2 開啟）')
+
+
+class EmptyResponse(Exception):
+    """模型回傳空白內容"""
+
+
+class CircuitOpenError(Exception):
+    """斷路器開啟中，請求直接失敗"""
+    def __init__(self, provider: str, retry_in: float):
+        super().__init__(f"{provider} 斷路器開啟中，{retry_in:.0f} 秒後再試")
+        self.provider = provider
+        self.retry_in = retry_in
+
+
+class RequestDeadlineExceeded(Exception):
+    """超過單一請求的總時限"""
+
+
+def classify(error: Exception) -> str:
+    """將例外分類為 transient、quota 或 fatal"""
+    if isinstance(error, (EmptyResponse, asyncio.TimeoutError, TimeoutError, ConnectionError)):
+        return TRANSIENT
+    # google.api_core 的例外以 code、openai 的例外以 status_code 表示 HTTP 狀態碼
+    status = getattr(error, 'status_code', None)
+    if not isinstance(status, int):
+        status = getattr(error, 'code', None)
+    if isinstance(status, int):
+        if status == 429:
+            return QUOTA
+        if status in _TRANSIENT_STATUS or status >= 500:
+            return TRANSIENT
+        if 400 <= status < 500:
+            return FATAL
+    if any(cls.__name__ in _TRANSIENT_NAMES for cls in type(error).__mro__):
+        return TRANSIENT
+    return FATAL
+
+
+class CircuitBreaker:
+    """斷路器
+
+    連續 failure_threshold 次暫時性錯誤後開啟，recovery_time 秒內的請求直接失敗；
+    之後進入半開狀態，只放行一個試探請求，成功則關閉，失敗則再次開啟。
+    """
+    CLOSED, HALF_OPEN, OPEN = 0, 1, 2
+
+    def __init__(self, name: str, failure_threshold: int = 5, recovery_time: float = 30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_time = recovery_time
+        self.failures = 0
+        self.opened_at = 0.0
+        self.state = self.CLOSED
+        self._probing = False
+        CIRCUIT_STATE.set_function(lambda: self.state, provider=name)
+
+    def retry_in(self) -> float:
+        """距離可以再次嘗試的秒數，關閉狀態時為 0"""
+        if self.state != self.OPEN:
+            return 0.0
+        return max(0.0, self.opened_at + self.recovery_time - time.monotonic())
+
+    def allow(self) -> bool:
+        if self.state == self.OPEN:
+            if self.retry_in() > 0:
+                return False
+            self.state = self.HALF_OPEN
+            self._probing = False
+            logging.info(f"{self.name} 斷路器進入半開狀態")
+        if self.state == self.HALF_OPEN:
+            if self._probing:
+                return False
+            self._probing = True
+        return True
+
+    def record_success(self):
+        if self.state != self.CLOSED:
+            logging.info(f"{self.name} 斷路器已關閉")
+        self.state = self.CLOSED
+        self.failures = 0
+        self._probing = False
+
+    def record_ignored(self):
+        """結果不影響斷路器狀態（例如配額或請求本身的錯誤），只釋放半開時的試探名額"""
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                logging.warning(f"{self.name} 斷路器開啟，{self.recovery_time} 秒內的請求將直接失敗")
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+            self._probing = False
+
+
+class RetryPolicy:
+    """指數退避加上隨機抖動（full jitter）的重試策略"""
+    def __init__(self, max_attempts: int = 4, base_delay: float = 0.5, max_delay: float = 8,
+                 deadline: float = 45, stream_idle_timeout: float = 30):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.stream_idle_timeout = stream_idle_timeout
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+class Resilience:
+    """為單一 LLM 供應商包裝重試、總時限與斷路器，並記錄請求指標"""
+    def __init__(self, provider: str, policy: RetryPolicy = None, breaker: CircuitBreaker = None):
+        self.provider = provider
+        self.policy = policy or RetryPolicy()
+        self.breaker = breaker or CircuitBreaker(provider)
+
+    def _check(self, deadline: float) -> float:
+        """確認斷路器與總時限，回傳剩餘秒數"""
+        if not self.breaker.allow():
+            raise CircuitOpenError(self.provider, self.breaker.retry_in())
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise RequestDeadlineExceeded(f"{self.provider} 請求超過 {self.policy.deadline} 秒時限")
+        return remaining
+
+    def _failed(self, error: Exception, attempt: int, deadline: float):
+        """記錄失敗並決定是否重試，回傳退避秒數；不應重試時重新拋出例外"""
+        kind = classify(error)
+        LLM_REQUESTS.inc(provider=self.provider, status=kind)
+        if kind == TRANSIENT:
+            self.breaker.record_failure()
+        else:
+            # 配額與請求本身的錯誤不代表服務中斷
+            self.breaker.record_ignored()
+
+        if kind == FATAL or attempt + 1 >= self.policy.max_attempts:
+            raise error
+        # 配額錯誤通常可以換一把 Key 立即重試
+        delay = 0.0 if kind == QUOTA else self.policy.backoff(attempt)
+        if time.monotonic() + delay >= deadline:
+            raise error
+        LLM_RETRIES.inc(provider=self.provider)
+        logging.warning(f"{self.provider} 請求失敗（{kind}，第 {attempt + 1}/{self.policy.max_attempts} 次），"
+                        f"{delay:.1f} 秒後重試: {error}")
+        return delay
+
+    def _succeeded(self, before: float):
+        self.breaker.record_success()
+        LLM_LATENCY.observe(time.perf_counter() - before, provider=self.provider)
+        LLM_REQUESTS.inc(provider=self.provider, status='ok')
+
+    async def call(self, operation):
+        """執行 operation()（回傳 awaitable 的函式），失敗時依策略重試"""
+        deadline = time.monotonic() + self.policy.deadline
+        for attempt in range(self.policy.max_attempts):
+            remaining = self._check(deadline)
+            before = time.perf_counter()
+            try:
+                token = _DEADLINE.set(deadline)
+                try:
+                    async with asyncio.timeout(remaining):
+                        result = await operation()
+                finally:
+                    _DEADLINE.reset(token)
+            except asyncio.CancelledError:
+                self.breaker.record_ignored()
+                raise
+            except Exception as e:
+                await asyncio.sleep(self._failed(e, attempt, deadline))
+                continue
+            self._succeeded(before)
+            return result
+
+    async def stream(self, operation):
+        """逐段產生 operation()（回傳非同步產生器的函式）的內容
+
+        只有在尚未產生任何內容前才會重試；總時限只限制第一段內容的等待時間，
+        之後每段內容之間最多等待 stream_idle_timeout 秒。
+        """
+        deadline = time.monotonic() + self.policy.deadline
+        for attempt in range(self.policy.max_attempts):
+            self._check(deadline)
+            before = time.perf_counter()
+            chunks = operation()
+            started = False
+            try:
+                while True:
+                    timeout = self.policy.stream_idle_timeout if started else deadline - time.monotonic()
+                    try:
+                        # 時限只包住等待下一段的過程，不能包住 yield，否則會取消到呼叫端
+                        token = _DEADLINE.set(None if started else deadline)
+                        try:
+                            async with asyncio.timeout(max(timeout, 0)):
+                                chunk = await chunks.__anext__()
+                        finally:
+                            _DEADLINE.reset(token)
+                    except StopAsyncIteration:
+                        break
+                    started = True
+                    yield chunk
+            except (asyncio.CancelledError, GeneratorExit):
+                self.breaker.record_ignored()
+                raise
+            except Exception as e:
+                if started:
+                    LLM_REQUESTS.inc(provider=self.provider, status=classify(e))
+                    self.breaker.record_failure()
+                    raise
+                await asyncio.sleep(self._failed(e, attempt, deadline))
+                continue
+            finally:
+                await chunks.aclose()
+            self._succeeded(before)
+            return
@@ -0,0 +1,207 @@
+import time
+import asyncio
+import logging
+from latency import RollingWindow
+from session import SessionManager
+from metrics import LLM_HEDGES, LLM_FAILOVERS
+
+
+class RouterBackend:
+    """在主要與備援 LLM 後端之間路由的後端
+
+    主要後端在最近延遲的 hedge_percentile 百分位內沒有回覆時，同時對備援後端送出對沖請求，
+    採用最先成功的回覆並取消另一個；任一後端的斷路器開啟時直接改用另一個。
+    兩個後端共用同一個 SessionManager，只有勝出的回覆會以該後端的 commit 寫入歷史，
+    因此不論哪個後端產生回覆，對話歷史都保持一致。
+
+    被包裝的後端需提供 generate(session, text)、generate_stream(session, text)、commit(session, text, reply)
+    以及 resilience 屬性（gemini_ai 與 Grok 皆已提供）。
+    """
+    def __init__(self, primary, secondary, sessions: SessionManager = None, hedge_percentile: float = 95,
+                 min_hedge_delay: float = 1.0, default_hedge_delay: float = 4.0, min_samples: int = 20,
+                 window: int = 200):
+        self.primary = primary
+        self.secondary = secondary
+        self.sessions = sessions if sessions is not None else primary.sessions
+        self.hedge_percentile = hedge_percentile
+        self.min_hedge_delay = min_hedge_delay
+        self.default_hedge_delay = default_hedge_delay
+        self.min_samples = min_samples
+        # 各後端成功請求的完整延遲與串流第一段內容的延遲（秒），以後端物件為 key
+        self.latencies = {primary: RollingWindow(window), secondary: RollingWindow(window)}
+        self.first_chunk = {primary: RollingWindow(window), secondary: RollingWindow(window)}
+
+    @staticmethod
+    def _name(backend) -> str:
+        return backend.resilience.provider
+
+    @staticmethod
+    def _available(backend) -> bool:
+        return backend.resilience.breaker.retry_in() <= 0
+
+    def _order(self):
+        """回傳 (首選, 備援)，首選後端的斷路器開啟時直接改用另一個"""
+        if not self._available(self.primary) and self._available(self.secondary):
+            LLM_FAILOVERS.inc(provider=self._name(self.primary))
+            return self.secondary, self.primary
+        return self.primary, self.secondary
+
+    def hedge_delay(self, backend, stream: bool = False) -> float:
+        """依最近的延遲分佈決定多久沒有回覆就送出對沖請求"""
+        window = self.first_chunk[backend] if stream else self.latencies[backend]
+        if len(window) < self.min_samples:
+            return self.default_hedge_delay
+        return max(self.min_hedge_delay, window.percentile(self.hedge_percentile))
+
+    async def _timed(self, backend, session, text: str, persona=None):
+        before = time.perf_counter()
+        reply = await backend.generate(session, text, persona)
+        self.latencies[backend].add(time.perf_counter() - before)
+        return reply
+
+    async def chat_async(self, text: str, session_key=None, persona=None):
+        """送出請求，必要時對沖或改用備援後端"""
+        if not text or not isinstance(text, str):
+            logging.error("無效的輸入文本")
+            return "抱歉，我無法處理空白或無效的輸入。"
+
+        session = self.sessions.get(session_key)
+        first, second = self._order()
+        tasks = {asyncio.create_task(self._timed(first, session, text, persona)): first}
+        pending = set(tasks)
+        hedge_at = time.monotonic() + self.hedge_delay(first)
+        winner = None
+        try:
+            while True:
+                if pending:
+                    timeout = max(0.0, hedge_at - time.monotonic()) if second is not None else None
+                    done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        if task.exception() is None:
+                            winner = task
+                            break
+                        logging.warning(f"{self._name(tasks[task])} 請求失敗: {task.exception()}")
+                    if winner:
+                        break
+                # 首選後端逾時或已經失敗時，送出對沖（或改用）備援後端
+                if second is not None and (not pending or time.monotonic() >= hedge_at):
+                    if self._available(second):
+                        if pending:
+                            LLM_HEDGES.inc(provider=self._name(second))
+                            logging.info(f"{self._name(first)} 超過 {self.hedge_delay(first):.1f} 秒未回覆，"
+                                         f"同時向 {self._name(second)} 送出請求")
+                        else:
+                            LLM_FAILOVERS.inc(provider=self._name(first))
+                        task = asyncio.create_task(self._timed(second, session, text, persona))
+                        tasks[task] = second
+                        pending.add(task)
+                    second = None
+                if not pending:
+                    break
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+
+        if winner is None:
+            logging.error("所有 AI 後端皆無法回覆")
+            return "抱歉，我現在遇到了一些技術問題，請稍後再試。"
+
+        reply = winner.result()
+        backend = tasks[winner]
+        logging.info(f"由 {self._name(backend)} 產生回覆")
+        backend.commit(session, text, reply)
+        return reply
+
+    async def _pump(self, backend, session, text: str, persona, queue: asyncio.Queue):
+        """在獨立的工作中讀取串流，將 (後端, 種類, 內容) 放入共用佇列"""
+        try:
+            async for chunk in backend.generate_stream(session, text, persona):
+                await queue.put((backend, 'chunk', chunk))
+            await queue.put((backend, 'done', None))
+        except Exception as e:
+            await queue.put((backend, 'error', e))
+
+    async def chat_stream(self, text: str, session_key=None, persona=None):
+        """以串流方式回覆，對沖條件以第一段內容的等待時間判斷
+
+        最先產生內容的後端勝出，另一個串流會被取消；勝出後若串流中斷則交給呼叫端處理。
+        """
+        if not text or not isinstance(text, str):
+            logging.error("無效的輸入文本")
+            yield "抱歉，我無法處理空白或無效的輸入。"
+            return
+
+        session = self.sessions.get(session_key)
+        first, second = self._order()
+        queue = asyncio.Queue()
+        pumps = {first: asyncio.create_task(self._pump(first, session, text, persona, queue))}
+        started = time.perf_counter()
+        hedge_at = time.monotonic() + self.hedge_delay(first, stream=True)
+        winner = None
+        failed = set()
+        parts = []
+        try:
+            while True:
+                timeout = None
+                if winner is None and second is not None:
+                    timeout = max(0.0, hedge_at - time.monotonic())
+                try:
+                    backend, kind, payload = await asyncio.wait_for(queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    backend, kind, payload = None, None, None
+
+                if winner is None and kind == 'chunk':
+                    winner = backend
+                    self.first_chunk[backend].add(time.perf_counter() - started)
+                    for other, task in pumps.items():
+                        if other is not backend:
+                            task.cancel()
+                if backend is not None and backend is not winner and winner is not None:
+                    continue
+
+                if kind == 'chunk':
+                    parts.append(payload)
+                    yield payload
+                elif kind == 'done':
+                    if winner is None:
+                        # 沒有任何內容就結束，視同失敗
+                        failed.add(backend)
+                    else:
+                        break
+                elif kind == 'error':
+                    if winner is not None:
+                        raise payload
+                    logging.warning(f"{self._name(backend)} 串流請求失敗: {payload}")
+                    failed.add(backend)
+
+                if winner is None and second is not None and (first in failed or time.monotonic() >= hedge_at):
+                    if self._available(second):
+                        if first in failed:
+                            LLM_FAILOVERS.inc(provider=self._name(first))
+                        else:
+                            LLM_HEDGES.inc(provider=self._name(second))
+                        pumps[second] = asyncio.create_task(self._pump(second, session, text, persona, queue))
+                    second = None
+
+                if winner is None and len(failed) == len(pumps) and second is None:
+                    logging.error("所有 AI 後端皆無法回覆")
+                    yield "抱歉，我現在遇到了一些技術問題，請稍後再試。"
+                    return
+        finally:
+            for task in pumps.values():
+                task.cancel()
+            await asyncio.gather(*pumps.values(), return_exceptions=True)
+
+        logging.info(f"由 {self._name(winner)} 產生回覆")
+        winner.commit(session, text, ''.join(parts))
+
+    def get_history(self, session_key=None):
+        """獲取歷史記錄"""
+        return self.primary.get_history(session_key)
+
+    def cleanup(self):
+        """清理資源"""
+        self.primary.cleanup()
+        self.secondary.cleanup()
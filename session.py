@@ -0,0 +1,202 @@
+import time
+import logging
+from collections import OrderedDict
+
+# 對話範圍：決定哪些訊息共用同一段上下文
+SCOPES = ('user', 'channel', 'guild', 'global')
+
+
+class Session:
+    """單一對話的歷史記錄
+
+    訊息以與供應商無關的格式儲存：{'role': 'user' | 'assistant', 'content': str}，
+    由各後端在送出請求前轉換成自己的格式。較舊的訊息會被 ContextCompactor 併入 summary，
+    max_messages 與 max_chars 只是摘要來不及時的硬性上限。
+
+    每則訊息都有遞增的序號，start 為 messages[0] 的序號；設定 store 時新增的訊息與摘要
+    會同步寫入 ConversationStore。
+    """
+    def __init__(self, key, max_messages: int = 100, max_chars: int = 40000, store=None):
+        self.key = key
+        self.max_messages = max_messages
+        self.max_chars = max_chars
+        self.store = store
+        self.messages = []
+        self.chars = 0
+        self.start = 0
+        self.summary = ''
+        self.compacting = False
+        self.created_at = time.monotonic()
+        self.last_active = self.created_at
+
+    def append(self, role: str, content: str):
+        """新增一則訊息，超出上限時從最舊的訊息開始移除"""
+        if self.store:
+            self.store.append(self.key, self.start + len(self.messages), role, content)
+        self.messages.append({'role': role, 'content': content})
+        self.chars += len(content)
+        self.touch()
+        self._trim()
+
+    def extend_turn(self, user_text: str, reply: str):
+        """新增一組使用者訊息與模型回覆"""
+        self.append('user', user_text)
+        self.append('assistant', reply)
+
+    def _trim(self):
+        # 保留最新一組對話，成對移除以避免歷史以 assistant 開頭
+        while len(self.messages) > 2 and (
+            len(self.messages) > self.max_messages or self.chars > self.max_chars
+        ):
+            self.drop_oldest(2)
+
+    def drop_oldest(self, count: int):
+        """移除最舊的 count 則訊息"""
+        removed = self.messages[:count]
+        del self.messages[:count]
+        self.chars -= sum(len(m['content']) for m in removed)
+        self.start += len(removed)
+
+    def set_summary(self, summary: str, count: int):
+        """以摘要取代最舊的 count 則訊息"""
+        self.drop_oldest(count)
+        self.summary = summary
+        if self.store:
+            self.store.save_summary(self.key, summary, self.start)
+
+    def restore(self, summary: str, start: int, messages):
+        """以資料庫中的記錄還原對話"""
+        # 視窗可能從對話中間切開，去掉開頭的模型回覆
+        while messages and messages[0]['role'] != 'user':
+            messages = messages[1:]
+            start += 1
+        self.summary = summary
+        self.start = start
+        self.messages = list(messages)
+        self.chars = sum(len(m['content']) for m in self.messages)
+        self._trim()
+
+    def touch(self):
+        self.last_active = time.monotonic()
+
+    def clear(self):
+        self.messages.clear()
+        self.chars = 0
+        self.start = 0
+        self.summary = ''
+        if self.store:
+            self.store.delete(self.key)
+
+    def __len__(self):
+        return len(self.messages)
+
+
+class SessionManager:
+    """依 (guild, channel, user) 管理對話，支援 LRU 與閒置逾時淘汰
+
+    設定 store 時，淘汰只是釋放記憶體，對話再次活躍時由 load 從資料庫載入最近的視窗。
+    """
+    def __init__(self, scope: str = 'user', max_sessions: int = 500, max_messages: int = 100,
+                 max_chars: int = 40000, ttl: float = 3600, store=None):
+        if scope not in SCOPES:
+            raise ValueError(f"未知的對話範圍：{scope}，可用值：{', '.join(SCOPES)}")
+
+        self.scope = scope
+        self.max_sessions = max_sessions
+        self.max_messages = max_messages
+        self.max_chars = max_chars
+        self.ttl = ttl
+        self.store = store
+        self._sessions = OrderedDict()
+
+    def key_for(self, guild_id=None, channel_id=None, user_id=None):
+        """依設定的範圍產生對話鍵值"""
+        if self.scope == 'user':
+            return (guild_id, channel_id, user_id)
+        if self.scope == 'channel':
+            return (guild_id, channel_id)
+        if self.scope == 'guild':
+            return (guild_id,)
+        return ('global',)
+
+    def key_for_message(self, message):
+        """從 Discord 訊息產生對話鍵值"""
+        guild_id = message.guild.id if message.guild else None
+        return self.key_for(guild_id, message.channel.id, message.author.id)
+
+    def get(self, key=None) -> Session:
+        """取得對話，不存在時才建立"""
+        if key is None:
+            key = ('global',)
+
+        self.prune()
+        session = self._sessions.get(key)
+        if session is None:
+            session = self._create(key)
+            self._sessions[key] = session
+            self._evict_overflow()
+        else:
+            self._sessions.move_to_end(key)
+        session.touch()
+        return session
+
+    async def load(self, key=None) -> Session:
+        """取得對話，不在記憶體中時先從資料庫載入最近的記錄"""
+        if key is None:
+            key = ('global',)
+        if self.store is None or key in self._sessions:
+            return self.get(key)
+
+        state = await self.store.load(key)
+        # 等待期間可能已經由其他請求建立
+        if key not in self._sessions and state is not None:
+            session = self._create(key)
+            session.restore(*state)
+            self._sessions[key] = session
+            self._evict_overflow()
+            logging.debug(f"已從資料庫載入對話 {key}：{len(session.messages)} 則訊息")
+        return self.get(key)
+
+    def attach_store(self, store):
+        """之後的對話寫入 store；已在記憶體中的對話也改為寫入，但先前的內容不會補寫"""
+        self.store = store
+        for session in self._sessions.values():
+            session.store = store
+
+    def _create(self, key) -> Session:
+        return Session(key, max_messages=self.max_messages, max_chars=self.max_chars, store=self.store)
+
+    def _evict_overflow(self):
+        while len(self._sessions) > self.max_sessions:
+            key, _ = self._sessions.popitem(last=False)
+            logging.debug(f"對話數量超過上限，淘汰最久未使用的對話：{key}")
+
+    def prune(self):
+        """移除閒置超過 ttl 的對話"""
+        if not self.ttl:
+            return
+        now = time.monotonic()
+        # OrderedDict 以最近使用排序，遇到第一個未逾時的即可停止
+        while self._sessions:
+            key, session = next(iter(self._sessions.items()))
+            if now - session.last_active < self.ttl:
+                break
+            self._sessions.popitem(last=False)
+            logging.debug(f"對話閒置逾時，已淘汰：{key}")
+
+    def peek(self, key):
+        """取得對話但不更新使用時間"""
+        return self._sessions.get(key)
+
+    def drop(self, key):
+        self._sessions.pop(key, None)
+
+    def clear(self):
+        self._sessions.clear()
+
+    def __len__(self):
+        # 沒有任何對話時為 False：判斷是否有傳入 SessionManager 要用 is None，不能用 or
+        return len(self._sessions)
+
+    def __contains__(self, key):
+        return key in self._sessions
@@ -0,0 +1,205 @@
+import json
+import time
+import queue
+import sqlite3
+import asyncio
+import logging
+import threading
+from concurrent.futures import Future
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    session TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    created REAL NOT NULL,
+    PRIMARY KEY (session, seq)
+);
+CREATE INDEX IF NOT EXISTS idx_messages_created ON messages(created);
+CREATE TABLE IF NOT EXISTS summaries (
+    session TEXT PRIMARY KEY,
+    summary TEXT NOT NULL,
+    start INTEGER NOT NULL,
+    updated REAL NOT NULL
+);
+"""
+
+# 寫入類工作可以合併成同一個交易
+_WRITES = ('append', 'summary', 'delete')
+
+
+def encode_key(key) -> str:
+    """將對話鍵值（tuple）轉成資料庫用的字串"""
+    return json.dumps(list(key), separators=(',', ':'))
+
+
+class ConversationStore:
+    """以 SQLite（WAL 模式）保存對話歷史
+
+    所有資料庫操作都在單一背景執行緒中進行，事件迴圈只負責把工作放入佇列：
+    寫入會在 flush_interval 內累積成批、以同一個交易寫出；讀取排在先前的寫入之後，
+    因此剛被淘汰又重新載入的對話也能讀到最新內容。背景執行緒每 prune_interval 秒
+    依保存天數與每段對話的訊息上限清理舊資料。
+    """
+    def __init__(self, path: str = 'conversations.db', window: int = 50, batch_size: int = 200,
+                 flush_interval: float = 0.5, max_age_days: float = 30, max_messages_per_session: int = 2000,
+                 prune_interval: float = 3600):
+        self.path = path
+        self.window = window
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_age_days = max_age_days
+        self.max_messages_per_session = max_messages_per_session
+        self.prune_interval = prune_interval
+        self.written = 0
+        self._jobs = queue.Queue()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='conversation-store', daemon=True)
+            self._thread.start()
+            logging.info(f'對話資料庫：{self.path}')
+
+    # 以下方法由事件迴圈呼叫，只放入佇列不會阻塞
+
+    def append(self, key, seq: int, role: str, content: str):
+        self._jobs.put(('append', (encode_key(key), seq, role, content, time.time()), None))
+
+    def save_summary(self, key, summary: str, start: int):
+        self._jobs.put(('summary', (encode_key(key), summary, start, time.time()), None))
+
+    def delete(self, key):
+        self._jobs.put(('delete', encode_key(key), None))
+
+    def _submit(self, kind: str, payload):
+        # 背景執行緒沒有在執行時，等待結果的工作永遠不會完成
+        if self._thread is None:
+            raise RuntimeError('對話資料庫尚未啟動或已關閉，請先呼叫 start()')
+        future = Future()
+        self._jobs.put((kind, payload, future))
+        return asyncio.wrap_future(future)
+
+    async def load(self, key):
+        """讀取對話最近的視窗，回傳 (摘要, 第一則訊息的序號, 訊息列表)，沒有記錄時回傳 None"""
+        return await self._submit('load', encode_key(key))
+
+    async def prune(self):
+        """立即清理舊資料，回傳刪除的訊息數量"""
+        return await self._submit('prune', None)
+
+    async def close(self):
+        """寫出所有尚未寫入的資料並停止背景執行緒"""
+        if self._thread is None:
+            return
+        self._jobs.put(('stop', None, None))
+        await asyncio.to_thread(self._thread.join)
+        self._thread = None
+
+    # 以下方法只在背景執行緒中執行
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, isolation_level=None)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        db.executescript(_SCHEMA)
+        return db
+
+    def _run(self):
+        db = self._connect()
+        next_prune = time.monotonic() + self.prune_interval
+        running = True
+        while running:
+            try:
+                job = self._jobs.get(timeout=max(0.0, next_prune - time.monotonic()))
+            except queue.Empty:
+                job = ('prune', None, None)
+
+            # 收集同一批的寫入，遇到讀取或停止時提早結束
+            batch = [job]
+            deadline = time.monotonic() + self.flush_interval
+            while job[0] in _WRITES and len(batch) < self.batch_size:
+                try:
+                    job = self._jobs.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                batch.append(job)
+
+            writes = [j for j in batch if j[0] in _WRITES]
+            if writes:
+                try:
+                    self._write(db, writes)
+                except sqlite3.Error as e:
+                    logging.error(f'寫入對話資料庫時發生錯誤：{e}')
+
+            for kind, payload, future in batch:
+                if kind in _WRITES:
+                    continue
+                if kind == 'stop':
+                    running = False
+                    continue
+                try:
+                    if kind == 'load':
+                        result = self._load(db, payload)
+                    else:
+                        result = self._prune(db)
+                        next_prune = time.monotonic() + self.prune_interval
+                    if future:
+                        future.set_result(result)
+                except Exception as e:
+                    logging.error(f'存取對話資料庫時發生錯誤：{e}')
+                    if future:
+                        future.set_exception(e)
+        db.close()
+
+    def _write(self, db, jobs):
+        db.execute('BEGIN')
+        try:
+            for kind, payload, _ in jobs:
+                if kind == 'append':
+                    db.execute('INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?)', payload)
+                elif kind == 'summary':
+                    db.execute('INSERT OR REPLACE INTO summaries VALUES (?, ?, ?, ?)', payload)
+                else:
+                    db.execute('DELETE FROM messages WHERE session = ?', (payload,))
+                    db.execute('DELETE FROM summaries WHERE session = ?', (payload,))
+            db.execute('COMMIT')
+        except sqlite3.Error:
+            db.execute('ROLLBACK')
+            raise
+        self.written += len(jobs)
+
+    def _load(self, db, session: str):
+        row = db.execute('SELECT summary, start FROM summaries WHERE session = ?', (session,)).fetchone()
+        summary, start = row if row else ('', 0)
+        rows = db.execute(
+            'SELECT seq, role, content FROM messages WHERE session = ? AND seq >= ? ORDER BY seq DESC LIMIT ?',
+            (session, start, self.window)
+        ).fetchall()
+        if not rows and not summary:
+            return None
+        rows.reverse()
+        first = rows[0][0] if rows else start
+        return summary, first, [{'role': role, 'content': content} for _, role, content in rows]
+
+    def _prune(self, db):
+        deleted = 0
+        if self.max_age_days:
+            cutoff = time.time() - self.max_age_days * 86400
+            deleted += db.execute('DELETE FROM messages WHERE created < ?', (cutoff,)).rowcount
+            db.execute('DELETE FROM summaries WHERE updated < ? AND session NOT IN (SELECT session FROM messages)',
+                       (cutoff,))
+        if self.max_messages_per_session:
+            oversized = db.execute(
+                'SELECT session, MAX(seq) FROM messages GROUP BY session HAVING COUNT(*) > ?',
+                (self.max_messages_per_session,)
+            ).fetchall()
+            for session, last in oversized:
+                deleted += db.execute(
+                    'DELETE FROM messages WHERE session = ? AND seq <= ?',
+                    (session, last - self.max_messages_per_session)
+                ).rowcount
+        if deleted:
+            logging.info(f'已清理 {deleted} 則過期的對話記錄')
+        return deleted
@@ -1,30 +1,62 @@
 import asyncio
 import os
+import argparse
+from startup import STARTUP
 from dotenv import load_dotenv
-from discord_bot import DiscordBot
 import signal
 import sys
-from gemini import cleanup_genai
 import logging
-from rich.logging import RichHandler
-
-# 設定日誌
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[RichHandler()]
-)
+from log_config import setup_logging
 
 # 載入環境變數
 load_dotenv()
+
+parser = argparse.ArgumentParser(description='啟動 Discord Bot')
+parser.add_argument('--profile-startup', action='store_true',
+                    help='只執行匯入與初始化（不登入 Discord），列出各階段耗時後結束')
+parser.add_argument('--force-sync', action='store_true', help='不論指令是否變更都同步斜線指令')
+parser.add_argument('--sync-guild', type=int, action='append', metavar='GUILD_ID',
+                    help='只同步斜線指令到指定的伺服器（開發用，可重複指定）')
+parser.add_argument('--log-json', action='store_true', default=os.getenv('LOG_FORMAT') == 'json',
+                    help='以精簡的 JSON 格式輸出日誌（也可設定環境變數 LOG_FORMAT=json）')
+parser.add_argument('--rich', action='store_true', default=os.getenv('LOG_RICH') == '1',
+                    help='使用 Rich 彩色日誌與含區域變數的錯誤堆疊，僅供開發（也可設定 LOG_RICH=1）')
+parser.add_argument('--store', default=os.getenv('CONVERSATION_DB', 'conversations.db'), metavar='PATH',
+                    help='保存對話記錄的 SQLite 檔案（也可設定環境變數 CONVERSATION_DB）')
+parser.add_argument('--no-store', action='store_true', help='不保存對話記錄，重新啟動後對話從頭開始')
+args = parser.parse_args()
+store_path = None if args.no_store else args.store
+STARTUP.enabled = args.profile_startup
+
+# 設定日誌：記錄交給背景執行緒輸出
+setup_logging(json_format=args.log_json, rich=args.rich)
+
+def rich_excepthook(*exc_info):
+    """第一次出現未處理的例外時才載入 rich.traceback（含區域變數的輸出載入較慢）"""
+    from rich import traceback
+    traceback.install(show_locals=True)
+    sys.excepthook(*exc_info)
+
+if args.rich:
+    sys.excepthook = rich_excepthook
+
+with STARTUP.phase('匯入 discord_bot'):
+    from discord_bot import DiscordBot
+
 token = os.getenv('DISCORD_TOKEN')
 owner_id = 808972376619483137  # 你的 Discord ID
-channel_ID = int(os.getenv('CHANNEL_ID'))
+channel_ID = int(os.getenv('CHANNEL_ID', '0'))
 thread_ID = int(os.getenv('THREAD_ID', '0'))  # 新增討論串 ID
 
 # 全局變數用於控制關閉流程
 shutdown_event = asyncio.Event()
 
+def cleanup_genai():
+    """清理 Gemini 資源；只有選用 Gemini 後端時才會載入該模組"""
+    gemini = sys.modules.get('gemini')
+    if gemini:
+        gemini.cleanup_genai()
+
 def handle_shutdown(signum, frame):
     """處理關閉信號"""
     logging.info('接收到關閉信號，正在安全關閉...')
@@ -46,7 +78,9 @@ async def main():
         signal.signal(signal.SIGTERM, handle_shutdown)
         
         # 創建並啟動 bot
-        bot = DiscordBot(token, owner_id)
+        with STARTUP.phase('DiscordBot 初始化'):
+            bot = DiscordBot(token, owner_id, store_path=store_path, sync_guilds=args.sync_guild,
+                             force_sync=args.force_sync)
         logging.info('正在啟動機器人...')
         await bot.start()
 
@@ -63,7 +97,20 @@ async def main():
             await asyncio.sleep(1)
             await shutdown()
 
+async def profile_startup():
+    """只執行初始化與 setup_hook，不登入 Discord，列出各階段耗時"""
+    with STARTUP.phase('DiscordBot 初始化'):
+        bot = DiscordBot(token, owner_id, store_path=store_path)
+    await bot.setup_hook()
+    # 在關閉前輸出，避免把關閉所需的時間算進總計
+    print(STARTUP.report())
+    await bot.close()
+
 if __name__ == '__main__':
+    if args.profile_startup:
+        asyncio.run(profile_startup())
+        sys.exit(0)
+
     try:
         asyncio.run(main())
         
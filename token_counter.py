@@ -0,0 +1,60 @@
+import re
+import logging
+from functools import lru_cache
+
+# 中日韓文字（含全形標點）大約每個字一個 token
+_CJK = re.compile(
+    r'[\u3000-\u303f\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]'
+)
+# 英文單字與數字大約每 4 個字元一個 token
+_WORD = re.compile(r'[A-Za-z0-9_]+')
+# 其他非空白字元（標點、符號、表情）各算一個 token
+_OTHER = re.compile(r'[^\sA-Za-z0-9_\u3000-\u303f\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]')
+
+
+@lru_cache(maxsize=4096)
+def _raw_estimate(text: str) -> float:
+    cjk = len(_CJK.findall(text))
+    words = sum(max(1, len(w) / 4) for w in _WORD.findall(text))
+    other = len(_OTHER.findall(text))
+    return cjk + words + other
+
+
+class TokenEstimator:
+    """本地 token 估算器
+
+    以 CJK 感知的規則估算 token 數量，結果經 LRU 快取。每次拿到伺服器回傳的實際用量時
+    呼叫 calibrate，以指數移動平均修正估算倍率，不需再為計數額外發送 count_tokens 請求。
+    """
+    def __init__(self, ratio: float = 1.0, smoothing: float = 0.1):
+        self.ratio = ratio
+        self.smoothing = smoothing
+
+    def count(self, text: str) -> int:
+        """估算文字的 token 數量"""
+        if not text:
+            return 0
+        return max(1, round(_raw_estimate(text) * self.ratio))
+
+    def calibrate(self, text: str, actual_tokens: int):
+        """以伺服器回報的實際 token 數修正估算倍率"""
+        if not text or not actual_tokens:
+            return
+        raw = _raw_estimate(text)
+        if raw <= 0:
+            return
+        observed = actual_tokens / raw
+        self.ratio += (observed - self.ratio) * self.smoothing
+        logging.debug(f"token 估算倍率已更新為 {self.ratio:.3f}")
+
+    def cache_info(self):
+        return _raw_estimate.cache_info()
+
+
+# 不屬於特定後端的估算（例如流量記錄）共用的估算器；各 LLM 後端各自持有一個依自家用量校正的實例
+estimator = TokenEstimator()
+
+
+def estimate_tokens(text: str) -> int:
+    """以全域估算器估算 token 數量"""
+    return estimator.count(text)
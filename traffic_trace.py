@@ -0,0 +1,133 @@
+import os
+import hmac
+import json
+import time
+import queue
+import hashlib
+import logging
+import threading
+from token_counter import estimate_tokens
+
+
+class TraceRecorder:
+    """正式環境流量記錄器
+
+    將每則訊息的時間、大小與處理延遲寫成精簡的 JSONL，頻道與使用者 ID 以每次記錄隨機產生的
+    鹽值做 HMAC 匿名化；只有 include_content 為 True 時才會保存訊息內容。
+    事件在事件迴圈上只放入佇列，序列化與寫檔由背景執行緒處理，每 flush_every 筆或
+    flush_interval 秒寫入一次。
+    """
+    def __init__(self, path: str, include_content: bool = False, flush_every: int = 50,
+                 flush_interval: float = 1.0):
+        self.path = path
+        self.include_content = include_content
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self._salt = os.urandom(16)
+        self._started = time.monotonic()
+        self._events = queue.SimpleQueue()
+        self._file = open(path, 'a', encoding='utf-8')
+        self._thread = threading.Thread(target=self._run, name='trace-recorder', daemon=True)
+        self._thread.start()
+        self._write({'type': 'start', 'wall': time.time(), 'content': include_content})
+        logging.info(f'正在記錄流量至 {path}')
+
+    def _anon(self, value) -> str:
+        if value is None:
+            return None
+        return hmac.new(self._salt, str(value).encode(), hashlib.sha256).hexdigest()[:12]
+
+    def _write(self, event: dict):
+        event['t'] = round(time.monotonic() - self._started, 4)
+        self._events.put(event)
+
+    def _run(self):
+        buffer = []
+        stopping = False
+        while not stopping:
+            deadline = time.monotonic() + self.flush_interval
+            while len(buffer) < self.flush_every:
+                try:
+                    event = self._events.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if event is None:
+                    stopping = True
+                    break
+                buffer.append(json.dumps(event, ensure_ascii=False, separators=(',', ':')))
+            if buffer:
+                try:
+                    self._file.write('\n'.join(buffer) + '\n')
+                    self._file.flush()
+                except OSError as e:
+                    logging.warning(f'寫入流量記錄失敗：{e}')
+                buffer.clear()
+        self._file.close()
+
+    def record_message(self, message, mentioned: bool):
+        """記錄收到的訊息"""
+        event = {
+            'type': 'message',
+            'guild': self._anon(message.guild.id if message.guild else None),
+            'channel': self._anon(message.channel.id),
+            'user': self._anon(message.author.id),
+            'mention': mentioned,
+            'chars': len(message.content),
+            'tokens': estimate_tokens(message.content),
+        }
+        if self.include_content:
+            event['text'] = message.content
+        self._write(event)
+
+    def record_reply(self, message, queue_wait: float, llm_latency: float, handle_latency: float,
+                     reply: str, status: str):
+        """記錄一次回覆的佇列等待、延遲與回覆大小
+
+        llm 為取得模型回覆所花的時間（失敗時為 None），handle 另外包含等待與發送回覆的時間。
+        """
+        event = {
+            'type': 'reply',
+            'channel': self._anon(message.channel.id),
+            'user': self._anon(message.author.id),
+            'wait': round(queue_wait, 4),
+            'llm': round(llm_latency, 4) if llm_latency is not None else None,
+            'handle': round(handle_latency, 4),
+            'chars': len(reply or ''),
+            'tokens': estimate_tokens(reply or ''),
+            'status': status,
+        }
+        if self.include_content:
+            event['text'] = reply
+        self._write(event)
+
+    def close(self):
+        """寫入剩下的事件並停止背景執行緒"""
+        if self._thread is None:
+            return
+        self._events.put(None)
+        self._thread.join()
+        self._thread = None
+
+
+def load_trace(path: str):
+    """讀取流量記錄，回傳事件列表
+
+    同一個檔案可能包含多次啟動的記錄，依每段的啟動時間把 t 換算成相對於第一段的秒數。
+    """
+    events = []
+    first_wall = None
+    offset = 0.0
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            event = json.loads(line)
+            if event['type'] == 'start':
+                if first_wall is None:
+                    first_wall = event['wall']
+                offset = event['wall'] - first_wall
+                continue
+            event['t'] += offset
+            events.append(event)
+    return events
@@ -0,0 +1,265 @@
+import os
+import time
+import random
+import asyncio
+import logging
+from collections import Counter
+import aiohttp
+from ratelimit import TokenBucket
+
+# OpenWeatherMap API設置
+API_KEY = os.getenv('OPENWEATHER_API_KEY', '5f11c065acc703865b9351406ac35562')
+BASE_URL = "http://api.openweathermap.org/data/2.5"
+
+# 天氣圖標對照表
+WEATHER_ICONS = {
+    "Clear": "☀️",
+    "Clouds": "☁️",
+    "Rain": "🌧️",
+    "Drizzle": "🌦️",
+    "Thunderstorm": "⛈️",
+    "Snow": "🌨️",
+    "Mist": "🌫️",
+    "Smoke": "🌫️",
+    "Haze": "🌫️",
+    "Dust": "🌫️",
+    "Fog": "🌫️",
+    "Sand": "🌫️",
+    "Ash": "🌫️",
+    "Squall": "🌪️",
+    "Tornado": "🌪️"
+}
+
+
+class WeatherError(Exception):
+    """天氣 API 回傳非 200 狀態"""
+    def __init__(self, status: int, message: str = ''):
+        super().__init__(f"天氣 API 回傳 {status}: {message}")
+        self.status = status
+
+
+class WeatherService:
+    """天氣查詢服務
+
+    共用一個 aiohttp 連線池，同時查詢當前天氣與預報；結果依城市快取（當前天氣與預報各自的 TTL），
+    同一城市的並行查詢只會發出一次上游請求。
+    """
+    def __init__(self, api_key: str = API_KEY, current_ttl: float = 600, forecast_ttl: float = 1800,
+                 timeout: float = 10):
+        self.api_key = api_key
+        self.ttls = {'weather': current_ttl, 'forecast': forecast_ttl}
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.session = None
+
+        self._cache = {}      # (kind, city) -> (過期時間, 資料)
+        self._inflight = {}   # (kind, city) -> 進行中的 Future
+
+        # 統計資訊
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.prefetches = 0
+        self.upstream_requests = 0
+        self.upstream_errors = 0
+        self.upstream_latency_total = 0.0
+        self.last_upstream_latency = 0.0
+
+    async def start(self):
+        """建立共用連線池"""
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(timeout=self.timeout)
+
+    async def close(self):
+        """關閉連線池"""
+        if self.session and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+    async def get_weather(self, city: str):
+        """同時取得當前天氣與預報，回傳 (current, forecast)；預報失敗時 forecast 為 None"""
+        current, forecast = await asyncio.gather(
+            self.get_current(city),
+            self.get_forecast(city),
+            return_exceptions=True
+        )
+        if isinstance(current, BaseException):
+            raise current
+        if isinstance(forecast, BaseException):
+            logging.warning(f"取得 {city} 的天氣預報失敗：{forecast}")
+            forecast = None
+        return current, forecast
+
+    async def get_current(self, city: str):
+        return await self._get('weather', city)
+
+    async def get_forecast(self, city: str):
+        return await self._get('forecast', city)
+
+    async def refresh(self, kind: str, city: str):
+        """略過快取重新取得資料，供背景預取使用"""
+        return await self._get(kind, city, force=True)
+
+    def expires_in(self, kind: str, city: str):
+        """快取剩餘有效秒數，不存在時回傳 None"""
+        entry = self._cache.get((kind, city))
+        if entry is None:
+            return None
+        return entry[0] - time.monotonic()
+
+    async def _get(self, kind: str, city: str, force: bool = False):
+        key = (kind, city)
+        entry = self._cache.get(key)
+        if not force and entry and entry[0] > time.monotonic():
+            self.hits += 1
+            return entry[1]
+
+        # 合併同一城市的並行查詢
+        future = self._inflight.get(key)
+        if future is not None:
+            self.coalesced += 1
+            return await asyncio.shield(future)
+
+        if force:
+            self.prefetches += 1
+        else:
+            self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            data = await self._fetch(kind, city)
+            self._cache[key] = (time.monotonic() + self.ttls[kind], data)
+            future.set_result(data)
+            return data
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # 避免沒有其他等待者時出現「例外未被取得」警告
+            future.exception()
+            raise
+        finally:
+            self._inflight.pop(key, None)
+
+    async def _fetch(self, kind: str, city: str):
+        await self.start()
+        params = {
+            "q": city,
+            "appid": self.api_key,
+            "units": "metric",  # 使用攝氏溫度
+            "lang": "zh_tw"     # 使用繁體中文
+        }
+        self.upstream_requests += 1
+        before = time.monotonic()
+        try:
+            async with self.session.get(f"{BASE_URL}/{kind}", params=params) as resp:
+                data = await resp.json(content_type=None)
+                if resp.status != 200:
+                    raise WeatherError(resp.status, data.get('message', '') if isinstance(data, dict) else '')
+                return data
+        except Exception:
+            self.upstream_errors += 1
+            raise
+        finally:
+            self.last_upstream_latency = (time.monotonic() - before) * 1000
+            self.upstream_latency_total += self.last_upstream_latency
+
+    def stats(self):
+        """快取命中率與上游延遲統計"""
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'prefetches': self.prefetches,
+            'hit_rate': (self.hits + self.coalesced) / lookups if lookups else 0.0,
+            'upstream_requests': self.upstream_requests,
+            'upstream_errors': self.upstream_errors,
+            'avg_upstream_latency_ms': self.upstream_latency_total / self.upstream_requests if self.upstream_requests else 0.0,
+            'last_upstream_latency_ms': self.last_upstream_latency,
+            'cached_entries': len(self._cache),
+        }
+
+
+class WeatherPrefetcher:
+    """熱門城市的背景預取排程器
+
+    記錄每個城市的查詢次數，定期在前 top_k 個城市的快取到期前主動更新。
+    每個城市的更新時間加上隨機抖動以分散請求，並以全域權杖桶限制預取的上游請求量。
+    """
+    def __init__(self, service: WeatherService, top_k: int = 5, refresh_margin: float = 60,
+                 interval: float = 15, jitter: float = 20, budget_per_minute: int = 20,
+                 decay_interval: float = 3600):
+        self.service = service
+        self.top_k = top_k
+        self.refresh_margin = refresh_margin
+        self.interval = interval
+        self.jitter = jitter
+        self.decay_interval = decay_interval
+        self.budget = TokenBucket(rate=budget_per_minute / 60, capacity=budget_per_minute)
+
+        self.counts = Counter()
+        self._jitters = {}
+        self._task = None
+        self._last_decay = time.monotonic()
+
+    def record(self, city: str):
+        """記錄一次查詢"""
+        self.counts[city] += 1
+
+    def hot_cities(self):
+        return [city for city, _ in self.counts.most_common(self.top_k)]
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                self._decay()
+                await self.refresh_due()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"天氣預取時發生錯誤：{e}")
+
+    def _decay(self):
+        # 定期將次數減半，讓排名反映近期的查詢熱度
+        if time.monotonic() - self._last_decay < self.decay_interval:
+            return
+        self._last_decay = time.monotonic()
+        for city in list(self.counts):
+            self.counts[city] //= 2
+            if not self.counts[city]:
+                del self.counts[city]
+                self._jitters.pop(city, None)
+
+    async def refresh_due(self):
+        """更新即將到期的熱門城市快取"""
+        jobs = []
+        for city in self.hot_cities():
+            margin = self.refresh_margin + self._jitters.setdefault(city, random.uniform(0, self.jitter))
+            for kind in ('weather', 'forecast'):
+                remaining = self.service.expires_in(kind, city)
+                if remaining is not None and remaining > margin:
+                    continue
+                if not self.budget.try_acquire():
+                    logging.debug("天氣預取已達請求預算上限")
+                    break
+                jobs.append(self.service.refresh(kind, city))
+
+        if jobs:
+            results = await asyncio.gather(*jobs, return_exceptions=True)
+            failed = sum(isinstance(r, Exception) for r in results)
+            logging.debug(f"已預取 {len(jobs) - failed}/{len(jobs)} 筆天氣資料")